@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import socket
+import sys
+from typing import Optional
+
+from analyze import compute_game_stats
+from async_engine import STREAM_LIMIT, AsyncAnalysisEngine
+from game_data import GameData
+
+# Long-running analysis server that keeps KataGo engines warm (network loaded, NN cache filled) between requests.
+#
+#     python analysis_daemon.py serve -e "katago analysis -config analysis.cfg -model model.bin.gz" --socket /tmp/igoadviser.sock
+#     python analysis_daemon.py query --socket /tmp/igoadviser.sock game1.sgf game2.sgf
+#
+# The protocol is one JSON object per line in each direction, over a Unix socket or a localhost TCP port:
+#
+#     request:  {"id": any, "games": [{"name": str, "sgf": str} | {"name": str, "game_data": {GameData fields}}],
+#                "max_visits": int, "ownership": bool, "include_responses": bool}   (all but "games" optional)
+#     response: {"id": any, "games": [{"name": str, "stats": <analyze.compute_game_stats>, "responses": [...]}
+#                                     | {"name": str, "error": str}]}
+#
+# Every request is handled concurrently, so queries from simultaneous clients are in the engine together and
+# share its NN batches. An identical game that is already being analyzed is not queried again; the second
+# caller waits for the first query's responses.
+
+
+class AnalysisDaemon:
+    def __init__(
+        self, engines: list[AsyncAnalysisEngine], max_visits: Optional[int] = None, ownership: Optional[bool] = None
+    ) -> None:
+        assert engines
+        self.engines = engines
+        self.max_visits = max_visits
+        self.ownership = ownership
+        self._in_flight: dict[str, asyncio.Future[list[dict]]] = dict()
+
+    async def analyze_game(
+        self, game_data: GameData, max_visits: Optional[int] = None, ownership: Optional[bool] = None
+    ) -> list[dict]:
+        if max_visits is None:
+            max_visits = self.max_visits
+        if ownership is None:
+            ownership = self.ownership
+        query_dict = game_data.to_query_dict("", max_visits, ownership)
+        key = hashlib.sha256(json.dumps(query_dict, sort_keys=True).encode("utf-8")).hexdigest()
+        future = self._in_flight.get(key)
+        if future is None:
+            # registered before anything is awaited, so an identical request arriving while the query is being
+            # submitted waits for it too; the entry goes away however the query ends, so a failed one is retried
+            future = asyncio.ensure_future(self._query(query_dict))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _query(self, query_dict: dict) -> list[dict]:
+        engine = min(self.engines, key=lambda e: e.in_flight_turns)
+        query = await engine.submit(query_dict)
+        return await query.result()
+
+    async def handle_request(self, request: dict) -> dict:
+        async def handle_game(i: int, item: dict) -> dict:
+            name = item.get("name", f"game{i}")
+            try:
+                if "sgf" in item:
+                    game_data = GameData.from_sgf_string(item["sgf"], name)
+                else:
+                    game_data = GameData(**item["game_data"])
+                game_data.validate()
+                katago_results = await self.analyze_game(game_data, request.get("max_visits"), request.get("ownership"))
+                result = {"name": name, "stats": compute_game_stats(katago_results, game_data)}
+                if request.get("include_responses"):
+                    result["responses"] = katago_results
+                return result
+            except Exception as e:
+                return {"name": name, "error": f"{type(e).__name__}: {e}"}
+
+        games = await asyncio.gather(*[handle_game(i, item) for i, item in enumerate(request.get("games", []))])
+        return {"id": request.get("id"), "games": games}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        write_lock = asyncio.Lock()
+        tasks: set[asyncio.Task] = set()
+
+        async def respond(line: bytes) -> None:
+            try:
+                response = await self.handle_request(json.loads(line))
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            async with write_lock:
+                writer.write(f"{json.dumps(response)}\n".encode("utf-8"))
+                await writer.drain()
+
+        try:
+            async for line in reader:
+                if not line.strip():
+                    continue
+                task = asyncio.ensure_future(respond(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args: dict) -> None:
+    engine_cmds = [re.split(r"\s+", cmd.strip()) for cmd in args["engine_command"]]
+    engines = [await AsyncAnalysisEngine.start(cmd) for cmd in engine_cmds]
+    daemon = AnalysisDaemon(engines, args["max_visits"], args["ownership"] or None)
+    if args["socket"] is not None:
+        if os.path.exists(args["socket"]):
+            os.remove(args["socket"])
+        server = await asyncio.start_unix_server(daemon.handle_connection, args["socket"], limit=STREAM_LIMIT)
+        print(f"Listening on {args['socket']}")
+    else:
+        server = await asyncio.start_server(daemon.handle_connection, "127.0.0.1", args["port"], limit=STREAM_LIMIT)
+        print(f"Listening on 127.0.0.1:{args['port']}")
+    sys.stdout.flush()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for engine in engines:
+            await engine.close()
+        if args["socket"] is not None and os.path.exists(args["socket"]):
+            os.remove(args["socket"])
+
+
+def request(request_dict: dict, socket_path: Optional[str] = None, port: Optional[int] = None) -> dict:
+    """Send one request to a running daemon and wait for its response."""
+    if socket_path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    else:
+        sock = socket.create_connection(("127.0.0.1", port))
+    with sock, sock.makefile("rwb") as f:
+        f.write(f"{json.dumps(request_dict)}\n".encode("utf-8"))
+        f.flush()
+        return json.loads(f.readline())
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Run the daemon")
+    serve_parser.add_argument(
+        "-e", "--engine_command", action="append", required=True, help="KataGo analysis engine command (repeatable)"
+    )
+    serve_parser.add_argument("--max_visits", type=int, help="Default maxVisits of requests that do not set it")
+    serve_parser.add_argument("--ownership", action="store_true", help="Include ownership unless requests set it")
+    query_parser = subparsers.add_parser("query", help="Analyze SGFs with a running daemon and print the statistics")
+    query_parser.add_argument("sgf_files", nargs="+")
+    query_parser.add_argument("--max_visits", type=int)
+    for p in (serve_parser, query_parser):
+        address_group = p.add_mutually_exclusive_group(required=True)
+        address_group.add_argument("--socket", help="Unix socket path")
+        address_group.add_argument("--port", type=int, help="Localhost TCP port")
+    args = vars(parser.parse_args(argv))
+
+    if args["command"] == "serve":
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
+    else:
+        games = []
+        for sgf_file in args["sgf_files"]:
+            with open(sgf_file, "r", encoding="utf-8") as f:
+                games.append({"name": os.path.splitext(os.path.basename(sgf_file))[0], "sgf": f.read()})
+        response = request({"games": games, "max_visits": args["max_visits"]}, args["socket"], args["port"])
+        print(json.dumps(response, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,155 +1,711 @@
 from __future__ import annotations
 
 import argparse
+import collections
 import copy
-import glob
+import hashlib
 import json
 import os
+import queue
 import re
+import socket
+import sqlite3
 import subprocess
 import sys
 import threading
 import time
+from collections.abc import Mapping
 from signal import SIGINT
-from typing import Optional
-
-from pysgf import SGF, SGFNode
-
-SUPPORTED_RULES = (
-    "tromp-taylor",
-    "chinese",
-    "chinese-ogs",
-    "chinese-kgs",
-    "japanese",
-    "korean",
-    "stone-scoring",
-    "aga",
-    "bga",
-    "new-zealand",
-    "aga-button",
-)
-
-
-class GameData:
-    def __init__(
-        self,
-        board_x_size: int,
-        board_y_size: int,
-        komi: float,
-        rules: str,
-        initial_stones: list[list[str]],
-        moves: list[list[str]],
-        player_black: str,
-        player_white: str,
-    ) -> None:
-        self.board_x_size = board_x_size
-        self.board_y_size = board_y_size
-        self.komi = komi
-        self.rules = rules
-        self.initial_stones = initial_stones
-        self.moves = moves
-        self.player_black = player_black
-        self.player_white = player_white
+from typing import Callable, Iterator, Optional, Sequence, Union
 
-    @staticmethod
-    def from_sgf(filename: str) -> GameData:
-        root = SGF.parse_file(filename, "utf-8")
-
-        assert root.get_property("SZ") is not None
-        bx, by = root.board_size
-        assert 0 <= bx <= 19 and 0 <= by <= 19
-
-        if root.get_property("KM") is None:
-            print(f"No KM property in {filename}")
-        if root.komi == 375:
-            print("Interpret komi 375 as 7.5")
-            root.set_property("KM", 7.5)
-
-        if root.get_property("RU") is None:
-            print(f"No RU property in {filename}")
-            if root.komi == 6.5:
-                root.set_property("RU", "japanese")
-            elif root.komi == 7.5:
-                root.set_property("RU", "chinese")
-
-        initial_stones = [[m.player, m.gtp()] for m in root.move_with_placements if not m.is_pass]
-
-        nodes = [root]
-        node = root
-        while node.children:
-            assert len(node.children) == 1
-            node = node.children[0]
-            nodes.append(node)
-        assert isinstance(node, SGFNode)
-        assert node.nodes_from_root == nodes
-        moves: list[list[str]] = []
-        prev_player = ""
-        for node in nodes[1:]:
-            assert node.move is not None
-            m = node.move
-            if m.player == prev_player:
-                moves.append([m.PLAYERS.replace(m.player, ""), "pass"])
-            moves.append([m.player, m.gtp()])
-            prev_player = m.player
-        while moves and moves[-1][1].lower() == "pass":
-            moves.pop()
-        assert moves
-
-        player_black = "player_1"
-        if root.get_property("PB") is not None:
-            player_black = root.get_property("PB")
-        player_white = "player_2"
-        if root.get_property("PW") is not None:
-            player_white = root.get_property("PW")
-
-        return GameData(bx, by, root.komi, root.ruleset, initial_stones, moves, player_black, player_white)
-
-    def to_query(self, id_: str, max_visits: Optional[int] = None, ownership: Optional[bool] = None) -> str:
-        assert 1 <= self.board_x_size <= 19 and 1 <= self.board_y_size <= 19
-        assert abs(self.komi) <= 150
-        assert self.komi * 10 % 5 == 0
-        assert self.rules.lower() in SUPPORTED_RULES
-
-        query_dict = {
-            "id": f"{id_}",
-            "boardXSize": self.board_x_size,
-            "boardYSize": self.board_y_size,
-            "komi": self.komi,
-            "rules": self.rules,
-            "initialStones": self.initial_stones,
-            "moves": self.moves,
-            "analyzeTurns": list(range(len(self.moves) + 1)),
-        }
-        if max_visits is not None:
-            assert max_visits >= 1
-            query_dict["maxVisits"] = max_visits
-        if ownership is not None:
-            query_dict["includeMovesOwnership"] = ownership
-
-        return json.dumps(query_dict)
+import numpy as np
 
+from corpus import drop_illegal_games, load_games
+from game_data import SUPPORTED_RULES, GameData
+from go_board import gtp_to_point, inverse_symmetry, position_hashes, transform_gtp, transform_point
+from metrics import Metrics, MetricsExporter
+from result_index import ResultLog, ResultLogWriter
+from result_store import OWNERSHIP_DTYPES, RECORD_ERRORS, ResultStore, ResultStoreWriter, open_results
+from shard_queue import ShardQueue, merge_shards
 
 class AnalysisEngine:
-    def __init__(self, cmd: list[str], result_filename: str) -> None:
+    def __init__(
+        self,
+        cmd: list[str],
+        on_line: Callable[[AnalysisEngine, bytes], None],
+        on_exit: Callable[[AnalysisEngine], None],
+    ) -> None:
         print(f"engine command: \"{' '.join(cmd)}\"")
-        with open(result_filename, "w", encoding="utf-8") as f:
-            self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=f, stderr=sys.stderr)
+        self.cmd = cmd
+        self.config = read_engine_config(cmd)
+        self.default_max_visits = int(self.config.get("maxVisits", 1))
+        self.in_flight: dict[str, int] = dict()
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr)
+        self._write_lock = threading.Lock()
+        self._on_line = on_line
+        self._on_exit = on_exit
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
 
     @property
     def proc(self) -> subprocess.Popen[bytes]:
         return self._proc
 
+    @property
+    def in_flight_cost(self) -> int:
+        return sum(self.in_flight.values())
+
     def write_query(self, query: str) -> None:
-        def write_query_target() -> None:
-            if self._proc.stdin is not None:
+        if self._proc.stdin is not None:
+            with self._write_lock:
                 self._proc.stdin.write(f"{query}\n".encode("utf-8"))
                 self._proc.stdin.flush()
+        else:
+            print("proc.stdin is None")
+
+    def close(self) -> None:
+        if self._proc.stdin is not None and not self._proc.stdin.closed:
+            self._proc.stdin.close()
+
+    def _read_responses(self) -> None:
+        assert self._proc.stdout is not None
+        try:
+            for line in self._proc.stdout:
+                self._on_line(self, line)
+        finally:
+            self._on_exit(self)
+
+
+class TurnWindow:
+    """Limit on the turns outstanding in one engine, adapted to how fast the engine completes them.
+
+    The engine's throughput (visits per second) is measured over periods of at least a window of completed turns
+    and a second, and compared with its slowly decaying peak. Starting from the initial limit, the limit doubles
+    while that raises the throughput by more than a tenth and is then halved back. After that it shrinks by an
+    eighth while the throughput stays within 5% of the peak, and grows by a quarter when it falls more than 10%
+    below it with the window in use. The limit thus hovers just above the knee where fewer outstanding turns
+    would leave analysis threads idle, without queueing whole games in front of them. Without adaptive the
+    limit stays at its initial value.
+    """
+
+    def __init__(self, initial: int, min_limit: int = 1, adaptive: bool = True) -> None:
+        assert initial >= 1
+        self.limit = initial
+        self.min_limit = min(min_limit, initial)
+        self.max_limit = max(initial * 16, 256)
+        self.adaptive = adaptive
+        self._growing = True
+        self._outstanding = 0
+        self._period_start = self._last_change = time.perf_counter()
+        self._area = 0.0
+        self._completed = 0
+        self._visits = 0
+        self._peak = 0.0
+        # (limit, turns/s, seconds per turn in the engine) of recent periods
+        self._history: collections.deque[tuple[int, float, float]] = collections.deque(maxlen=16)
+
+    def room(self, outstanding: int) -> int:
+        return self.limit - outstanding
+
+    def update(self, outstanding: int, completed: int = 0, visits: int = 0) -> None:
+        now = time.perf_counter()
+        self._area += self._outstanding * (now - self._last_change)
+        self._last_change = now
+        self._outstanding = outstanding
+        self._completed += completed
+        self._visits += visits
+        elapsed = now - self._period_start
+        if self._completed < min(max(self.limit, 16), 1024) or elapsed < 1.0:
+            return
+        turn_rate = self._completed / elapsed
+        throughput = (self._visits or self._completed) / elapsed
+        mean_outstanding = self._area / elapsed
+        self._history.append((self.limit, turn_rate, mean_outstanding / turn_rate))
+        self._period_start = now
+        self._area = 0.0
+        self._completed = 0
+        self._visits = 0
+        if not self.adaptive:
+            return
+        saturated = mean_outstanding >= self.limit / 2
+        if self._growing:
+            if saturated and (self._peak == 0 or throughput > 1.1 * self._peak):
+                self.limit = min(self.max_limit, self.limit * 2)
+            elif saturated:
+                self._growing = False
+                self.limit = max(self.min_limit, self.limit // 2)
+        elif saturated and throughput < 0.9 * self._peak:
+            self.limit = min(self.max_limit, self.limit + max(1, self.limit // 4))
+        elif throughput >= 0.95 * self._peak:
+            self.limit = max(self.min_limit, self.limit - max(1, self.limit // 8))
+        # A slowly decaying maximum, so the reference follows lasting changes such as a different visit count
+        self._peak = max(self._peak * 0.98, throughput)
+
+    def summary(self) -> str:
+        if self.limit == sys.maxsize:
+            window = "no window"
+        elif self.adaptive and self._history:
+            mean_limit = sum(h[0] for h in self._history) / len(self._history)
+            window = f"window settled at {mean_limit:.0f} turns (last {self.limit})"
+        else:
+            window = f"window {self.limit} turns"
+        if not self._history:
+            return f"{window} (too few turns to measure)"
+        _, turn_rates, residences = zip(*self._history)
+        return (
+            f"{window},"
+            f" {sum(turn_rates) / len(turn_rates):.1f} turns/s,"
+            f" {sum(residences) / len(residences):.3f}s per turn in the engine"
+        )
+
+
+class EnginePool:
+    """Runs one or more engine processes and spreads games across them.
+
+    Each game goes to the engine with the least outstanding cost (analyzed turns x visits), and at most
+    max_in_flight games are registered per engine; submit blocks until one has room. The turns of the
+    registered games are written to the engine in chunks (queries with ids "<id>#<n>") as far as the engine's
+    TurnWindow allows, higher KataGo priority first, so the engine's queue stays short. A turn_window of 0
+    writes every game as one query right away. Responses from all engines are grouped by game, and a game is
+    handed out by completed_games as soon as all of its turns have arrived.
+
+    An engine that exits before the pool is closed (crash, OOM kill) is restarted up to max_restarts times, and
+    the turns it had not answered yet are written to the new process. A game that has been in flight during
+    more than max_retries engine exits, or that the engine rejects with an error, is given up: it is handed out
+    by completed_games with None instead of responses.
+    """
+
+    def __init__(
+        self,
+        cmds: list[list[str]],
+        max_in_flight: int,
+        metrics: Optional[Metrics] = None,
+        max_restarts: int = 5,
+        max_retries: int = 2,
+        turn_window: Optional[int] = None,
+    ) -> None:
+        assert cmds and max_in_flight >= 1
+        self.max_in_flight = max_in_flight
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.max_restarts = max_restarts
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._closing = False
+        self._queries: dict[str, dict] = dict()
+        self._unsent: dict[str, list[int]] = dict()
+        self._num_chunks: dict[str, int] = dict()
+        self._num_turns: dict[str, int] = dict()
+        self._responses: dict[str, list[dict]] = dict()
+        self._engine_of: dict[str, AnalysisEngine] = dict()
+        self._submit_time: dict[str, float] = dict()
+        self._retries: dict[str, int] = dict()
+        self._restarts = [0] * len(cmds)
+        self._completed: queue.Queue[Optional[tuple[str, Optional[list[dict]]]]] = queue.Queue()
+        self._num_running = len(cmds)
+        self.engines = [AnalysisEngine(cmd, self._on_line, self._on_exit) for cmd in cmds]
+        self.windows = [self._new_window(engine, turn_window) for engine in self.engines]
+
+    @staticmethod
+    def _new_window(engine: AnalysisEngine, turn_window: Optional[int]) -> TurnWindow:
+        if turn_window is not None:
+            return TurnWindow(turn_window if turn_window > 0 else sys.maxsize, adaptive=False)
+        # Every analysis thread needs a turn to search; start with as many waiting as searching
+        num_threads = int(engine.config.get("numAnalysisThreads", 0))
+        return TurnWindow(2 * num_threads if num_threads > 0 else 16, min_limit=max(num_threads, 1))
+
+    def submit(self, query_dict: dict) -> None:
+        id_ = query_dict["id"]
+        wait_start = time.perf_counter()
+        with self._cond:
+            while True:
+                available = [
+                    e for e in self.engines if e.proc.poll() is None and len(e.in_flight) < self.max_in_flight
+                ]
+                if available:
+                    break
+                if not any(e.proc.poll() is None for e in self.engines):
+                    raise RuntimeError("All engines have exited")
+                self._cond.wait()
+            self.metrics.observe("submit_wait", time.perf_counter() - wait_start)
+            engine = min(available, key=lambda e: e.in_flight_cost)
+            engine.in_flight[id_] = len(query_dict["analyzeTurns"]) * query_dict.get("maxVisits", engine.default_max_visits)
+            self._engine_of[id_] = engine
+            self._queries[id_] = query_dict
+            self._unsent[id_] = list(query_dict["analyzeTurns"])
+            self._num_chunks[id_] = 0
+            self._num_turns[id_] = len(query_dict["analyzeTurns"])
+            self._responses[id_] = []
+            self._submit_time[id_] = time.perf_counter()
+            self._update_in_flight()
+            chunks = self._take_chunks(engine)
+        self._write_chunks(engine, chunks)
+        self.metrics.inc("queries_submitted")
+
+    def close(self) -> None:
+        with self._cond:
+            self._closing = True
+        for engine in self.engines:
+            engine.close()
+
+    def wait(self) -> list[int]:
+        return [engine.proc.wait() for engine in self.engines]
+
+    def send_signal(self, sig: int) -> None:
+        with self._cond:
+            self._closing = True
+        for engine in self.engines:
+            if engine.proc.poll() is None:
+                engine.proc.send_signal(sig)
+
+    def kill(self) -> None:
+        with self._cond:
+            self._closing = True
+        for engine in self.engines:
+            if engine.proc.poll() is None:
+                engine.proc.kill()
+
+    def window_summary(self) -> list[str]:
+        return [f"engine {i}: {window.summary()}" for i, window in enumerate(self.windows)]
+
+    def completed_games(self) -> Iterator[tuple[str, Optional[list[dict]]]]:
+        """Yield (id, responses) for each game as soon as all of its turns have been received, (id, None) for a
+        game that was given up."""
+        while True:
+            item = self._completed.get()
+            if item is None:
+                break
+            yield item
+        with self._cond:
+            for id_, responses in self._responses.items():
+                print(f"Incomplete result for {id_}: {len(responses)}/{self._num_turns[id_]} turns", file=sys.stderr)
+
+    def _outstanding_turns(self, engine: AnalysisEngine) -> int:
+        """Turns written to an engine and not answered yet."""
+        return sum(
+            self._num_turns[id_] - len(self._unsent[id_]) - len(self._responses[id_]) for id_ in engine.in_flight
+        )
+
+    def _take_chunks(self, engine: AnalysisEngine) -> list[dict]:
+        """The queries to write to an engine to fill its window, taken out of the unsent turns (under the lock)."""
+        window = self.windows[self.engines.index(engine)]
+        outstanding = self._outstanding_turns(engine)
+        room = window.room(outstanding)
+        # Chunks smaller than this are not worth a query that repeats the whole move list
+        min_chunk = max(1, window.limit // 2)
+        chunks = []
+        for id_ in sorted(engine.in_flight, key=lambda i: -self._queries[i].get("priority", 0)):
+            unsent = self._unsent[id_]
+            if not unsent:
+                continue
+            if room < min(min_chunk, len(unsent)):
+                break
+            turns, self._unsent[id_] = unsent[:room], unsent[room:]
+            chunks.append(dict(self._queries[id_], id=f"{id_}#{self._num_chunks[id_]}", analyzeTurns=turns))
+            self._num_chunks[id_] += 1
+            room -= len(turns)
+            outstanding += len(turns)
+        if chunks:
+            window.update(outstanding)
+            self.metrics.set_gauge(f"turn_window_{self.engines.index(engine)}", window.limit)
+        return chunks
+
+    def _write_chunks(self, engine: AnalysisEngine, chunks: list[dict]) -> None:
+        for chunk in chunks:
+            try:
+                with self.metrics.timer("query_write"):
+                    engine.write_query(json.dumps(chunk))
+            except (OSError, ValueError):
+                # The engine died (or was closed); its exit puts every unanswered turn back to be written to the
+                # new process
+                return
+
+    def _release(self, id_: str) -> None:
+        engine = self._engine_of.pop(id_)
+        engine.in_flight.pop(id_, None)
+        del self._queries[id_]
+        del self._unsent[id_]
+        del self._num_chunks[id_]
+        self._retries.pop(id_, None)
+        del self._num_turns[id_]
+        del self._responses[id_]
+        self._submit_time.pop(id_, None)
+        self._update_in_flight()
+        self._cond.notify_all()
+
+    def _update_in_flight(self) -> None:
+        self.metrics.set_gauge("queries_in_flight", len(self._engine_of))
+
+    def _on_line(self, engine: AnalysisEngine, line: bytes) -> None:
+        response = json.loads(line)
+        chunks: list[dict] = []
+        with self._cond:
+            id_ = response.get("id", "").rsplit("#", 1)[0]
+            if "error" in response:
+                print(f"Engine error: {response}", file=sys.stderr)
+                if id_ in self._responses:
+                    self._release(id_)
+                    self._completed.put((id_, None))
+                return
+            if "warning" in response:
+                print(f"Engine warning: {response}", file=sys.stderr)
+                return
+            if response.get("isDuringSearch", False):
+                return
+
+            responses = self._responses.get(id_)
+            if responses is None:
+                return
+            response["id"] = id_
+            responses.append(response)
+            now = time.perf_counter()
+            if len(responses) == 1:
+                self.metrics.observe("first_response", now - self._submit_time[id_])
+            self.metrics.inc("turns_analyzed")
+            self.metrics.inc("visits", response.get("rootInfo", {}).get("visits", 0))
+            complete = len(responses) == self._num_turns[id_]
+            if complete:
+                self.metrics.observe("query_latency", now - self._submit_time[id_])
+                self._release(id_)
+            self.windows[self.engines.index(engine)].update(
+                self._outstanding_turns(engine), 1, response.get("rootInfo", {}).get("visits", 0)
+            )
+            chunks = self._take_chunks(engine)
+        self._write_chunks(engine, chunks)
+        if complete:
+            self._completed.put((id_, responses))
+
+    def _on_exit(self, engine: AnalysisEngine) -> None:
+        given_up: list[str] = []
+        chunks: list[dict] = []
+        with self._cond:
+            slot = self.engines.index(engine)
+            ids = list(engine.in_flight)
+            new_engine: Optional[AnalysisEngine] = None
+            if not self._closing and self._restarts[slot] < self.max_restarts:
+                self._restarts[slot] += 1
+                self.metrics.inc("engine_restarts")
+                print(
+                    f"Engine exited with {engine.proc.wait()}, restarting it ({len(ids)} queries in flight)",
+                    file=sys.stderr,
+                )
+                new_engine = self.engines[slot] = AnalysisEngine(engine.cmd, self._on_line, self._on_exit)
+            elif not self._closing:
+                print(f"Engine exited with {engine.proc.wait()} and is not restarted again", file=sys.stderr)
+            for id_ in ids:
+                if self._closing:
+                    break
+                self._retries[id_] = self._retries.get(id_, 0) + 1
+                if new_engine is None or self._retries[id_] > self.max_retries:
+                    print(f"Giving up {id_} after {self._retries[id_]} engine exits", file=sys.stderr)
+                    self._release(id_)
+                    given_up.append(id_)
+                    continue
+                received = set(response["turnNumber"] for response in self._responses[id_])
+                unanswered = [t for t in self._queries[id_]["analyzeTurns"] if t not in received]
+                self.metrics.inc("turns_resubmitted", len(unanswered) - len(self._unsent[id_]))
+                self._unsent[id_] = unanswered
+                new_engine.in_flight[id_] = engine.in_flight.pop(id_)
+                self._engine_of[id_] = new_engine
+            if new_engine is None:
+                self._num_running -= 1
+            else:
+                chunks = self._take_chunks(new_engine)
+            self._cond.notify_all()
+            num_running = self._num_running
+        if new_engine is not None:
+            self._write_chunks(new_engine, chunks)
+        for id_ in given_up:
+            self._completed.put((id_, None))
+        if num_running == 0:
+            self._completed.put(None)
+
+
+class ResultCache:
+    """On-disk index of complete per-game engine responses, keyed by the semantic content of the query.
+
+    An entry does not hold the responses but names the result log or store and the game id they were written
+    under, so the cache takes no space beyond the results themselves. A hit is only served while the journal of
+    that file still records the game with the same key, and reads back exactly the journaled turns; an entry whose
+    file was deleted or whose game was written again with other settings is a miss. Hits from a binary store come
+    back as decode_game returns them (quantized ownership, only the played move's policy value and rank).
+    """
+
+    def __init__(self, cache_dir: str, engine_cmds: list[list[str]]) -> None:
+        self.cache_dir = cache_dir
+        self.engine_fingerprint = engine_fingerprint(engine_cmds)
+        self._logs: dict[str, tuple[int, Union[ResultLog, ResultStore], dict[str, str], dict[str, list[int]]]] = dict()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, query_dict: dict) -> str:
+        return query_key(query_dict, self.engine_fingerprint)
+
+    def _path(self, key: str) -> str:
+        return f"{self.cache_dir}/{key[:2]}/{key}.json"
+
+    def _open(
+        self, result_filename: str, result_format: str, reload: bool
+    ) -> Optional[tuple[Union[ResultLog, ResultStore], dict[str, str], dict[str, list[int]]]]:
+        journal_path = f"{result_filename}.journal"
+        if not os.path.isfile(journal_path) or not os.path.isfile(result_filename):
+            return None
+        if result_format == "binary" and not os.path.isfile(f"{result_filename}.idx"):
+            return None
+        journal_size = os.path.getsize(journal_path)
+        if result_filename in self._logs:
+            size, result_log, completed, turns = self._logs[result_filename]
+            if not reload or size == journal_size:
+                return result_log, completed, turns
+            result_log.close()
+            del self._logs[result_filename]
+        completed, turns = read_journal(journal_path)
+        result_log: Union[ResultLog, ResultStore]
+        if result_format == "binary":
+            result_log = ResultStore(result_filename)
+        else:
+            result_log = ResultLog(result_filename)
+        self._logs[result_filename] = (journal_size, result_log, completed, turns)
+        return result_log, completed, turns
+
+    def load(self, key: str, id_: str) -> Optional[list[dict]]:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except ValueError:
+            return None
+        stored_id = entry["id"]
+        result_format = entry.get("format", "json")
+        stored = self._open(entry["result"], result_format, False)
+        if stored is not None and stored[1].get(stored_id) != key:
+            # the game may have been written after the file was opened (e.g. by this run), so look again
+            stored = self._open(entry["result"], result_format, True)
+        if stored is None:
+            return None
+        result_log, completed, turns = stored
+        if completed.get(stored_id) != key or stored_id not in result_log:
+            return None
+        try:
+            katago_results = result_log.load(stored_id, turns[stored_id])
+        except RECORD_ERRORS as e:
+            print(f"Unreadable cached result of {id_} in {entry['result']} ({e!r}), analyzing again", file=sys.stderr)
+            return None
+        if [d["turnNumber"] for d in katago_results] != turns[stored_id]:
+            return None
+        for line_dict in katago_results:
+            line_dict["id"] = id_
+        return katago_results
+
+    def store(self, key: str, result_filename: str, result_format: str, id_: str) -> None:
+        """Point the key at a game that has been written to result_filename (a log or a store) and journaled."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the cache directory may be shared by workers on several hosts, where pids alone can collide
+        tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"result": os.path.abspath(result_filename), "format": result_format, "id": id_}, f)
+        os.replace(tmp_path, path)
+
+    def close(self) -> None:
+        for _, result_log, _, _ in self._logs.values():
+            result_log.close()
+        self._logs.clear()
+
+
+class PositionCache:
+    """Persistent store of single-turn engine responses keyed by board position and shared across games.
+
+    Positions are Zobrist-hashed and canonicalised over the board symmetries, so a response stored from
+    one game is mapped back into the orientation of any other game reaching the same position. Move
+    history before the position is ignored, which KataGo does take into account, so cached values are
+    close to, but not bit-identical with, a fresh search.
+    """
+
+    def __init__(self, db_path: str, engine_cmds: list[list[str]], max_turns: int) -> None:
+        self.engine_fingerprint = engine_fingerprint(engine_cmds)
+        self.max_turns = max_turns
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS positions (params TEXT, position TEXT, response TEXT, PRIMARY KEY (params, position))"
+        )
+
+    def _params_key(self, query_dict: dict) -> str:
+        ignored = ("id", "initialStones", "moves", "analyzeTurns", "priority")
+        content = dict((k, v) for k, v in query_dict.items() if k not in ignored)
+        content["engine"] = self.engine_fingerprint
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _positions(self, query_dict: dict) -> list[tuple[int, int]]:
+        return position_hashes(
+            query_dict["boardXSize"],
+            query_dict["boardYSize"],
+            query_dict["initialStones"],
+            query_dict["moves"],
+            self.max_turns,
+        )
+
+    def lookup(self, query_dict: dict) -> dict[int, dict]:
+        """Return cached responses, in the game's orientation, for the turns of the query found in the store."""
+        params = self._params_key(query_dict)
+        analyze_turns = set(query_dict["analyzeTurns"])
+        bx, by = query_dict["boardXSize"], query_dict["boardYSize"]
+        found = dict()
+        for turn, (position, sym) in enumerate(self._positions(query_dict)):
+            if turn not in analyze_turns:
+                continue
+            row = self._conn.execute(
+                "SELECT response FROM positions WHERE params = ? AND position = ?", (params, f"{position:016x}")
+            ).fetchone()
+            if row is None:
+                continue
+            response = transform_response(json.loads(row[0]), inverse_symmetry(sym), bx, by)
+            response["id"] = query_dict["id"]
+            response["turnNumber"] = turn
+            found[turn] = response
+        return found
+
+    def store(self, query_dict: dict, katago_results: list[dict]) -> None:
+        params = self._params_key(query_dict)
+        bx, by = query_dict["boardXSize"], query_dict["boardYSize"]
+        responses = dict((d["turnNumber"], d) for d in katago_results)
+        rows = []
+        for turn, (position, sym) in enumerate(self._positions(query_dict)):
+            if turn in responses:
+                response = json.dumps(transform_response(responses[turn], sym, bx, by))
+                rows.append((params, f"{position:016x}", response))
+        self._conn.executemany("INSERT OR IGNORE INTO positions VALUES (?, ?, ?)", rows)
+        self._conn.commit()
+
+
+def encode_turns(turns: list[int]) -> str:
+    """Sorted turns as comma separated ranges, e.g. [0, 1, 2, 5] -> "0-2,5"."""
+    ranges: list[list[int]] = []
+    for turn in sorted(turns):
+        if ranges and turn == ranges[-1][1] + 1:
+            ranges[-1][1] = turn
+        else:
+            ranges.append([turn, turn])
+    return ",".join(f"{a}-{b}" if a != b else f"{a}" for a, b in ranges)
+
+
+def decode_turns(s: str) -> list[int]:
+    turns: list[int] = []
+    for item in s.split(","):
+        if item:
+            a, _, b = item.partition("-")
+            turns.extend(range(int(a), int(b or a) + 1))
+    return turns
+
+
+def read_journal(path: str) -> tuple[dict[str, str], dict[str, list[int]]]:
+    """Query key and turns of each game a journal (see GameJournal) records as complete."""
+    completed: dict[str, str] = dict()
+    turns: dict[str, list[int]] = dict()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if line.endswith("\n") and len(fields) == 3:
+                completed[fields[0]] = fields[1]
+                turns[fields[0]] = decode_turns(fields[2])
+    return completed, turns
+
+
+class GameJournal:
+    """Append-only record of the games whose responses are complete in a result log or store.
+
+    A game's "id<TAB>query key<TAB>turns" line is appended with a single write and fsynced after its responses
+    have been flushed, so however a run ends, the journal only names games that can be read back in full. The
+    turns (e.g. "0-49,55") are those written for the game, so a resume reads back exactly these even if the log
+    also holds other turns of the game from earlier runs. A torn last line and lines of older journals without
+    turns are ignored.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.completed: dict[str, str] = dict()
+        self.turns: dict[str, list[int]] = dict()
+        if os.path.isfile(path):
+            self.completed, self.turns = read_journal(path)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    os.write(self._fd, b"\n")
+
+    def record(self, id_: str, key: str, turns: list[int]) -> None:
+        os.write(self._fd, f"{id_}\t{key}\t{encode_turns(turns)}\n".encode("utf-8"))
+        os.fsync(self._fd)
+        self.completed[id_] = key
+        self.turns[id_] = sorted(turns)
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def transform_response(response: dict, sym: int, board_x_size: int, board_y_size: int) -> dict:
+    """Apply a board symmetry to the moves, PVs and per-point arrays of an engine response."""
+
+    def transform_points(values: list) -> list:
+        transformed = list(values)
+        for p in range(board_x_size * board_y_size):
+            transformed[transform_point(p, sym, board_x_size, board_y_size)] = values[p]
+        return transformed
+
+    response = copy.deepcopy(response)
+    for move_info in response.get("moveInfos", []):
+        move_info["move"] = transform_gtp(move_info["move"], sym, board_x_size, board_y_size)
+        if "isSymmetryOf" in move_info:
+            move_info["isSymmetryOf"] = transform_gtp(move_info["isSymmetryOf"], sym, board_x_size, board_y_size)
+        if "pv" in move_info:
+            move_info["pv"] = [transform_gtp(m, sym, board_x_size, board_y_size) for m in move_info["pv"]]
+        if "ownership" in move_info:
+            move_info["ownership"] = transform_points(move_info["ownership"])
+    for key in ("ownership", "policy"):
+        if key in response:
+            response[key] = transform_points(response[key])
+    return response
+
+
+def query_key(query_dict: dict, fingerprint: str) -> str:
+    """Hash of what determines a query's responses: its content except id and priority, and the engine setup."""
+    # The priority only changes when a query is searched, not its result
+    content = dict((k, v) for k, v in query_dict.items() if k not in ("id", "priority"))
+    content["engine"] = fingerprint
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def engine_fingerprint(cmds: list[list[str]]) -> str:
+    """Identify the engine setup: the command lines plus the contents (or size and mtime for large files) of files they name."""
+    h = hashlib.sha256()
+    for cmd in sorted(cmds):
+        h.update(" ".join(cmd).encode("utf-8"))
+        for arg in cmd:
+            if not os.path.isfile(arg):
+                continue
+            st = os.stat(arg)
+            if st.st_size <= 1 << 20:
+                with open(arg, "rb") as f:
+                    h.update(f.read())
             else:
-                print("proc.stdin is None")
+                h.update(f"{st.st_size}:{st.st_mtime_ns}".encode("utf-8"))
+    return h.hexdigest()
 
-        t = threading.Thread(target=write_query_target)
-        t.start()
-        t.join()
+
+def read_engine_config(cmd: list[str]) -> dict[str, str]:
+    """Read the key = value pairs of the config file passed to an engine command with -config."""
+    config: dict[str, str] = dict()
+    for flag, value in zip(cmd, cmd[1:]):
+        if flag != "-config" or not os.path.isfile(value):
+            continue
+        with open(value, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if "=" in line:
+                    k, v = line.split("=", 1)
+                    config[k.strip()] = v.strip()
+    return config
 
 
 def moves_equal(a: str, b: str) -> bool:
@@ -160,108 +716,843 @@ def format_value(v: float) -> str:
     return f"{v:.3f}"
 
 
-def add_result_to_csv(katago_result_file: str, game_data: GameData, csv_file: str, verbose: bool = False) -> None:
-    with open(katago_result_file, "r") as f:
-        katago_results = sorted(
-            map(lambda x: json.loads(x), f.read().strip().split("\n")), key=lambda d: d["turnNumber"]
-        )
-    assert len(katago_results) == len(game_data.moves) + 1
-
-    winrate_thresholds = (1.0, 0.9, 0.95, 0.98)
-    features = {"match": [], "match_visits": [], "winrate_diff": [], "score_diff": [], "blunder": []}
-    d_player = dict((round(w, 2), copy.deepcopy(features)) for w in winrate_thresholds)
-    analysis_results_dict = {"B": d_player, "W": copy.deepcopy(d_player)}
-    for current_pos, next_pos, move in zip(katago_results, katago_results[1:], game_data.moves):
-        assert current_pos["rootInfo"]["currentPlayer"] == move[0]
-        assert current_pos["moveInfos"][0]["order"] == 0
-        best_move = current_pos["moveInfos"][0]["move"]
-        match = moves_equal(move[1], best_move)
+WINRATE_THRESHOLDS = (1.0, 0.9, 0.95, 0.98)
+
+
+def load_turn_arrays(
+    katago_results: list[dict], game_data: GameData, scored_moves: Optional[Sequence[int]] = None
+) -> dict[str, np.ndarray]:
+    """Per-move arrays of everything the metrics need, read from the responses once.
+
+    There is one entry per scored move: a move whose positions before and after were both analyzed, which is
+    every move when all turns were analyzed, limited to scored_moves (0-based) if given. "move_index" holds the
+    0-based index of each scored move.
+    """
+    responses = dict((d["turnNumber"], d) for d in katago_results)
+    assert all(0 <= turn <= len(game_data.moves) for turn in responses)
+    candidates = range(len(game_data.moves)) if scored_moves is None else sorted(scored_moves)
+    scored_moves = [i for i in candidates if i in responses and i + 1 in responses]
+
+    num_moves = len(scored_moves)
+    is_black = np.zeros(num_moves, dtype=bool)
+    match = np.zeros(num_moves, dtype=bool)
+    columns = ("winrate", "next_winrate", "score_lead", "next_score_lead", "score_stdev", "visits", "match_visits",
+               "played_order", "policy_rank")
+    arrays = dict((name, np.full(num_moves, np.nan)) for name in columns)
+    for i, move_index in enumerate(scored_moves):
+        current_pos, next_pos, move = responses[move_index], responses[move_index + 1], game_data.moves[move_index]
+        root_info = current_pos["rootInfo"]
+        move_infos = current_pos["moveInfos"]
+        assert root_info["currentPlayer"] == move[0]
+        assert move_infos[0]["order"] == 0
+        assert root_info["currentPlayer"] != next_pos["rootInfo"]["currentPlayer"]
+        best_move = move_infos[0]["move"]
+        is_black[i] = move[0] == "B"
+        match[i] = moves_equal(move[1], best_move)
         match_visits = 0
-        for move_info in current_pos["moveInfos"]:
+        played_prior = None
+        for move_info in move_infos:
             if moves_equal(move[1], move_info["move"]):
                 if "isSymmetryOf" in move_info:
                     if move_info["isSymmetryOf"] == best_move:
-                        match = True
+                        match[i] = True
                 match_visits = move_info["visits"]
-        assert current_pos["rootInfo"]["currentPlayer"] != next_pos["rootInfo"]["currentPlayer"]
-        winrate_diff = (1 - next_pos["rootInfo"]["winrate"] - current_pos["rootInfo"]["winrate"]) * 100
-        score_diff = -next_pos["rootInfo"]["scoreLead"] - current_pos["rootInfo"]["scoreLead"]
-        score_stdev = max(current_pos["rootInfo"]["scoreStdev"], 0.001)
-        blunder = max(-winrate_diff / score_stdev, 0) * 100
+                played_prior = move_info["prior"]
+                arrays["played_order"][i] = move_info["order"]
+        arrays["winrate"][i] = root_info["winrate"]
+        arrays["next_winrate"][i] = next_pos["rootInfo"]["winrate"]
+        arrays["score_lead"][i] = root_info["scoreLead"]
+        arrays["next_score_lead"][i] = next_pos["rootInfo"]["scoreLead"]
+        arrays["score_stdev"][i] = root_info["scoreStdev"]
+        arrays["visits"][i] = root_info["visits"]
+        arrays["match_visits"][i] = match_visits
+        if "policy" in current_pos:
+            # Full policy (includePolicy): row-major points followed by pass, -1 for illegal moves
+            point = gtp_to_point(move[1], game_data.board_x_size, game_data.board_y_size)
+            policy = current_pos["policy"]
+            played = policy[game_data.board_x_size * game_data.board_y_size if point is None else point]
+            arrays["policy_rank"][i] = 1 + sum(p > played for p in policy)
+        elif "playedPolicyRank" in current_pos:
+            # What the binary result store keeps of a full policy
+            arrays["policy_rank"][i] = current_pos["playedPolicyRank"]
+        elif played_prior is not None:
+            arrays["policy_rank"][i] = 1 + sum(m["prior"] > played_prior for m in move_infos)
 
-        if verbose:
-            print(current_pos)
-            print(match, match_visits, winrate_diff, score_diff, blunder)
+    arrays["is_black"] = is_black
+    arrays["match"] = match
+    arrays["move_index"] = np.asarray(scored_moves, dtype=np.int64)
+    return arrays
 
-        for threshold in winrate_thresholds:
-            w = current_pos["rootInfo"]["winrate"]
-            if max(w, 1 - w) <= threshold:
-                analysis_results_dict[move[0]][round(threshold, 2)]["match"].append(match)
-                analysis_results_dict[move[0]][round(threshold, 2)]["match_visits"].append(
-                    match_visits / current_pos["rootInfo"]["visits"]
-                )
-                analysis_results_dict[move[0]][round(threshold, 2)]["winrate_diff"].append(winrate_diff)
-                analysis_results_dict[move[0]][round(threshold, 2)]["score_diff"].append(score_diff)
-                analysis_results_dict[move[0]][round(threshold, 2)]["blunder"].append(blunder)
+
+def winrate_diff(t: dict[str, np.ndarray]) -> np.ndarray:
+    return (1 - t["next_winrate"] - t["winrate"]) * 100
+
+
+def top_k_match(k: int) -> Callable[[dict[str, np.ndarray]], np.ndarray]:
+    def metric(t: dict[str, np.ndarray]) -> np.ndarray:
+        return ((t["played_order"] < k) | t["match"]).astype(float)
+
+    return metric
+
+
+# name -> (per-move values, factor applied to their mean). NaN values (e.g. no policy rank for a played move
+# outside moveInfos) are left out of the mean. register_metric makes more metrics available to --metrics.
+METRICS: dict[str, tuple[Callable[[dict[str, np.ndarray]], np.ndarray], float]] = {
+    "match_rate": (lambda t: t["match"].astype(float), 100.0),
+    "match_visits": (lambda t: t["match_visits"] / t["visits"], 1.0),
+    "winrate_diff": (winrate_diff, 1.0),
+    "score_diff": (lambda t: -t["next_score_lead"] - t["score_lead"], 1.0),
+    "blunder": (lambda t: np.maximum(-winrate_diff(t) / np.maximum(t["score_stdev"], 0.001), 0) * 100, 1.0),
+    "top3_match": (top_k_match(3), 100.0),
+    "top5_match": (top_k_match(5), 100.0),
+    "policy_rank": (lambda t: t["policy_rank"], 1.0),
+}
+DEFAULT_METRICS = ("match_rate", "match_visits", "winrate_diff", "score_diff", "blunder")
+
+
+def register_metric(name: str, metric: Callable[[dict[str, np.ndarray]], np.ndarray], factor: float = 1.0) -> None:
+    METRICS[name] = (metric, factor)
+
+
+def compute_game_stats(
+    katago_results: list[dict],
+    game_data: GameData,
+    verbose: bool = False,
+    thresholds: Sequence[float] = WINRATE_THRESHOLDS,
+    metrics: Sequence[str] = DEFAULT_METRICS,
+    scored_moves: Optional[Sequence[int]] = None,
+) -> dict[str, dict]:
+    """Per color, the player's name and for each winrate threshold the move count n, the number of moves that
+    matched the engine's best move and the mean of each metric over the moves played at or below the threshold.
+    Only scored_moves (0-based) are counted if given; see load_turn_arrays."""
+    t = load_turn_arrays(katago_results, game_data, scored_moves)
+    values = np.stack([METRICS[m][0](t) for m in metrics]) if metrics else np.zeros((0, len(t["match"])))
+    is_nan = np.isnan(values)
+    in_threshold = np.maximum(t["winrate"], 1 - t["winrate"])[None, :] <= np.asarray(thresholds, dtype=float)[:, None]
 
     if verbose:
-        print(analysis_results_dict)
+        print(dict(zip(metrics, values)))
+
+    game_stats: dict[str, dict] = dict()
+    for c, is_color in (("B", t["is_black"]), ("W", ~t["is_black"])):
+        mask = in_threshold & is_color[None, :]
+        n = mask.sum(axis=1)
+        matches = (mask & t["match"][None, :]).sum(axis=1)
+        # (threshold, metric, move); summed in move order (cumsum) so means are bit-identical to summing lists
+        valid = mask[:, None, :] & ~is_nan[None, :, :]
+        sums = np.where(valid, values[None, :, :], 0.0).cumsum(axis=2)[:, :, -1] if len(t["match"]) else valid.sum(axis=2)
+        counts = valid.sum(axis=2)
+        per_threshold = []
+        for i, threshold in enumerate(thresholds):
+            stats: dict = {"threshold": threshold, "n": int(n[i])}
+            if n[i] > 0:
+                stats["match"] = int(matches[i])
+                for j, m in enumerate(metrics):
+                    stats[m] = float(sums[i, j] / counts[i, j] * METRICS[m][1]) if counts[i, j] > 0 else None
+            per_threshold.append(stats)
+        game_stats[c] = {"name": game_data.player_black if c == "B" else game_data.player_white, "stats": per_threshold}
+    return game_stats
+
+
+def csv_header(thresholds: Sequence[float], metrics: Sequence[str]) -> str:
+    labels = ["match"] + list(metrics)
+    return (
+        "color,name,"
+        + ",".join([f"<={w:.0%}" for w in thresholds for _ in labels])
+        + "\ncolor,name,"
+        + ",".join([lbl for _ in thresholds for lbl in labels])
+        + "\n"
+    )
+
 
+def write_game_stats_csv(game_stats: dict[str, dict], csv_file: str, metrics: Sequence[str] = DEFAULT_METRICS) -> None:
+    """Append the two rows (black, white) of a game to the result CSV, writing the header first for a new file."""
+    thresholds = [stats["threshold"] for stats in game_stats["B"]["stats"]]
+    header = csv_header(thresholds, metrics)
     if not os.path.isfile(csv_file):
         with open(csv_file, "w", encoding="utf-8") as f:
-            f.write("color,name,")
-            f.write(",".join([f"<={w:.0%}" for w in winrate_thresholds for _ in range(len(features) + 1)]))
-            f.write("\ncolor,name,")
-            labels = ["match", "match_rate", "match_visits", "winrate_diff", "score_diff", "blunder"]
-            f.write(",".join([lbl for _ in winrate_thresholds for lbl in labels]))
-            f.write("\n")
+            f.write(header)
+    else:
+        with open(csv_file, "r", encoding="utf-8") as f:
+            existing_header = f.readline() + f.readline()
+        if existing_header != header:
+            raise RuntimeError(f"{csv_file} was written with different winrate thresholds or metrics")
 
     with open(csv_file, "a", encoding="utf-8") as f:
-        for c in "BW":
-            line_data = [c]
-            line_data.append(game_data.player_black if c == "B" else game_data.player_white)
-            for threshold in winrate_thresholds:
-                d = analysis_results_dict[c][round(threshold, 2)]
-                assert len(d["match"]) == len(d["match_visits"]) == len(d["winrate_diff"]) == len(d["score_diff"]) == len(d["blunder"])
-                n = len(d["match"])
-                if n == 0:
-                    line_data += ["-"] * 6
-                else:
-                    line_data.append(f'{sum(d["match"])}/{n}')
-                    line_data.append(format_value(sum(d["match"]) / n * 100))
-                    line_data.append(format_value(sum(d["match_visits"]) / n))
-                    line_data.append(format_value(sum(d["winrate_diff"]) / n))
-                    line_data.append(format_value(sum(d["score_diff"]) / n))
-                    line_data.append(format_value(sum(d["blunder"]) / n))
-
-            f.write(",".join(line_data))
+        for line in game_stats_rows(game_stats, metrics):
+            f.write(line)
             f.write("\n")
 
 
-if __name__ == "__main__":
+def game_stats_rows(game_stats: dict[str, dict], metrics: Sequence[str] = DEFAULT_METRICS) -> list[str]:
+    """The result CSV rows (black, white) of a game, without line ends."""
+    rows = []
+    for c in "BW":
+        line_data = [c, game_stats[c]["name"]]
+        for stats in game_stats[c]["stats"]:
+            n = stats["n"]
+            if n == 0:
+                line_data += ["-"] * (len(metrics) + 1)
+            else:
+                line_data.append(f'{stats["match"]}/{n}')
+                line_data += ["-" if stats[m] is None else format_value(stats[m]) for m in metrics]
+        rows.append(",".join(line_data))
+    return rows
+
+
+def add_result_to_csv(
+    katago_results: list[dict],
+    game_data: GameData,
+    csv_file: str,
+    verbose: bool = False,
+    thresholds: Sequence[float] = WINRATE_THRESHOLDS,
+    metrics: Sequence[str] = DEFAULT_METRICS,
+    scored_moves: Optional[Sequence[int]] = None,
+) -> None:
+    write_game_stats_csv(
+        compute_game_stats(katago_results, game_data, verbose, thresholds, metrics, scored_moves), csv_file, metrics
+    )
+
+
+class SweepSettings:
+    def __init__(self, sweep_visits: int, near_tie: float, critical_winrate_diff: float, critical_blunder: float) -> None:
+        assert sweep_visits >= 1
+        self.sweep_visits = sweep_visits
+        self.near_tie = near_tie
+        self.critical_winrate_diff = critical_winrate_diff
+        self.critical_blunder = critical_blunder
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+def select_critical_turns(katago_results: list[dict], moves: list[list[str]], sweep: SweepSettings) -> list[int]:
+    """Turns of a cheap sweep whose statistics could change with a deeper search, together with the turns after them.
+
+    A turn is critical when the played move and the best move (or, if they are the same, the runner-up) are
+    within near_tie winrate, or when the move loses a lot of winrate or looks like a blunder.
+    """
+    responses = dict((d["turnNumber"], d) for d in katago_results)
+    critical: set[int] = set()
+    for turn, move in enumerate(moves):
+        if turn not in responses or turn + 1 not in responses:
+            continue
+        current_pos, next_pos = responses[turn], responses[turn + 1]
+        move_infos = current_pos["moveInfos"]
+        best_winrate = move_infos[0]["winrate"]
+        if moves_equal(move[1], move_infos[0]["move"]):
+            close = len(move_infos) > 1 and best_winrate - move_infos[1]["winrate"] < sweep.near_tie
+        else:
+            close = any(
+                moves_equal(move[1], m["move"]) and best_winrate - m["winrate"] < sweep.near_tie for m in move_infos
+            )
+        winrate_diff = (1 - next_pos["rootInfo"]["winrate"] - current_pos["rootInfo"]["winrate"]) * 100
+        score_stdev = max(current_pos["rootInfo"]["scoreStdev"], 0.001)
+        blunder = max(-winrate_diff / score_stdev, 0) * 100
+        if close or abs(winrate_diff) >= sweep.critical_winrate_diff or blunder >= sweep.critical_blunder:
+            critical.update((turn, turn + 1))
+    return sorted(critical)
+
+
+class TurnSelection:
+    """Which moves of a game are scored; a scored move i needs the responses of turns i and i + 1.
+
+    turn_range limits the scored moves to move numbers first..last (1-based, inclusive) and turn_step scores
+    every k-th of them. k must be odd, since with an even k all scored moves are the same player's. The moves in
+    between are not scored, so the statistics must be computed with the scored_moves of the same selection. With
+    decided_winrate a cheap probe at probe_visits is run over the selected turns first, and no move is scored from
+    the point where max(winrate, 1 - winrate) >= decided_winrate for decided_turns consecutive probed turns.
+    """
+
+    def __init__(
+        self,
+        turn_range: Optional[tuple[int, int]] = None,
+        turn_step: int = 1,
+        decided_winrate: Optional[float] = None,
+        decided_turns: int = 10,
+        probe_visits: int = 16,
+    ) -> None:
+        assert turn_step >= 1 and turn_step % 2 == 1 and decided_turns >= 1 and probe_visits >= 1
+        self.turn_range = turn_range
+        self.turn_step = turn_step
+        self.decided_winrate = decided_winrate
+        self.decided_turns = decided_turns
+        self.probe_visits = probe_visits
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    def scored_moves(self, num_moves: int) -> list[int]:
+        first, last = self.turn_range if self.turn_range is not None else (1, num_moves)
+        return list(range(max(first, 1) - 1, min(last, num_moves), self.turn_step))
+
+    def analyze_turns(self, num_moves: int) -> list[int]:
+        return turns_of_moves(self.scored_moves(num_moves))
+
+    def decided_turn(self, katago_results: list[dict]) -> Optional[int]:
+        """First turn of the first run of decided_turns consecutive probed turns beyond decided_winrate."""
+        assert self.decided_winrate is not None
+        run_start = None
+        run_length = 0
+        for line_dict in sorted(katago_results, key=lambda d: d["turnNumber"]):
+            w = line_dict["rootInfo"]["winrate"]
+            if max(w, 1 - w) < self.decided_winrate:
+                run_length = 0
+                continue
+            if run_length == 0:
+                run_start = line_dict["turnNumber"]
+            run_length += 1
+            if run_length >= self.decided_turns:
+                return run_start
+        return None
+
+
+def turns_of_moves(moves: list[int]) -> list[int]:
+    return sorted(set(moves) | set(i + 1 for i in moves))
+
+
+DEEP_ID_SUFFIX = ":deep"
+PROBE_ID_SUFFIX = ":probe"
+
+# KataGo searches queued queries with a higher "priority" first. A user priority outranks any cost. User priorities
+# stay below MAX_USER_PRIORITY in absolute value so that KataGo priorities fit in 32-bit integers.
+PRIORITY_STEP = 1000000
+MAX_USER_PRIORITY = 2000
+
+
+def query_cost(query_dict: dict) -> int:
+    """Estimated search cost of a query: analyzed turns x visits (1 visit when maxVisits comes from the config)."""
+    return len(query_dict["analyzeTurns"]) * query_dict.get("maxVisits", 1)
+
+
+def query_priority(query_dict: dict, user_priority: int) -> int:
+    """KataGo priority of a query for longest-processing-time-first scheduling within each user priority."""
+    assert abs(user_priority) < MAX_USER_PRIORITY
+    return user_priority * PRIORITY_STEP + min(query_cost(query_dict) // 100, PRIORITY_STEP - 1)
+
+
+def game_id(query_id: str) -> str:
+    for suffix in (DEEP_ID_SUFFIX, PROBE_ID_SUFFIX):
+        if query_id.endswith(suffix):
+            return query_id[: -len(suffix)]
+    return query_id
+
+
+class GameQueries(Mapping[str, dict]):
+    """The analysis query dicts of a set of games, each built from its GameData only when it is accessed.
+
+    With a corpus (see corpus.CorpusGames) a game is then decoded just as the driver takes it up, instead of all
+    games being decoded and kept as queries before the first one is submitted.
+    """
+
+    def __init__(
+        self, game_data_dict: Mapping[str, GameData], max_visits: Optional[int] = None, ownership: Optional[bool] = None
+    ) -> None:
+        self.game_data_dict = game_data_dict
+        self.max_visits = max_visits
+        self.ownership = ownership
+
+    def __len__(self) -> int:
+        return len(self.game_data_dict)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.game_data_dict)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.game_data_dict
+
+    def __getitem__(self, name: str) -> dict:
+        return self.game_data_dict[name].to_query_dict(name, self.max_visits, self.ownership)
+
+
+class AnalysisDriver:
+    """Runs the queries of a set of games through the caches and an engine pool.
+
+    on_game_complete(id, responses) is called once per game, from the calling thread, as soon as all of its
+    turns are available and have been appended to result_filename, an indexed JSON result log (result_index.py)
+    or with result_format "binary" a compact result store (result_store.py). With sweep settings every game is
+    first analyzed at sweep_visits, and only the critical turns are analyzed again with the game's own maxVisits
+    and merged over the sweep. A turn selection narrows the analyzed turns of every game, possibly after a probe.
+
+    With schedule "lpt" games are submitted in order of user priority (higher first, default 0) and then
+    estimated cost (longest first), and every query carries a matching KataGo priority, so long games do not
+    end up alone at the tail of a run and urgent games overtake queued ones. Schedule "input" submits games in
+    the given order and only sets KataGo priorities for games with a user priority.
+
+    Completed games are recorded in <result_filename>.journal. With resume, a game the journal records with the
+    same query key is read back from result_filename instead of being analyzed again, so a run that was
+    killed can simply be started again. A game the engine pool gives up on (see EnginePool) is listed in
+    failed_games and not output.
+    """
+
+    def __init__(
+        self,
+        engine_cmds: list[list[str]],
+        result_filename: str,
+        max_in_flight: int,
+        on_game_complete: Callable[[str, list[dict]], None],
+        cache: Optional[ResultCache] = None,
+        position_cache: Optional[PositionCache] = None,
+        sweep: Optional[SweepSettings] = None,
+        metrics: Optional[Metrics] = None,
+        verbose: bool = False,
+        result_format: str = "json",
+        ownership_dtype: str = "float16",
+        turn_selection: Optional[TurnSelection] = None,
+        schedule: str = "lpt",
+        priorities: Optional[dict[str, int]] = None,
+        resume: bool = True,
+        max_restarts: int = 5,
+        max_retries: int = 2,
+        turn_window: Optional[int] = None,
+    ) -> None:
+        self.engine_cmds = engine_cmds
+        self.result_filename = result_filename
+        self.result_format = result_format
+        self.ownership_dtype = ownership_dtype
+        self.turn_selection = turn_selection
+        self.schedule = schedule
+        self.priorities = priorities if priorities is not None else dict()
+        self.resume = resume
+        self.max_restarts = max_restarts
+        self.max_retries = max_retries
+        self.turn_window = turn_window
+        self.max_in_flight = max_in_flight
+        self.on_game_complete = on_game_complete
+        self.cache = cache
+        self.position_cache = position_cache
+        self.sweep = sweep
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.verbose = verbose
+        self.pool: Optional[EnginePool] = None
+        self.failed_games: list[str] = []
+        self._result_log: Optional[Union[ResultLogWriter, ResultStoreWriter]] = None
+        self._journal: Optional[GameJournal] = None
+        self._stored_results: Optional[Union[ResultLog, ResultStore]] = None
+        self._moves: dict[str, list[list[str]]] = dict()
+        self._games: dict[str, dict] = dict()
+        self._keys: dict[str, str] = dict()
+        self._queries: dict[str, dict] = dict()
+        self._cached_turns: dict[str, list[dict]] = dict()
+        self._sweep_results: dict[str, list[dict]] = dict()
+        self._game_start: dict[str, float] = dict()
+
+    def run(self, query_dict_dict: Mapping[str, dict]) -> None:
+        self._journal = GameJournal(f"{self.result_filename}.journal")
+        if self.resume and self._journal.completed:
+            if self.result_format == "binary" and os.path.isfile(f"{self.result_filename}.idx"):
+                self._stored_results = ResultStore(self.result_filename)
+            elif self.result_format == "json" and os.path.isfile(self.result_filename):
+                self._stored_results = ResultLog(self.result_filename)
+        if self.result_format == "binary":
+            self._result_log = ResultStoreWriter(self.result_filename, self.ownership_dtype)
+        else:
+            self._result_log = ResultLogWriter(self.result_filename)
+        try:
+            self._run(query_dict_dict)
+        finally:
+            self._result_log.close()
+            self._journal.close()
+            if self._stored_results is not None:
+                self._stored_results.close()
+            if self.cache is not None:
+                self.cache.close()
+        if self.failed_games:
+            print(f"{len(self.failed_games)} games failed: {' '.join(self.failed_games)}", file=sys.stderr)
+
+    def _run(self, query_dict_dict: Mapping[str, dict]) -> None:
+        assert self._journal is not None
+        num_cached_games = 0
+        num_resumed_games = 0
+        first_queries: list[dict] = []
+        fingerprint = self.cache.engine_fingerprint if self.cache is not None else engine_fingerprint(self.engine_cmds)
+        for id_, query_dict in query_dict_dict.items():
+            if self.turn_selection is not None:
+                query_dict = dict(query_dict, analyzeTurns=self.turn_selection.analyze_turns(len(query_dict["moves"])))
+            key_content = dict(query_dict)
+            if self.sweep is not None:
+                key_content["sweep"] = self.sweep.to_dict()
+            if self.turn_selection is not None:
+                key_content["turn_selection"] = self.turn_selection.to_dict()
+            self._keys[id_] = query_key(key_content, fingerprint)
+            stored_results = self._load_journaled(id_)
+            if stored_results is not None:
+                with self.metrics.timer("game_output"):
+                    self.on_game_complete(id_, stored_results)
+                num_resumed_games += 1
+                self.metrics.inc("games_resumed")
+                continue
+            if self.cache is not None:
+                cached_results = self.cache.load(self._keys[id_], id_)
+                if cached_results is not None:
+                    if self._journal.completed.get(id_) == self._keys[id_]:
+                        # already in the result log (e.g. with --no_resume); appending it again would only grow the log
+                        with self.metrics.timer("game_output"):
+                            self.on_game_complete(id_, cached_results)
+                    else:
+                        self._moves[id_] = query_dict["moves"]
+                        self._output_game(id_, cached_results)
+                    num_cached_games += 1
+                    self.metrics.inc("games_cached")
+                    continue
+            self._games[id_] = query_dict
+            self._moves[id_] = query_dict["moves"]
+            if self.turn_selection is not None and self.turn_selection.decided_winrate is not None:
+                probe_query_dict = dict(
+                    query_dict, id=f"{id_}{PROBE_ID_SUFFIX}", maxVisits=self.turn_selection.probe_visits
+                )
+                first_query_dict = self._prepare_or_finish(probe_query_dict)
+            else:
+                first_query_dict = self._first_query(id_)
+            if first_query_dict is not None:
+                first_queries.append(first_query_dict)
+
+        if self.schedule == "lpt":
+            first_queries.sort(key=lambda q: (-self.priorities.get(game_id(q["id"]), 0), -query_cost(q)))
+
+        num_cached_turns = sum(len(v) for v in self._cached_turns.values())
+        self.metrics.inc("turns_from_position_cache", num_cached_turns)
+        print(
+            f"{num_resumed_games} resumed, {num_cached_games} cached, {len(first_queries)} to analyze"
+            f" ({num_cached_turns} turns from position cache)"
+        )
+        if not self._games:
+            self._close()
+            return
+
+        writer_errors: list[Exception] = []
+
+        def write_queries() -> None:
+            try:
+                for query_dict in first_queries:
+                    self._submit(query_dict)
+            except Exception as e:
+                writer_errors.append(e)
+                self._close()
+
+        pool = self._start_pool()
+        writer = threading.Thread(target=write_queries, daemon=True)
+        writer.start()
+        for id_, katago_results in pool.completed_games():
+            if katago_results is None:
+                self._fail_query(id_)
+            else:
+                self._finish_query(id_, katago_results)
+            if not self._games:
+                self._close()
+        writer.join()
+        if writer_errors:
+            raise writer_errors[0]
+        pool.wait()
+        for line in pool.window_summary():
+            print(line)
+
+    def _load_journaled(self, id_: str) -> Optional[list[dict]]:
+        """The stored responses of a game the journal records with its current query key, if all are readable."""
+        assert self._journal is not None
+        if (
+            self._stored_results is None
+            or self._journal.completed.get(id_) != self._keys[id_]
+            or id_ not in self._stored_results
+        ):
+            return None
+        turns = self._journal.turns[id_]
+        try:
+            stored_results = self._stored_results.load(id_, turns)
+        except RECORD_ERRORS as e:
+            print(f"Unreadable stored result of {id_} ({e!r}), analyzing again", file=sys.stderr)
+            return None
+        if [d["turnNumber"] for d in stored_results] != turns:
+            return None
+        return stored_results
+
+    def _start_pool(self) -> EnginePool:
+        if self.pool is None:
+            self.pool = EnginePool(
+                self.engine_cmds,
+                self.max_in_flight,
+                self.metrics,
+                self.max_restarts,
+                self.max_retries,
+                self.turn_window,
+            )
+        return self.pool
+
+    def _close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+
+    def _submit(self, query_dict: dict) -> None:
+        id_ = game_id(query_dict["id"])
+        if self.schedule == "lpt" or id_ in self.priorities:
+            # A copy, so the query kept for the position cache stays as prepared
+            query_dict = dict(query_dict, priority=query_priority(query_dict, self.priorities.get(id_, 0)))
+        if self.verbose:
+            print(json.dumps(query_dict))
+        self._game_start.setdefault(id_, time.perf_counter())
+        self._start_pool().submit(query_dict)
+
+    def _first_query(self, id_: str) -> Optional[dict]:
+        """The first engine query of a game once any probe is done (the sweep, or the full-visit query)."""
+        query_dict = dict(self._games[id_])
+        if self.sweep is not None:
+            query_dict["maxVisits"] = self.sweep.sweep_visits
+        return self._prepare_or_finish(query_dict)
+
+    def _prepare_or_finish(self, query_dict: dict) -> Optional[dict]:
+        """The query to submit, or None if all of its turns were cached (it is then finished right away)."""
+        prepared = self._prepare(query_dict)
+        if prepared is None:
+            self._finish_query(query_dict["id"], [])
+        return prepared
+
+    def _prepare(self, query_dict: dict) -> Optional[dict]:
+        """Take the turns found in the position cache out of a query. Returns None if nothing is left to analyze."""
+        self._queries[query_dict["id"]] = query_dict
+        if not query_dict["analyzeTurns"]:
+            return None
+        if self.position_cache is None:
+            return query_dict
+        cached_turns = self.position_cache.lookup(query_dict)
+        if not cached_turns:
+            return query_dict
+        self._cached_turns[query_dict["id"]] = list(cached_turns.values())
+        query_dict["analyzeTurns"] = [t for t in query_dict["analyzeTurns"] if t not in cached_turns]
+        if not query_dict["analyzeTurns"]:
+            return None
+        return query_dict
+
+    def _finish_query(self, query_id: str, katago_results: list[dict]) -> None:
+        query_dict = self._queries.pop(query_id)
+        if self.position_cache is not None:
+            self.position_cache.store(query_dict, katago_results)
+            katago_results = katago_results + self._cached_turns.pop(query_id, [])
+
+        if query_id.endswith(PROBE_ID_SUFFIX):
+            assert self.turn_selection is not None
+            id_ = game_id(query_id)
+            decided_turn = self.turn_selection.decided_turn(katago_results)
+            if decided_turn is not None:
+                game_query_dict = self._games[id_]
+                scored_moves = self.turn_selection.scored_moves(len(game_query_dict["moves"]))
+                scored_moves = [i for i in scored_moves if i < decided_turn]
+                self._games[id_] = dict(game_query_dict, analyzeTurns=turns_of_moves(scored_moves))
+            first_query_dict = self._first_query(id_)
+            if first_query_dict is not None:
+                self._submit(first_query_dict)
+        elif self.sweep is None:
+            self._finish_game(query_id, katago_results)
+        elif query_id.endswith(DEEP_ID_SUFFIX):
+            id_ = query_id[: -len(DEEP_ID_SUFFIX)]
+            merged = dict((d["turnNumber"], d) for d in self._sweep_results.pop(id_))
+            for line_dict in katago_results:
+                line_dict["id"] = id_
+                merged[line_dict["turnNumber"]] = line_dict
+            self._finish_game(id_, list(merged.values()))
+        else:
+            game_query_dict = self._games[query_id]
+            critical_turns = select_critical_turns(katago_results, game_query_dict["moves"], self.sweep)
+            if not critical_turns:
+                self._finish_game(query_id, katago_results)
+                return
+            self._sweep_results[query_id] = katago_results
+            deep_query_dict = dict(game_query_dict, id=f"{query_id}{DEEP_ID_SUFFIX}", analyzeTurns=critical_turns)
+            deep_query_dict = self._prepare_or_finish(deep_query_dict)
+            if deep_query_dict is not None:
+                self._submit(deep_query_dict)
+
+    def _fail_query(self, query_id: str) -> None:
+        """Drop the game of a query the engine pool gave up on."""
+        self._queries.pop(query_id, None)
+        self._cached_turns.pop(query_id, None)
+        id_ = game_id(query_id)
+        del self._games[id_]
+        self._sweep_results.pop(id_, None)
+        self._game_start.pop(id_, None)
+        self._moves.pop(id_, None)
+        self.failed_games.append(id_)
+        self.metrics.inc("games_failed")
+
+    def _finish_game(self, id_: str, katago_results: list[dict]) -> None:
+        del self._games[id_]
+        if id_ in self._game_start:
+            self.metrics.observe("game_latency", time.perf_counter() - self._game_start.pop(id_))
+        self._output_game(id_, katago_results)
+        if self.cache is not None:
+            self.cache.store(self._keys[id_], self.result_filename, self.result_format, id_)
+        self.metrics.inc("games_completed")
+
+    def _output_game(self, id_: str, katago_results: list[dict]) -> None:
+        assert self._result_log is not None
+        with self.metrics.timer("result_write"):
+            self._result_log.append_game(id_, katago_results, self._moves.pop(id_))
+        assert self._journal is not None
+        self._journal.record(id_, self._keys[id_], [d["turnNumber"] for d in katago_results])
+        with self.metrics.timer("game_output"):
+            self.on_game_complete(id_, katago_results)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
     parser = argparse.ArgumentParser()
-    parser.add_argument("-e", "--engine_command", required=True, help="KataGo analysis engine command")
+    parser.add_argument(
+        "-e",
+        "--engine_command",
+        action="append",
+        help="KataGo analysis engine command (repeat to run several engines, e.g. one per NUMA node)",
+    )
+    parser.add_argument("--max_in_flight", type=int, default=16, help="Maximum number of games queued per engine")
+    parser.add_argument(
+        "--turn_window",
+        type=int,
+        help="Fixed number of turns outstanding per engine (0: write whole games at once; default: adapt to the engine)",
+    )
     parser.add_argument("-k", "--katago_result_dir", default="katago_results")
-    parser.add_argument("--sgf_dir", required=True, help="Target SGFs directory")
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("--sgf_dir", help="Target SGFs directory")
+    input_group.add_argument("--corpus", help="Compiled corpus file (see corpus.py) used instead of --sgf_dir")
     parser.add_argument("--komi", type=float, help="Override komi in sgfs if specified")
     parser.add_argument("--rules", choices=SUPPORTED_RULES, help="Override rules in sgfs if specified")
     parser.add_argument("--max_visits", type=int, help="Override maxVisits in config if specified")
     parser.add_argument("--ownership", action="store_true")
-    parser.add_argument("--result_csv", required=True, help="Analysis result CSV file (appended if already exists)")
-    parser.add_argument("-v", "--verbose", action="store_true")
-    args = vars(parser.parse_args())
+    parser.add_argument(
+        "--sweep_visits",
+        type=int,
+        help="Analyze all turns with this many visits first, then re-analyze only critical turns with max_visits",
+    )
+    parser.add_argument(
+        "--near_tie", type=float, default=0.02, help="Winrate gap between played and best move that makes a turn critical"
+    )
+    parser.add_argument(
+        "--critical_winrate_diff", type=float, default=5.0, help="Winrate loss (%%) that makes a turn critical"
+    )
+    parser.add_argument("--critical_blunder", type=float, default=30.0, help="Blunder value that makes a turn critical")
+    parser.add_argument(
+        "--turn_range", type=int, nargs=2, metavar=("FIRST", "LAST"), help="Only score moves FIRST..LAST (1-based)"
+    )
+    parser.add_argument(
+        "--turn_step", type=int, default=1, help="Only score every k-th move (odd, so both players are scored)"
+    )
+    parser.add_argument(
+        "--decided_winrate",
+        type=float,
+        help="Probe every game first and stop scoring once max(winrate, 1 - winrate) stays at or above this",
+    )
+    parser.add_argument(
+        "--decided_turns", type=int, default=10, help="Consecutive probed turns beyond --decided_winrate that end a game"
+    )
+    parser.add_argument("--probe_visits", type=int, default=16, help="maxVisits of the --decided_winrate probe")
+    parser.add_argument(
+        "--schedule",
+        choices=("lpt", "input"),
+        default="lpt",
+        help="Submit games longest first (lpt, with KataGo priorities) or in input order",
+    )
+    parser.add_argument(
+        "--priority",
+        action="append",
+        default=[],
+        metavar="GAME=PRIORITY",
+        help="Analyze a game before all games of lower priority (default 0; repeatable)",
+    )
+    parser.add_argument("--priority_file", help="File with one \"game priority\" pair per line")
+    parser.add_argument(
+        "--result_csv",
+        help="Analysis result CSV file (appended if already exists). Games are written as they complete, so their"
+        " order varies between runs; --shard/--merge write them in game name order",
+    )
+    parser.add_argument(
+        "--winrate_thresholds",
+        type=float,
+        nargs="+",
+        default=list(WINRATE_THRESHOLDS),
+        help="Statistics are computed over the moves whose position has max(winrate, 1 - winrate) <= each threshold",
+    )
+    parser.add_argument(
+        "--metrics",
+        nargs="+",
+        choices=list(METRICS),
+        default=list(DEFAULT_METRICS),
+        help="Per-threshold mean columns written after the match count",
+    )
+    parser.add_argument(
+        "--result_format",
+        choices=("json", "binary"),
+        default="json",
+        help="Store responses as an indexed JSON log (all.txt) or a compact binary store (all.bin, see result_store.py)",
+    )
+    parser.add_argument(
+        "--ownership_dtype", choices=list(OWNERSHIP_DTYPES), default="float16", help="Ownership precision in all.bin"
+    )
+    parser.add_argument(
+        "--rescore",
+        action="store_true",
+        help="Write the result CSV from the responses stored in katago_result_dir without running an engine",
+    )
+    parser.add_argument(
+        "--shard",
+        action="store_true",
+        help="Analyze batches claimed from a queue shared with other workers (see shard_queue.py) into katago_result_dir/shards",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the finished batches of the shard queue into --result_csv and katago_result_dir without running an engine",
+    )
+    parser.add_argument("--queue_dir", help="Shard queue directory (default: <sgf_dir>/.queue or <corpus>.queue)")
+    parser.add_argument("--batch_size", type=int, default=64, help="Games per shard batch (fixed by the first worker)")
+    parser.add_argument("--worker_id", help="Name of this worker in the shard queue (default: <hostname>-<pid>)")
+    parser.add_argument(
+        "--claim_timeout", type=float, default=600.0, help="Seconds after which a batch of an unresponsive worker is retaken"
+    )
+    parser.add_argument(
+        "--max_restarts", type=int, default=5, help="Times each engine is restarted after exiting unexpectedly"
+    )
+    parser.add_argument(
+        "--max_retries", type=int, default=2, help="Engine exits a game may be in flight for before it is given up"
+    )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="Analyze games again even if the journal of the result log/store records them as complete",
+    )
+    parser.add_argument("--cache_dir", help="Analysis result cache directory (default: <katago_result_dir>/cache)")
+    parser.add_argument(
+        "--no_validate", action="store_true", help="Send games to the engine without replaying them for illegal moves"
+    )
+    parser.add_argument("--no_cache", action="store_true", help="Do not read or write the analysis result cache")
+    parser.add_argument(
+        "--position_cache_turns",
+        type=int,
+        default=0,
+        help="Share results of the first N turns across games (0: disabled). The answers are approximate: positions are"
+        " matched without move history or captures, which KataGo's search and Japanese scoring do depend on",
+    )
+    parser.add_argument(
+        "--metrics_file", help="Write run metrics to this file periodically (Prometheus text format if it ends in .prom)"
+    )
+    parser.add_argument("--metrics_interval", type=float, default=10.0, help="Seconds between metrics file updates")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Also print every query and per-turn statistics")
+    args = vars(parser.parse_args(argv))
+    if not args["engine_command"] and not args["rescore"] and not args["merge"]:
+        parser.error("-e/--engine_command is required unless --rescore or --merge is given")
+    if args["result_csv"] is None and not args["shard"]:
+        parser.error("--result_csv is required unless --shard is given")
+    if args["turn_step"] < 1 or args["turn_step"] % 2 == 0:
+        parser.error("--turn_step must be odd: with an even step every scored move is the same player's")
 
     print(f"args: {args}\n")
 
-    game_data_dict: dict[str, GameData] = dict()
-    for sgf_file in sorted(glob.glob(f"{os.path.abspath(args['sgf_dir'])}/*.sgf")):
-        sgf_name = os.path.basename(sgf_file).replace(".sgf", "")
-        game_data = GameData.from_sgf(sgf_file)
-        if args["komi"] is not None:
-            game_data.komi = args["komi"]
-        if args["rules"] is not None:
-            game_data.rules = args["rules"]
-        game_data_dict[sgf_name] = game_data
+    metrics = Metrics()
+    with metrics.timer("parse"):
+        overrides = dict((attr, args[attr]) for attr in ("komi", "rules") if args[attr] is not None)
+        game_data_dict = load_games(args["sgf_dir"], args["corpus"], overrides)
+    metrics.inc("games_loaded", len(game_data_dict))
+    # corpus.py already validated the games of a compiled corpus, under their own rules
+    validated = args["corpus"] is not None and args["rules"] is None
+    if not args["no_validate"] and not validated and not args["rescore"] and not args["merge"]:
+        # Illegal games would only come back as engine errors after taking queue slots
+        with metrics.timer("validate"):
+            metrics.inc("games_invalid", len(drop_illegal_games(game_data_dict)))
 
     if not game_data_dict:
         sys.exit()
@@ -269,45 +1560,226 @@ if __name__ == "__main__":
     katago_result_dir = os.path.abspath(args["katago_result_dir"])
     os.makedirs(katago_result_dir, exist_ok=True)
 
-    katago_result_all_file = f"{katago_result_dir}/all.txt"
-    engine = AnalysisEngine(re.split(r"\s+", args["engine_command"].strip()), katago_result_all_file)
+    turn_selection: Optional[TurnSelection] = None
+    if args["turn_range"] is not None or args["turn_step"] > 1 or args["decided_winrate"] is not None:
+        turn_selection = TurnSelection(
+            tuple(args["turn_range"]) if args["turn_range"] is not None else None,
+            args["turn_step"],
+            args["decided_winrate"],
+            args["decided_turns"],
+            args["probe_visits"],
+        )
+
+    def scored_moves(sgf_name: str) -> Optional[list[int]]:
+        if turn_selection is None:
+            return None
+        return turn_selection.scored_moves(len(game_data_dict[sgf_name].moves))
+
+    def handle_results(sgf_name: str, katago_results: list[dict]) -> None:
+        with metrics.timer("csv_write"):
+            add_result_to_csv(
+                katago_results,
+                game_data_dict[sgf_name],
+                args["result_csv"],
+                args["verbose"],
+                args["winrate_thresholds"],
+                args["metrics"],
+                scored_moves(sgf_name),
+            )
+
+    if args["rescore"]:
+        stored_results = open_results(katago_result_dir)
+        if stored_results is None:
+            print(f"No stored results in {katago_result_dir}", file=sys.stderr)
+            sys.exit(1)
+        for sgf_name in sorted(game_data_dict.keys()):
+            if sgf_name not in stored_results:
+                print(f"No stored result for {sgf_name}", file=sys.stderr)
+                continue
+            handle_results(sgf_name, stored_results.load(sgf_name))
+        stored_results.close()
+        print(metrics.summary())
+        sys.exit()
+
+    shard_queue: Optional[ShardQueue] = None
+    if args["shard"] or args["merge"]:
+        queue_dir = args["queue_dir"] or (
+            f"{args['sgf_dir']}/.queue" if args["sgf_dir"] is not None else f"{args['corpus']}.queue"
+        )
+        shard_queue = ShardQueue(
+            queue_dir,
+            katago_result_dir,
+            list(game_data_dict),
+            args["batch_size"],
+            args["worker_id"],
+            args["claim_timeout"],
+        )
+    result_basename = "all.bin" if args["result_format"] == "binary" else "all.txt"
+
+    if args["merge"]:
+        assert shard_queue is not None
+        missing_batches = shard_queue.missing_batches()
+        if missing_batches:
+            print(f"Unfinished batches: {' '.join(missing_batches)}", file=sys.stderr)
+            sys.exit(1)
+        with metrics.timer("merge"):
+            merge_shards(
+                shard_queue,
+                args["result_csv"],
+                f"{katago_result_dir}/{result_basename}",
+                args["result_format"],
+                args["ownership_dtype"],
+                dict((sgf_name, game_data.moves) for sgf_name, game_data in game_data_dict.items()),
+            )
+        print(metrics.summary())
+        sys.exit()
+
+    engine_cmds = [re.split(r"\s+", cmd.strip()) for cmd in args["engine_command"]]
+    cache: Optional[ResultCache] = None
+    position_cache: Optional[PositionCache] = None
+    if not args["no_cache"]:
+        cache_dir = os.path.abspath(args["cache_dir"] or f"{katago_result_dir}/cache")
+        cache = ResultCache(cache_dir, engine_cmds)
+        db_filename = "positions.sqlite3"
+        if shard_queue is not None:
+            # SQLite locking is unreliable on network filesystems, so shard workers do not share one database; each
+            # worker gets its own (named after --worker_id, to be reused by reruns)
+            db_filename = f"positions.{shard_queue.worker_id}.sqlite3"
+        if args["position_cache_turns"] > 0:
+            position_cache = PositionCache(f"{cache_dir}/{db_filename}", engine_cmds, args["position_cache_turns"])
+
+    sweep: Optional[SweepSettings] = None
+    if args["sweep_visits"] is not None:
+        sweep = SweepSettings(
+            args["sweep_visits"], args["near_tie"], args["critical_winrate_diff"], args["critical_blunder"]
+        )
+
+    def parse_priority(text: str, where: str) -> int:
+        try:
+            priority = int(text)
+        except ValueError:
+            parser.error(f"{where}: priority {text!r} is not an integer")
+        if abs(priority) >= MAX_USER_PRIORITY:
+            parser.error(f"{where}: priority {priority} is outside -{MAX_USER_PRIORITY - 1}..{MAX_USER_PRIORITY - 1}")
+        return priority
+
+    priorities: dict[str, int] = dict()
+    if args["priority_file"] is not None:
+        with open(args["priority_file"], "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                where = f"{args['priority_file']} line {line_number}"
+                fields = line.rsplit(None, 1)
+                if len(fields) != 2:
+                    parser.error(f"{where}: expected \"game priority\", got {line.strip()!r}")
+                priorities[fields[0].strip()] = parse_priority(fields[1], where)
+    for item in args["priority"]:
+        if "=" not in item:
+            parser.error(f"--priority {item}: expected GAME=PRIORITY")
+        name, priority = item.rsplit("=", 1)
+        priorities[name] = parse_priority(priority, f"--priority {item}")
+
+    def make_driver(result_filename: str, on_game_complete: Callable[[str, list[dict]], None]) -> AnalysisDriver:
+        return AnalysisDriver(
+            engine_cmds,
+            result_filename,
+            args["max_in_flight"],
+            on_game_complete,
+            cache=cache,
+            position_cache=position_cache,
+            sweep=sweep,
+            metrics=metrics,
+            verbose=args["verbose"],
+            result_format=args["result_format"],
+            ownership_dtype=args["ownership_dtype"],
+            turn_selection=turn_selection,
+            schedule=args["schedule"],
+            priorities=priorities,
+            resume=not args["no_resume"],
+            max_restarts=args["max_restarts"],
+            max_retries=args["max_retries"],
+            turn_window=args["turn_window"],
+        )
+
+    drivers: list[AnalysisDriver] = []
+
+    def run_shard_worker(shard_queue: ShardQueue) -> None:
+        """Analyze claimed batches until none is left, each into its own directory with a CSV sorted by game."""
+        while True:
+            batch = shard_queue.claim_next()
+            if batch is None:
+                break
+            print(f"{shard_queue.worker_id}: {batch.name} ({len(batch.games)} games)")
+            with shard_queue.holding(batch):
+                os.makedirs(batch.output_dir, exist_ok=True)
+                batch_stats: dict[str, dict] = dict()
+
+                def collect_stats(sgf_name: str, katago_results: list[dict]) -> None:
+                    with metrics.timer("stats"):
+                        batch_stats[sgf_name] = compute_game_stats(
+                            katago_results,
+                            game_data_dict[sgf_name],
+                            args["verbose"],
+                            args["winrate_thresholds"],
+                            args["metrics"],
+                            scored_moves(sgf_name),
+                        )
+
+                drivers.append(make_driver(f"{batch.output_dir}/{result_basename}", collect_stats))
+                drivers[-1].run(
+                    dict((sgf_name, query_dict_dict[sgf_name]) for sgf_name in batch.games if sgf_name in query_dict_dict)
+                )
+                batch_csv = f"{batch.output_dir}/result.csv"
+                if os.path.exists(f"{batch_csv}.tmp"):
+                    os.remove(f"{batch_csv}.tmp")
+                with metrics.timer("csv_write"):
+                    for sgf_name in batch.games:
+                        if sgf_name in batch_stats:
+                            write_game_stats_csv(batch_stats[sgf_name], f"{batch_csv}.tmp", args["metrics"])
+                if os.path.exists(f"{batch_csv}.tmp"):
+                    os.replace(f"{batch_csv}.tmp", batch_csv)
+                shard_queue.complete(batch)
+            metrics.inc("batches_completed")
+
+    query_dict_dict = GameQueries(game_data_dict, args["max_visits"], args["ownership"])
+    exporter: Optional[MetricsExporter] = None
+    if args["metrics_file"] is not None:
+        exporter = MetricsExporter(metrics, args["metrics_file"], args["metrics_interval"]).start()
     try:
-        assert engine.proc.stdin is not None
-        for sgf_name, game_data in game_data_dict.items():
-            query = game_data.to_query(sgf_name, args["max_visits"], args["ownership"])
-            print(query)
-            engine.write_query(query)
-        engine.proc.stdin.close()
-        while engine.proc.poll() is None:
-            time.sleep(3)
+        if shard_queue is None:
+            drivers.append(make_driver(f"{katago_result_dir}/{result_basename}", handle_results))
+            drivers[-1].run(query_dict_dict)
+        else:
+            run_shard_worker(shard_queue)
     except KeyboardInterrupt:
         print("Interrupted", file=sys.stderr)
-        engine.proc.send_signal(SIGINT)
+        if not drivers or drivers[-1].pool is None:
+            sys.exit(1)
+        driver = drivers[-1]
+        assert driver.pool is not None
+        driver.pool.send_signal(SIGINT)
 
         wait_sec = 5
         try:
-            returncode = engine.proc.wait(wait_sec)
-            print(f"returncode: {returncode}")
-            sys.exit(returncode)
+            returncodes = [engine.proc.wait(wait_sec) for engine in driver.pool.engines]
+            print(f"returncode: {returncodes}")
+            sys.exit(max(returncodes))
         except subprocess.TimeoutExpired as toe:
             print(toe)
-            engine.proc.kill()
+            driver.pool.kill()
             sys.exit(1)
     except Exception as e:
         print("Unexpected Exception", file=sys.stderr)
         print(e, file=sys.stderr)
-        engine.proc.kill()
+        if drivers and drivers[-1].pool is not None:
+            drivers[-1].pool.kill()
         sys.exit(1)
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        print(metrics.summary())
 
-    with open(katago_result_all_file, "r", encoding="utf-8") as f:
-        katago_results = list(map(lambda x: json.loads(x), f.read().strip().split("\n")))
 
-    for sgf_name in sorted(game_data_dict.keys()):
-        katago_result_file = f"{katago_result_dir}/{sgf_name}.txt"
-        with open(katago_result_file, "w", encoding="utf-8") as f:
-            for line_dict in katago_results:
-                if line_dict["id"] == sgf_name:
-                    f.write(json.dumps(line_dict))
-                    f.write("\n")
-
-        add_result_to_csv(katago_result_file, game_data_dict[sgf_name], args["result_csv"], args["verbose"])
+if __name__ == "__main__":
+    main()
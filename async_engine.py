@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import sys
+from typing import AsyncIterator, Optional
+
+from game_data import GameData
+
+# asyncio client for one long-running KataGo analysis engine, for use as a library (e.g. from a web backend).
+#
+#     engine = await AsyncAnalysisEngine.start(["katago", "analysis", "-config", ..., "-model", ...])
+#     results = await engine.analyze(game_data, max_visits=200)
+#     async for response in engine.analyze_turns(game_data):
+#         ...
+#     await engine.close()
+#
+# Many callers can share the engine concurrently: every query gets a unique id, responses are routed back by
+# id and turnNumber, and a caller that is cancelled (or stops iterating early) has its query terminated in
+# the engine so no search time is spent on it.
+
+# Responses with ownership for every candidate move are far larger than asyncio's default 64KiB line limit
+STREAM_LIMIT = 1 << 26
+
+
+class AnalysisError(RuntimeError):
+    pass
+
+
+class AnalysisQuery:
+    """Responses of one submitted query, available all at once (await result()) or turn by turn (async for)."""
+
+    def __init__(self, engine: AsyncAnalysisEngine, query_dict: dict) -> None:
+        self.engine = engine
+        self.id = query_dict["id"]
+        self.num_turns = len(query_dict["analyzeTurns"])
+        self.responses: dict[int, dict] = dict()
+        self._future: asyncio.Future[list[dict]] = asyncio.get_running_loop().create_future()
+        self._arrivals: asyncio.Queue[Optional[dict]] = asyncio.Queue()
+
+    @property
+    def done(self) -> bool:
+        return self._future.done()
+
+    async def result(self) -> list[dict]:
+        """All responses sorted by turnNumber. Cancelling the wait terminates the query."""
+        try:
+            return await asyncio.shield(self._future)
+        except asyncio.CancelledError:
+            await self.cancel()
+            raise
+
+    async def cancel(self) -> None:
+        if not self._future.done():
+            self._future.cancel()
+            self._arrivals.put_nowait(None)
+            await self.engine.terminate(self.id)
+
+    def __aiter__(self) -> AsyncIterator[dict]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[dict]:
+        num_received = 0
+        try:
+            while num_received < self.num_turns:
+                response = await self._arrivals.get()
+                if response is None:
+                    break
+                num_received += 1
+                yield response
+            if self._future.done() and not self._future.cancelled() and self._future.exception() is not None:
+                raise self._future.exception()  # type: ignore[misc]
+        finally:
+            if num_received < self.num_turns:
+                await self.cancel()
+
+    def _add_response(self, response: dict) -> None:
+        if self._future.done():
+            return
+        self.responses[response["turnNumber"]] = response
+        self._arrivals.put_nowait(response)
+        if len(self.responses) == self.num_turns:
+            self._future.set_result([self.responses[t] for t in sorted(self.responses)])
+
+    def _fail(self, error: Exception) -> None:
+        if not self._future.done():
+            self._future.set_exception(error)
+            # Retrieved by whichever of result() or the iterator the caller uses; avoid "never retrieved" noise
+            self._future.exception()
+            self._arrivals.put_nowait(None)
+
+
+class AsyncAnalysisEngine:
+    def __init__(self, proc: asyncio.subprocess.Process, id_prefix: str = "q") -> None:
+        self.proc = proc
+        self.id_prefix = id_prefix
+        self._queries: dict[str, AnalysisQuery] = dict()
+        self._ids = itertools.count()
+        self._write_lock = asyncio.Lock()
+        self._reader = asyncio.get_running_loop().create_task(self._read_responses())
+
+    @staticmethod
+    async def start(cmd: list[str], id_prefix: str = "q") -> AsyncAnalysisEngine:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=sys.stderr, limit=STREAM_LIMIT
+        )
+        return AsyncAnalysisEngine(proc, id_prefix)
+
+    @property
+    def in_flight_turns(self) -> int:
+        return sum(q.num_turns - len(q.responses) for q in self._queries.values())
+
+    async def __aenter__(self) -> AsyncAnalysisEngine:
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await self.close()
+
+    async def submit(self, query_dict: dict) -> AnalysisQuery:
+        """Send a query (its id is replaced with a unique one) and return the handle its responses arrive on."""
+        if self.proc.returncode is not None:
+            raise AnalysisError(f"Engine has exited with {self.proc.returncode}")
+        query_dict = dict(query_dict, id=f"{self.id_prefix}{next(self._ids)}")
+        query = AnalysisQuery(self, query_dict)
+        if query.num_turns == 0:
+            query._future.set_result([])
+            return query
+        self._queries[query.id] = query
+        await self._write(query_dict)
+        return query
+
+    async def analyze(
+        self, game_data: GameData, max_visits: Optional[int] = None, ownership: Optional[bool] = None, **fields: object
+    ) -> list[dict]:
+        """Analyze a game and return the responses of all analyzed turns, sorted by turnNumber.
+
+        Extra keyword arguments are added to the query as is (e.g. analyzeTurns=[10, 11], priority=5).
+        """
+        query = await self.submit(dict(game_data.to_query_dict("", max_visits, ownership), **fields))
+        return await query.result()
+
+    async def analyze_turns(
+        self, game_data: GameData, max_visits: Optional[int] = None, ownership: Optional[bool] = None, **fields: object
+    ) -> AsyncIterator[dict]:
+        """Like analyze, but yields each turn's response as soon as the engine sends it (in arrival order)."""
+        query = await self.submit(dict(game_data.to_query_dict("", max_visits, ownership), **fields))
+        async for response in query:
+            yield response
+
+    async def terminate(self, id_: str) -> None:
+        query = self._queries.pop(id_, None)
+        if query is None or self.proc.returncode is not None:
+            return
+        await self._write({"id": f"terminate-{id_}", "action": "terminate", "terminateId": id_})
+
+    async def close(self) -> None:
+        """Close the engine's input and wait for it to finish the outstanding queries and exit."""
+        if self.proc.stdin is not None and not self.proc.stdin.is_closing():
+            self.proc.stdin.close()
+        await self.proc.wait()
+        await self._reader
+
+    async def _write(self, query_dict: dict) -> None:
+        assert self.proc.stdin is not None
+        async with self._write_lock:
+            self.proc.stdin.write(f"{json.dumps(query_dict)}\n".encode("utf-8"))
+            await self.proc.stdin.drain()
+
+    async def _read_responses(self) -> None:
+        assert self.proc.stdout is not None
+        try:
+            async for line in self.proc.stdout:
+                self._on_response(json.loads(line))
+        finally:
+            returncode = await self.proc.wait()
+            for query in self._queries.values():
+                query._fail(AnalysisError(f"Engine exited with {returncode} before all turns were analyzed"))
+            self._queries.clear()
+
+    def _on_response(self, response: dict) -> None:
+        if response.get("action") == "terminate" or response.get("isDuringSearch", False):
+            return
+        query = self._queries.get(response.get("id", ""))
+        if "error" in response:
+            if query is None:
+                print(f"Engine error: {response}", file=sys.stderr)
+                return
+            del self._queries[query.id]
+            query._fail(AnalysisError(f"Engine error: {response}"))
+            return
+        if "warning" in response:
+            print(f"Engine warning: {response}", file=sys.stderr)
+            return
+        if query is None:
+            return
+        query._add_response(response)
+        if query.done:
+            del self._queries[query.id]
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import pandas as pd
+
+from chatgpt_prompt_generator import PROMPT_COLUMNS, build_prompts
+from feature_store import read_features
+
+CHUNK_SIZE = 10000
+
+def add_game_column(df, default_name):
+    # CSV files have no game column; a new game starts wherever move_num does not increase. A file holding one game
+    # names it after the file, a file holding several names them <file>#0, <file>#1, ... in file order, since
+    # prompt_data_generator.py does not write game names to CSV
+    if "game" in df.columns:
+        return df
+    game_num = (df["move_num"].diff() <= 0).cumsum()
+    if game_num.iloc[-1] == 0:
+        df.insert(0, "game", default_name)
+    else:
+        df.insert(0, "game", default_name + "#" + game_num.astype(str))
+    return df
+
+def add_loss_columns(df):
+    # NaN where the played move was not among the engine's candidates (see prompt_data_generator.compute_features)
+    df["score_loss"] = df["best_score_lead"] - df["score_lead"]
+    df["winrate_loss"] = (df["best_winrate"] - df["winrate"]) * 100
+    return df
+
+def parse_selector(s):
+    game, move_num = s.rsplit(":", 1)
+    return game, int(move_num)
+
+def load_table(input_file, games=None):
+    if os.path.isdir(input_file):
+        return read_features(input_file, columns=PROMPT_COLUMNS, games=games)
+    df = pd.read_csv(input_file)
+    df = add_game_column(df, os.path.splitext(os.path.basename(input_file))[0])
+    if games is not None:
+        # numbered games of a multi-game file are kept for the "Not found" hint of select_rows
+        df = df.loc[df["game"].isin(games) | df["game"].str.rsplit("#", n=1).str[0].isin(games)]
+    return df
+
+def select_rows(df, selectors, rule):
+    """Row positions of df matching the (game, move_num) selectors and/or the rule, in table order.
+
+    Rows without the played move's winrate and score lead (it was not among the engine's candidates) never match
+    the rule, whatever it tests."""
+    positions = []
+    if selectors:
+        # A game analyzed again (e.g. appended twice to the feature CSV) has duplicate keys; its last rows are selected
+        last = ~df.duplicated(["game", "move_num"], keep="last").to_numpy()
+        index = pd.MultiIndex.from_arrays([df["game"][last], df["move_num"][last]])
+        found = index.get_indexer(selectors)
+        games = set(df["game"])
+        for selector, pos in zip(selectors, found):
+            if pos < 0:
+                hint = f" (a file with several games, select {selector[0]}#0, ...)" if f"{selector[0]}#0" in games else ""
+                print(f"Not found: {selector[0]}:{selector[1]}{hint}")
+        positions.append(last.nonzero()[0][found[found >= 0]])
+    if rule:
+        mask = add_loss_columns(df.copy()).eval(rule) & df["winrate"].notna() & df["score_lead"].notna()
+        positions.append(mask.to_numpy().nonzero()[0])
+    if not positions:
+        return range(len(df))
+    return sorted(set().union(*[set(p.tolist()) for p in positions]))
+
+def write_prompts(df, positions, output_file):
+    """Write the prompts of the rows at positions as JSON lines and return their number."""
+    num_prompts = 0
+    with open(output_file, "w", encoding="utf-8") as w:
+        for start in range(0, len(positions), CHUNK_SIZE):
+            chunk = df.iloc[list(positions[start : start + CHUNK_SIZE])]
+            prompts = build_prompts(chunk)
+            for game, move_num, prompt in zip(chunk["game"], chunk["move_num"], prompts):
+                w.write(json.dumps({"game": game, "move_num": int(move_num), "prompt": prompt}, ensure_ascii=False))
+                w.write("\n")
+                num_prompts += 1
+    return num_prompts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", "-f", help="Input CSV file or Parquet dataset directory path.", required=True, type=str)
+    parser.add_argument("--output_file", "-o", help="Output JSONL file path.", required=True, type=str)
+    parser.add_argument("--select", "-s", help="Target as game:move_num (repeatable). Games of a CSV file are named after it, <file>#<n> (from 0, in file order) if it holds several.", action="append", default=[], type=str)
+    parser.add_argument("--select_file", help="File with one game:move_num target per line.", type=str)
+    parser.add_argument("--rule", "-r", help='Row filter expression, e.g. "score_loss > 3" (columns: score_loss, winrate_loss and all features).', type=str)
+    args = parser.parse_args(argv)
+
+    selectors = [parse_selector(s) for s in args.select]
+    if args.select_file:
+        with open(args.select_file, "r", encoding="utf-8") as f:
+            selectors += [parse_selector(line.strip()) for line in f if line.strip()]
+
+    games = None
+    if selectors and not args.rule:
+        games = sorted(set(game for game, _ in selectors))
+    df = load_table(args.input_file, games).reset_index(drop=True)
+    positions = select_rows(df, selectors, args.rule)
+
+    num_prompts = write_prompts(df, positions, args.output_file)
+    print(f"{num_prompts} prompts written to {args.output_file}")
+
+if __name__ == "__main__":
+    main()
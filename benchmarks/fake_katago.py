@@ -0,0 +1,173 @@
+"""Stand-in for the KataGo analysis engine, for benchmarks and tests on machines without KataGo or a GPU.
+
+Reads analysis queries as JSON lines on stdin and writes one plausible response per analyzed turn
+(rootInfo, moveInfos with PVs and optional ownership). Responses are deterministic for a given
+position prefix and visit count. Extra arguments such as "analysis -config ... -model ..." are ignored
+so the fake can be dropped into an existing engine command line.
+
+    python benchmarks/fake_katago.py --latency 0.001 --threads 8 --reorder 16
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+GTP_COLUMNS = "ABCDEFGHJKLMNOPQRST"
+NUM_CANDIDATES = 8
+
+
+def opponent(player: str) -> str:
+    return "W" if player == "B" else "B"
+
+
+def random_point(rng: random.Random, board_x_size: int, board_y_size: int) -> str:
+    return f"{GTP_COLUMNS[rng.randrange(board_x_size)]}{rng.randrange(board_y_size) + 1}"
+
+
+def respond(query: dict, turn: int) -> dict:
+    bx, by = query["boardXSize"], query["boardYSize"]
+    moves = query["moves"]
+    max_visits = query.get("maxVisits", 100)
+    seed = hashlib.md5(json.dumps([query.get("initialStones"), moves[:turn], max_visits]).encode("utf-8")).digest()
+    rng = random.Random(seed)
+
+    if turn < len(moves):
+        player = moves[turn][0]
+    elif moves:
+        player = opponent(moves[-1][0])
+    else:
+        player = "B"
+    candidates: list[str] = []
+    if turn < len(moves) and rng.random() < 0.6:
+        candidates.append(moves[turn][1])
+    while len(candidates) < NUM_CANDIDATES:
+        m = random_point(rng, bx, by)
+        if m not in candidates:
+            candidates.append(m)
+    rng.shuffle(candidates)
+
+    root_winrate = min(max(rng.gauss(0.5, 0.2), 0.001), 0.999)
+    root_score = rng.gauss(0, 8)
+    move_infos = []
+    remaining_visits = max_visits
+    for order, move in enumerate(candidates):
+        visits = max(1, remaining_visits // 2) if order < NUM_CANDIDATES - 1 else max(1, remaining_visits)
+        remaining_visits = max(0, remaining_visits - visits)
+        move_info = {
+            "move": move,
+            "order": order,
+            "visits": visits,
+            "winrate": max(0.0, root_winrate - 0.02 * order * rng.random()),
+            "scoreLead": root_score - 0.5 * order * rng.random(),
+            "prior": 0.5 / (order + 1),
+            "pv": [move] + [random_point(rng, bx, by) for _ in range(rng.randrange(1, 8))],
+        }
+        if query.get("includeMovesOwnership"):
+            move_info["ownership"] = [round(rng.uniform(-1, 1), 6) for _ in range(bx * by)]
+        move_infos.append(move_info)
+    return {
+        "id": query["id"],
+        "isDuringSearch": False,
+        "turnNumber": turn,
+        "moveInfos": move_infos,
+        "rootInfo": {
+            "currentPlayer": player,
+            "winrate": root_winrate,
+            "scoreLead": root_score,
+            "scoreStdev": rng.uniform(5, 25),
+            "visits": max_visits,
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of simulated search per turn")
+    parser.add_argument("--threads", type=int, default=1, help="Turns searched concurrently")
+    parser.add_argument("--reorder", type=int, default=0, help="Shuffle responses within windows of this size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--crash_after", type=int, default=0, help="Exit abruptly after this many responses, like a crashed engine"
+    )
+    args, _ = parser.parse_known_args()
+
+    out_lock = threading.Lock()
+    terminated: set[str] = set()
+    tasks: queue.Queue = queue.Queue(maxsize=max(1, args.threads) * 4)
+    rng = random.Random(args.seed)
+    pending: list[str] = []
+    num_emitted = [0]
+
+    def emit(response: dict) -> None:
+        line = json.dumps(response)
+        with out_lock:
+            num_emitted[0] += 1
+            if args.crash_after > 0 and num_emitted[0] > args.crash_after:
+                sys.stdout.flush()
+                os._exit(3)
+            if args.reorder > 1:
+                pending.append(line)
+                # Hold responses back to reorder them, but never while the engine would otherwise sit idle
+                if len(pending) < args.reorder and not tasks.empty():
+                    return
+                rng.shuffle(pending)
+                lines = pending[:]
+                pending.clear()
+            else:
+                lines = [line]
+            sys.stdout.write("".join(f"{x}\n" for x in lines))
+            sys.stdout.flush()
+
+    def worker() -> None:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            query, turn = task
+            if query["id"] in terminated:
+                continue
+            if args.latency > 0:
+                time.sleep(args.latency)
+            emit(respond(query, turn))
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, args.threads))]
+    for w in workers:
+        w.start()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            query = json.loads(line)
+        except json.JSONDecodeError as e:
+            emit({"error": f"Could not parse json: {e}"})
+            continue
+        if query.get("action") == "terminate":
+            terminated.add(query["terminateId"])
+            emit({"id": query["id"], "action": "terminate", "terminateId": query["terminateId"]})
+            continue
+        bad_field = next((k for k in ("moves", "analyzeTurns") if not isinstance(query.get(k), list)), None)
+        if bad_field is not None:
+            emit({"id": query.get("id"), "error": "Missing or invalid field", "field": bad_field})
+            continue
+        for turn in query["analyzeTurns"]:
+            tasks.put((query, turn))
+
+    for _ in workers:
+        tasks.put(None)
+    for w in workers:
+        w.join()
+    with out_lock:
+        sys.stdout.write("".join(f"{x}\n" for x in pending))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
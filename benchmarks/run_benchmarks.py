@@ -0,0 +1,188 @@
+"""Throughput benchmarks for the analysis pipeline on synthetic games, using the fake engine instead of KataGo.
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 --json bench.json
+
+Stages: SGF parsing (GameData.from_sgf), replaying the games for illegal moves (GameData.validate), query building (to_query), the engine I/O loop through EnginePool,
+writing and reading the indexed result log and the binary result store, analyze.add_result_to_csv, prompt_data_generator.compute_features
+(with ownership) and calc_average's running statistics.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import analyze  # noqa: E402
+import calc_average  # noqa: E402
+import prompt_data_generator  # noqa: E402
+from benchmarks.fake_katago import respond  # noqa: E402
+from corpus import load_games  # noqa: E402
+from go_board import Board  # noqa: E402
+from result_index import ResultLog, ResultLogWriter  # noqa: E402
+from result_store import ResultStore, ResultStoreWriter  # noqa: E402
+
+SGF_COLUMNS = "abcdefghijklmnopqrs"
+FAKE_ENGINE = os.path.join(ROOT_DIR, "benchmarks", "fake_katago.py")
+
+
+def write_synthetic_sgfs(sgf_dir: str, num_games: int, num_moves: int, seed: int) -> None:
+    rng = random.Random(seed)
+    for i in range(num_games):
+        # random legal moves, so that captures and ko happen as in real games
+        board = Board(19, 19, track_hashes=False)
+        moves = []
+        for j in range(num_moves):
+            player = "BW"[j % 2]
+            tries = (rng.randrange(19 * 19) for _ in range(100))
+            point = next((p for p in tries if board.illegal_reason(player, p) is None), None)
+            if point is None:
+                break
+            board.play(player, point)
+            moves.append((point % 19, point // 19))
+        body = "".join(f";{'BW'[j % 2]}[{SGF_COLUMNS[x]}{SGF_COLUMNS[y]}]" for j, (x, y) in enumerate(moves))
+        with open(os.path.join(sgf_dir, f"game{i:06d}.sgf"), "w", encoding="utf-8") as f:
+            f.write(f"(;GM[1]FF[4]SZ[19]KM[6.5]RU[japanese]PB[black{i % 97}]PW[white{i % 89}]{body})")
+
+
+class Timer:
+    def __init__(self) -> None:
+        self.results: list[dict] = []
+
+    def run(self, size: int, stage: str, items: int, fn: Callable[[], object]) -> object:
+        start = time.perf_counter()
+        value = fn()
+        elapsed = time.perf_counter() - start
+        self.results.append(
+            {"size": size, "stage": stage, "seconds": elapsed, "items": items, "items_per_sec": items / elapsed}
+        )
+        print(f"{size:>8} {stage:<28} {elapsed:10.3f}s {items / elapsed:14.1f}/s", flush=True)
+        return value
+
+
+def bench_size(timer: Timer, size: int, args: argparse.Namespace, work_dir: str) -> None:
+    sgf_dir = os.path.join(work_dir, "sgf")
+    result_dir = os.path.join(work_dir, "katago_results")
+    os.makedirs(sgf_dir)
+    os.makedirs(result_dir)
+    write_synthetic_sgfs(sgf_dir, size, args.moves, args.seed)
+
+    game_data_dict = timer.run(size, "GameData.from_sgf", size, lambda: load_games(sgf_dir))
+    assert isinstance(game_data_dict, dict)
+    timer.run(size, "GameData.validate", size, lambda: [g.validate() for g in game_data_dict.values()])
+    num_turns = sum(len(g.moves) + 1 for g in game_data_dict.values())
+    query_dicts = timer.run(
+        size,
+        "to_query",
+        size,
+        lambda: dict((name, json.loads(g.to_query(name, args.visits))) for name, g in game_data_dict.items()),
+    )
+    assert isinstance(query_dicts, dict)
+
+    def engine_loop() -> dict[str, list[dict]]:
+        cmd = [sys.executable, FAKE_ENGINE, "--threads", str(args.engine_threads), "--reorder", "32"]
+        results: dict[str, list[dict]] = dict()
+        driver = analyze.AnalysisDriver(
+            [cmd], os.path.join(result_dir, "all.txt"), args.max_in_flight, lambda i, r: results.__setitem__(i, r)
+        )
+        driver.run(query_dicts)
+        return results
+
+    results = timer.run(size, "engine I/O loop (turns)", num_turns, engine_loop)
+    assert isinstance(results, dict) and len(results) == size
+
+    log_path = os.path.join(work_dir, "log.txt")
+
+    def write_result_log() -> None:
+        with ResultLogWriter(log_path) as writer:
+            for name, katago_results in results.items():
+                writer.append_game(name, katago_results)
+
+    timer.run(size, "result log write", size, write_result_log)
+
+    def read_result_log() -> None:
+        with ResultLog(log_path) as result_log:
+            for name in result_log.games():
+                result_log.load(name)
+
+    timer.run(size, "result log indexed read", size, read_result_log)
+
+    store_path = os.path.join(work_dir, "store.bin")
+
+    def write_result_store() -> None:
+        with ResultStoreWriter(store_path) as writer:
+            for name, katago_results in results.items():
+                writer.append_game(name, katago_results, query_dicts[name]["moves"])
+
+    timer.run(size, "result store write", size, write_result_store)
+
+    def read_result_store() -> None:
+        with ResultStore(store_path) as result_store:
+            for name in result_store.games():
+                result_store.load(name)
+
+    timer.run(size, "result store read", size, read_result_store)
+
+    csv_file = os.path.join(work_dir, "result.csv")
+
+    def add_results() -> None:
+        for name, katago_results in results.items():
+            analyze.add_result_to_csv(katago_results, game_data_dict[name], csv_file)
+
+    timer.run(size, "analyze.add_result_to_csv", size, add_results)
+
+    num_feature_games = min(size, args.feature_games)
+    feature_results = dict(
+        (name, [respond(dict(query_dicts[name], includeMovesOwnership=True), t) for t in range(len(g.moves) + 1)])
+        for name, g in list(game_data_dict.items())[:num_feature_games]
+    )
+
+    def compute_features() -> None:
+        for name, katago_results in feature_results.items():
+            prompt_data_generator.compute_features(katago_results, game_data_dict[name])
+
+    timer.run(size, "compute_features (ownership)", num_feature_games, compute_features)
+
+    def running_stats() -> None:
+        rs = calc_average.RunningStats()
+        rs.update(csv_file)
+        rs.combined()
+
+    timer.run(size, "calc_average RunningStats", size * 2, running_stats)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000], help="Numbers of synthetic games")
+    parser.add_argument("--moves", type=int, default=120, help="Moves per synthetic game")
+    parser.add_argument("--visits", type=int, default=100, help="maxVisits sent to the fake engine")
+    parser.add_argument("--engine_threads", type=int, default=4, help="Worker threads of the fake engine")
+    parser.add_argument("--max_in_flight", type=int, default=16)
+    parser.add_argument("--feature_games", type=int, default=200, help="Games used for the ownership feature stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    timer = Timer()
+    for size in args.sizes:
+        work_dir = tempfile.mkdtemp(prefix=f"igoadviser-bench-{size}-")
+        try:
+            bench_size(timer, size, args, work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(timer.results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Run several local analyze.py --shard workers on synthetic games with the fake engine and check the merge.
+
+    python benchmarks/run_shard_workers.py --games 200 --workers 4 --batch_size 16
+
+The same games are analyzed once by a single analyze.py process and once by --workers concurrent shard workers
+sharing one queue directory. A first worker is killed right after its first claim, and a last one is started once
+that claim has gone stale, to exercise the takeover.
+The merged result CSV and result log/store must hold the same rows and responses as the single-process run; the
+exit status is 1 if they do not.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.run_benchmarks import FAKE_ENGINE, write_synthetic_sgfs  # noqa: E402
+from result_store import open_results  # noqa: E402
+
+ANALYZE = os.path.join(ROOT_DIR, "analyze.py")
+
+
+def analyze_cmd(args: argparse.Namespace, sgf_dir: str, result_dir: str, *extra: str) -> list[str]:
+    engine = f"{sys.executable} {FAKE_ENGINE} --threads 4 --reorder 16 --latency {args.latency}"
+    return [
+        sys.executable,
+        ANALYZE,
+        "--sgf_dir",
+        sgf_dir,
+        "-e",
+        engine,
+        "-k",
+        result_dir,
+        "--max_visits",
+        str(args.visits),
+        "--result_format",
+        args.result_format,
+        *extra,
+    ]
+
+
+def run(cmd: list[str], log_path: str) -> None:
+    with open(log_path, "w", encoding="utf-8") as log:
+        subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=200, help="Number of synthetic games")
+    parser.add_argument("--moves", type=int, default=120, help="Moves per synthetic game")
+    parser.add_argument("--visits", type=int, default=100, help="maxVisits sent to the fake engine")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of simulated search per turn")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent shard workers")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--result_format", choices=("json", "binary"), default="json")
+    parser.add_argument(
+        "--claim_timeout", type=float, default=5.0, help="Seconds before the killed worker's batch is retaken"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="igoadviser-shards-")
+    print(f"work directory: {work_dir}")
+    try:
+        sgf_dir = os.path.join(work_dir, "sgf")
+        os.makedirs(sgf_dir)
+        write_synthetic_sgfs(sgf_dir, args.games, args.moves, args.seed)
+
+        single_dir = os.path.join(work_dir, "single")
+        start = time.perf_counter()
+        run(
+            analyze_cmd(args, sgf_dir, single_dir, "--no_cache", "--result_csv", f"{single_dir}.csv"),
+            f"{single_dir}.log",
+        )
+        print(f"1 process: {time.perf_counter() - start:.1f}s")
+
+        shard_dir = os.path.join(work_dir, "sharded")
+        queue_args = ("--queue_dir", os.path.join(work_dir, "queue"), "--batch_size", str(args.batch_size))
+        worker_args = (*queue_args, "--shard", "--no_cache", "--claim_timeout", str(args.claim_timeout))
+        start = time.perf_counter()
+        # the first worker is killed as soon as it has claimed a batch, leaving a stale claim behind
+        victim = subprocess.Popen(
+            analyze_cmd(args, sgf_dir, shard_dir, *worker_args, "--worker_id", "victim"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        assert victim.stdout is not None
+        for line in victim.stdout:
+            if line.startswith("victim: batch"):
+                break
+        victim.kill()
+        victim.wait()
+        killed_at = time.time()
+        workers = [
+            subprocess.Popen(
+                analyze_cmd(args, sgf_dir, shard_dir, *worker_args, "--worker_id", f"worker{i}"),
+                stdout=open(os.path.join(work_dir, f"worker{i}.log"), "w", encoding="utf-8"),
+                stderr=subprocess.STDOUT,
+            )
+            for i in range(args.workers)
+        ]
+        returncodes = [worker.wait() for worker in workers]
+        print(f"{args.workers} workers: {time.perf_counter() - start:.1f}s, returncodes {returncodes}")
+        if any(returncodes):
+            sys.exit(1)
+        # the workers leave the killed worker's batch alone until its claim goes stale; a worker started after that,
+        # as an operator would rerun one, takes it over
+        time.sleep(max(0.0, args.claim_timeout + 1 - (time.time() - killed_at)))
+        run(
+            analyze_cmd(args, sgf_dir, shard_dir, *worker_args, "--worker_id", "rescue"),
+            os.path.join(work_dir, "rescue.log"),
+        )
+        print(f"rescue worker: {time.perf_counter() - start:.1f}s")
+        run(
+            analyze_cmd(args, sgf_dir, shard_dir, *queue_args, "--merge", "--result_csv", f"{shard_dir}.csv"),
+            f"{shard_dir}.log",
+        )
+
+        same = True
+        # the single process writes games in completion order, the merge in game name order
+        with open(f"{single_dir}.csv", "r", encoding="utf-8") as f:
+            single_rows = sorted(f)
+        with open(f"{shard_dir}.csv", "r", encoding="utf-8") as f:
+            shard_rows = sorted(f)
+        if single_rows != shard_rows:
+            print("DIFFERENT: result CSV rows")
+            same = False
+        single_results = open_results(single_dir)
+        shard_results = open_results(shard_dir)
+        assert single_results is not None and shard_results is not None
+        with single_results, shard_results:
+            names = sorted(single_results.games())
+            if names != list(shard_results.games()):
+                print("DIFFERENT: games in the result logs")
+                same = False
+            elif any(single_results.load(name) != shard_results.load(name) for name in names):
+                print("DIFFERENT: responses in the result logs")
+                same = False
+        if not same:
+            sys.exit(1)
+        print(f"same results for {args.games} games")
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,247 @@
+import io
 import os
+import csv
+import json
+import hashlib
 import argparse
 import pandas as pd
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input_file", "-f", help="Input data file path.", required=True, type=str)
-    parser.add_argument("--output_file", "-o", help="Output file path.", required=True, type=str)
-    parser.add_argument("--develop", "-v", help="Developer mode.", action="store_true")
-    args = parser.parse_args()
-
-    df = pd.read_csv(args.input_file,  header=[0, 1])
-    data = df.describe()
-    data_b = df.loc[df[("color", "color")] == "B"].describe()
-    data_w = df.loc[df[("color", "color")] == "W"].describe()
-    print(data)
-    # print(data.loc[("mean", "std"), ("<=90%", "match_rate")])
-    # print(data.loc[("mean", "std"), ("<=90%", "winrate_diff")])
-    # print(data.loc[("mean", "std"), ("<=90%", "score_diff")])
-    # print(data.loc[("mean", "std"), ("<=90%", "blunder")])
-
-    # print(data.loc[("mean", "std"), ("<=95%", "match_rate")])
-    # print(data.loc[("mean", "std"), ("<=95%", "winrate_diff")])
-    # print(data.loc[("mean", "std"), ("<=95%", "score_diff")])
-    # print(data.loc[("mean", "std"), ("<=95%", "blunder")])
-
-    # print(data.loc[("mean", "std"), ("<=98%", "match_rate")])
-    # print(data.loc[("mean", "std"), ("<=98%", "winrate_diff")])
-    # print(data.loc[("mean", "std"), ("<=98%", "score_diff")])
-    # print(data.loc[("mean", "std"), ("<=98%", "blunder")])
-
-    # print(data.loc[("mean", "std"), ("<=100%", "match_rate")])
-    # print(data.loc[("mean", "std"), ("<=100%", "winrate_diff")])
-    # print(data.loc[("mean", "std"), ("<=100%", "score_diff")])
-    # print(data.loc[("mean", "std"), ("<=100%", "blunder")])
-
-    winrate_thresholds = (1.0, 0.9, 0.95, 0.98)
-    columns = ("match_rate", "winrate_diff", "score_diff", "blunder")
+# Result CSV columns that are not averaged: the "k/n" match count, and match_visits, which the averages never had
+SKIPPED_COLUMNS = ("match", "match_visits")
+# Averaged columns of the default analyze.py metrics, assumed for state files written before columns were saved
+DEFAULT_COLUMNS = ("match_rate", "winrate_diff", "score_diff", "blunder")
+CHUNK_SIZE = 100000
+# Bytes just before the state's offset that are hashed to recognize the CSV it was read from
+IDENTITY_BYTES = 4096
+
+
+def merge_stats(a, b):
+    # Combine two (count, mean, M2) triples (Chan et al. parallel variance)
+    n = a[0] + b[0]
+    if n == 0:
+        return [0, 0.0, 0.0]
+    delta = b[1] - a[1]
+    mean = a[1] + delta * b[0] / n
+    m2 = a[2] + b[2] + delta * delta * a[0] * b[0] / n
+    return [n, mean, m2]
+
+
+def stats_mean(s):
+    return s[1] if s[0] > 0 else float("nan")
+
+
+def stats_std(s):
+    # Sample standard deviation, as pandas describe() reports it
+    return (s[2] / (s[0] - 1)) ** 0.5 if s[0] > 1 else float("nan")
+
+
+def last_line_end(f, block_size=65536):
+    # Offset just past the last newline of a binary file
+    pos = f.seek(0, os.SEEK_END)
+    while pos > 0:
+        start = max(0, pos - block_size)
+        f.seek(start)
+        block = f.read(pos - start)
+        i = block.rfind(b"\n")
+        if i >= 0:
+            return start + i + 1
+        pos = start
+    return 0
+
+
+def file_identity(f, offset):
+    # Device, inode and a hash of the last bytes before offset, so a CSV that was replaced (or rewritten in place)
+    # since the state was saved is not mistaken for the same one grown by appends
+    st = os.fstat(f.fileno())
+    start = max(0, offset - IDENTITY_BYTES)
+    f.seek(start)
+    return [st.st_dev, st.st_ino, hashlib.sha256(f.read(offset - start)).hexdigest()]
+
+
+def stat_columns(header):
+    # Averaged columns of a result CSV in header order, so CSVs written with other --metrics work too
+    return [c for c in dict.fromkeys(header[1][2:]) if c not in SKIPPED_COLUMNS]
+
+
+def column_names(header):
+    # "<threshold>|<label>" for the two header rows of a result CSV
+    names = [f"{top}|{label}" for top, label in zip(header[0], header[1])]
+    names[0], names[1] = "color", "name"
+    return names
+
+
+class RunningStats():
+    """Per (player, color, winrate threshold, column) count/mean/M2 of an analyze.py result CSV.
+
+    The state remembers how far into the CSV it has read, so rows appended later are added without
+    re-reading the rest of the file, and which file that was (see file_identity).
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.identity = None
+        self.thresholds = []
+        self.columns = list(DEFAULT_COLUMNS)
+        self.stats = {}
+
+    @staticmethod
+    def load(path):
+        rs = RunningStats()
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                d = json.load(f)
+            rs.offset = d["offset"]
+            rs.identity = d.get("identity")
+            rs.thresholds = d["thresholds"]
+            rs.columns = d.get("columns", list(DEFAULT_COLUMNS))
+            rs.stats = d["stats"]
+        return rs
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "offset": self.offset,
+                    "identity": self.identity,
+                    "thresholds": self.thresholds,
+                    "columns": self.columns,
+                    "stats": self.stats,
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+
+    def update(self, input_file):
+        with open(input_file, "rb") as f:
+            header = [next(csv.reader([f.readline().decode("utf-8")])), next(csv.reader([f.readline().decode("utf-8")]))]
+            thresholds = list(dict.fromkeys(header[0][2:]))
+            columns = stat_columns(header)
+            header_end = f.tell()
+            if (
+                self.offset == 0
+                or thresholds != self.thresholds
+                or columns != self.columns
+                or os.path.getsize(input_file) < self.offset
+                or file_identity(f, self.offset) != self.identity
+            ):
+                self.offset = header_end
+                self.thresholds = thresholds
+                self.columns = columns
+                self.stats = {}
+            # Only complete lines are consumed; a row still being written is picked up next time
+            end = last_line_end(f)
+            names = column_names(header)
+            f.seek(self.offset)
+            while f.tell() < end:
+                lines = []
+                while f.tell() < end and len(lines) < CHUNK_SIZE:
+                    lines.append(f.readline())
+                self._add_lines(lines, names)
+            self.offset = max(self.offset, end)
+            self.identity = file_identity(f, self.offset)
+
+    def add_rows(self, header, rows):
+        # Rows of a result CSV held in memory (header: its two header lines), e.g. from the igoadviser pipeline
+        header = [next(csv.reader([line])) for line in header.splitlines()[:2]]
+        thresholds = list(dict.fromkeys(header[0][2:]))
+        columns = stat_columns(header)
+        if thresholds != self.thresholds or columns != self.columns:
+            self.thresholds = thresholds
+            self.columns = columns
+            self.stats = {}
+        names = column_names(header)
+        for start in range(0, len(rows), CHUNK_SIZE):
+            self._add_lines([f"{row}\n".encode("utf-8") for row in rows[start : start + CHUNK_SIZE]], names)
+
+    def _add_lines(self, lines, names):
+        chunk = pd.read_csv(io.BytesIO(b"".join(lines)), header=None, names=names, na_values=["-"],
+                            keep_default_na=False, dtype={"name": str})
+        self._add_chunk(chunk)
+
+    def _add_chunk(self, chunk):
+        for (name, color), group in chunk.groupby(["name", "color"], sort=False):
+            player = self.stats.setdefault(f"{name}\t{color}", {})
+            for w in self.thresholds:
+                th = player.setdefault(w, {})
+                for c in self.columns:
+                    values = group[f"{w}|{c}"].dropna().astype(float)
+                    if values.empty:
+                        continue
+                    chunk_stats = [len(values), float(values.mean()), float(((values - values.mean()) ** 2).sum())]
+                    th[c] = merge_stats(th.get(c, [0, 0.0, 0.0]), chunk_stats)
+
+    def combined(self, color=None):
+        # {threshold: {column: stats}} over all players, optionally only one color
+        total = {}
+        for key, player in self.stats.items():
+            if color is not None and key.split("\t")[1] != color:
+                continue
+            for w, th in player.items():
+                for c, s in th.items():
+                    total.setdefault(w, {})
+                    total[w][c] = merge_stats(total[w].get(c, [0, 0.0, 0.0]), s)
+        return total
+
+
+def write_averages(rs, output_file, develop=False, by_player=False):
+    """Write <output>-all/-black/-white (and with by_player <output>-players) files of the running statistics."""
     data_str_list = ["all", "black", "white"]
-    data_list = [data, data_b, data_w]
+    data_list = [rs.combined(), rs.combined("B"), rs.combined("W")]
+    empty = [0, 0.0, 0.0]
 
+    file_path_tuple = os.path.splitext(output_file)
     for i, d in enumerate(data_list):
         content = ""
-        for w in winrate_thresholds:
+        for w in rs.thresholds:
             m_list = []
-            if args.develop:
+            if develop:
                 s_list = []
-            for c in columns:
-                m_list.append(str(round(d.loc["mean", (f"<={w:.0%}", c)], 3)))
-                if args.develop:
-                    s_list.append(str(round(d.loc["std", (f"<={w:.0%}", c)], 3)))
+            for c in rs.columns:
+                s = d.get(w, {}).get(c, empty)
+                m_list.append(str(round(stats_mean(s), 3)))
+                if develop:
+                    s_list.append(str(round(stats_std(s), 3)))
             content += "\t".join(m_list)
             content += "\n"
-            if args.develop:
+            if develop:
                 content += "\t".join(s_list)
                 content += "\n"
 
-        file_path_tuple = os.path.splitext(args.output_file)
         out_file_path = f"{file_path_tuple[0]}-{data_str_list[i]}{file_path_tuple[1]}"
         with open(out_file_path, "w", encoding="utf-8") as w:
             w.write(content)
 
+    if by_player:
+        lines = ["\t".join(["name", "color", "threshold", "n"] + [f"{c}_{m}" for c in rs.columns for m in ("mean", "std")])]
+        for key in sorted(rs.stats):
+            name, color = key.split("\t")
+            for w in rs.thresholds:
+                th = rs.stats[key].get(w, {})
+                n = max((s[0] for s in th.values()), default=0)
+                values = []
+                for c in rs.columns:
+                    s = th.get(c, empty)
+                    values += [str(round(stats_mean(s), 3)), str(round(stats_std(s), 3))]
+                lines.append("\t".join([name, color, w, str(n)] + values))
+        with open(f"{file_path_tuple[0]}-players{file_path_tuple[1]}", "w", encoding="utf-8") as w:
+            w.write("\n".join(lines) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", "-f", help="Input data file path.", required=True, type=str)
+    parser.add_argument("--output_file", "-o", help="Output file path.", required=True, type=str)
+    parser.add_argument("--develop", "-v", help="Developer mode.", action="store_true")
+    parser.add_argument("--state_file", "-s", help="Running statistics file (default: <input_file>.stats.json).", type=str)
+    parser.add_argument("--by_player", "-p", help="Also write per-player statistics.", action="store_true")
+    args = parser.parse_args(argv)
+
+    state_file = args.state_file or f"{args.input_file}.stats.json"
+    rs = RunningStats.load(state_file)
+    rs.update(args.input_file)
+    rs.save(state_file)
+    write_averages(rs, args.output_file, args.develop, args.by_player)
+
 if __name__ == "__main__":
     main()
@@ -1,6 +1,9 @@
 import argparse
+import os
 import pandas as pd
 
+from feature_store import read_features
+
 COLUMN_TYPE = ["現在の手数", "現在の手番", "実戦手", "実戦手の勝率", "実戦の手を打った場合、何目優勢か(マイナスは劣勢)", \
                "最善手", "最善手の勝率", "最善手を打った場合、何目優勢か(マイナスは劣勢)", "実戦手を打った後のAIの進行", \
                "最善手を打った後のAIの進行", "実戦手の代わりに最善手を打った場合、どの程度陣地が増加するか(マイナスは減少)", \
@@ -12,58 +15,73 @@ AREA_TYPE = ["左上", "上辺", "右上", "左辺", "中央", "右辺", "左下
 def convert_color(color):
     return "黒" if color == "B" else "白"
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input_file", "-f", help="Input CSV file path.", required=True, type=str)
-    parser.add_argument("--output_file", "-o", help="Output file path.", required=True, type=str)
-    parser.add_argument("--target_num", "-n", help="Target move number.", required=True, type=int)
-    args = parser.parse_args()
+PROMPT_COLUMNS = ["move_num", "color", "move", "winrate", "score_lead", "best_move", "best_winrate", "best_score_lead", \
+                  "pv", "best_pv", "best_ownership_diff", "best_ownership", "ownership"]
 
-    df = pd.read_csv(args.input_file)
-    target_data = df.loc[df["move_num"] == args.target_num]
+def as_list(value):
+    # CSV cells hold space-joined values, Parquet datasets hold real lists, empty CSV cells are NaN
+    if isinstance(value, str):
+        return value.split(" ")
+    if isinstance(value, float):
+        return []
+    return list(value)
 
-    data_list = []
-    move_num = target_data["move_num"].values[0].astype(str)
-    data_list.append(f"・{COLUMN_TYPE[0]}: {move_num}")
-    color = convert_color(target_data["color"].values[0])
-    data_list.append(f"・{COLUMN_TYPE[1]}: {color}")
-    move = target_data["move"].values[0]
-    data_list.append(f"・{COLUMN_TYPE[2]}: {move}")
-    winrate = format(target_data["winrate"].values[0] * 100, '.1f') + '%'
-    data_list.append(f"・{COLUMN_TYPE[3]}: {winrate}")
-    score_lead = format(target_data["score_lead"].values[0], '.1f')
-    data_list.append(f"・{COLUMN_TYPE[4]}: {score_lead}")
-    best_move = target_data["best_move"].values[0]
-    data_list.append(f"・{COLUMN_TYPE[5]}: {best_move}")
-    best_winrate = format(target_data["best_winrate"].values[0] * 100, '.1f') + '%'
-    data_list.append(f"・{COLUMN_TYPE[6]}: {best_winrate}")
-    best_score_lead = format(target_data["best_score_lead"].values[0], '.1f')
-    data_list.append(f"・{COLUMN_TYPE[7]}: {best_score_lead}")
+def format_percent(values):
+    # NaN (a played move the engine did not consider) is shown as "-"
+    return (values * 100).map(lambda x: "-" if pd.isna(x) else format(x, '.1f') + '%')
 
-    pv_list = target_data["pv"].str.split(" ").values.tolist()[0]
-    pv = ",".join(pv_list)
-    data_list.append(f"・{COLUMN_TYPE[8]}: {pv}")
-    best_pv_list = target_data["best_pv"].str.split(" ").values.tolist()[0]
-    best_pv = ",".join(best_pv_list)
-    data_list.append(f"・{COLUMN_TYPE[9]}: {best_pv}")
+def format_float(values):
+    return values.map(lambda x: "-" if pd.isna(x) else format(x, '.1f'))
 
-    data_list.append(f"・{COLUMN_TYPE[10]}")
-    best_ownership_diff_list = target_data["best_ownership_diff"].str.split(" ").values.tolist()[0]
-    for i, bod in enumerate(best_ownership_diff_list):
-        data_list.append(f"- {AREA_TYPE[i]}: {bod}")
+def format_regions(values):
+    # "- 左上: 12.3" lines for every region, one block per row
+    items = values.map(as_list).explode().dropna()
+    if items.empty:
+        return pd.Series("", index=values.index)
+    pos = items.groupby(level=0).cumcount()
+    names = pos.map(lambda i: AREA_TYPE[i] if i < len(AREA_TYPE) else str(i + 1))
+    lines = "- " + names + ": " + items.astype(str)
+    return lines.groupby(level=0).agg("\n".join).reindex(values.index, fill_value="")
 
-    data_list.append(f"・{COLUMN_TYPE[11]}")
-    best_ownership_list = target_data["best_ownership"].str.split(" ").values.tolist()[0]
-    for i, bo in enumerate(best_ownership_list):
-        data_list.append(f"- {AREA_TYPE[i]}: {bo}")
+def build_prompts(df):
+    """Render the prompt of every row of a feature table at once. Returns a Series aligned with df."""
+    parts = [
+        f"・{COLUMN_TYPE[0]}: " + df["move_num"].astype(str),
+        f"・{COLUMN_TYPE[1]}: " + df["color"].map(convert_color),
+        f"・{COLUMN_TYPE[2]}: " + df["move"].astype(str),
+        f"・{COLUMN_TYPE[3]}: " + format_percent(df["winrate"]),
+        f"・{COLUMN_TYPE[4]}: " + format_float(df["score_lead"]),
+        f"・{COLUMN_TYPE[5]}: " + df["best_move"].astype(str),
+        f"・{COLUMN_TYPE[6]}: " + format_percent(df["best_winrate"]),
+        f"・{COLUMN_TYPE[7]}: " + format_float(df["best_score_lead"]),
+        f"・{COLUMN_TYPE[8]}: " + df["pv"].map(lambda v: ",".join(as_list(v))),
+        f"・{COLUMN_TYPE[9]}: " + df["best_pv"].map(lambda v: ",".join(as_list(v))),
+    ]
+    prompts = parts[0]
+    for part in parts[1:]:
+        prompts = prompts + "\n" + part
+    for i, column in ((10, "best_ownership_diff"), (11, "best_ownership"), (12, "ownership")):
+        regions = format_regions(df[column])
+        prompts = prompts + f"\n・{COLUMN_TYPE[i]}" + regions.map(lambda r: "\n" + r if r else "")
+    return prompts
 
-    data_list.append(f"・{COLUMN_TYPE[12]}")
-    ownership_list = target_data["ownership"].str.split(" ").values.tolist()[0]
-    for i, o in enumerate(ownership_list):
-        data_list.append(f"- {AREA_TYPE[i]}: {o}")
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", "-f", help="Input CSV file or Parquet dataset directory path.", required=True, type=str)
+    parser.add_argument("--output_file", "-o", help="Output file path.", required=True, type=str)
+    parser.add_argument("--target_num", "-n", help="Target move number.", required=True, type=int)
+    parser.add_argument("--game", "-g", help="Target game name (Parquet dataset only).", type=str)
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.input_file):
+        games = [args.game] if args.game is not None else None
+        df = read_features(args.input_file, columns=PROMPT_COLUMNS, games=games, move_range=(args.target_num, args.target_num))
+    else:
+        df = pd.read_csv(args.input_file)
+    target_data = df.loc[df["move_num"] == args.target_num]
 
     with open(args.output_file, "w", encoding="utf-8") as w:
-        w.write("\n".join(data_list))
+        w.write(build_prompts(target_data.head(1)).iloc[0])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,40 +1,27 @@
 import argparse
 import pandas as pd
 
+from chatgpt_prompt_generator import format_float
+
 COLUMN_TYPE = ["現在の手数", "現在の手番", "実戦手", "実戦手の勝率", "実戦の手を打った場合、何目優勢か(マイナスは劣勢)", \
                "最善手", "最善手の勝率", "最善手を打った場合、何目優勢か(マイナスは劣勢)"]
 
 def convert_color(color):
     return "黒" if color == "B" else "白"
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_file", "-f", help="Input CSV file path.", required=True, type=str)
     parser.add_argument("--output_file", "-o", help="Output file path.", required=True, type=str)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     df = pd.read_csv(args.input_file)
 
-    overall_data_list = []
-    for row in df.itertuples():
-        data_list = []
-        move_num = str(row.move_num)
-        data_list.append(move_num)
-        color = row.color
-        data_list.append(color)
-        move = row.move
-        data_list.append(move)
-        winrate = format(row.winrate * 100, '.1f')
-        data_list.append(winrate)
-        score_lead = format(row.score_lead, '.1f')
-        data_list.append(score_lead)
-        best_move = row.best_move
-        data_list.append(best_move)
-        best_winrate = format(row.best_winrate * 100, '.1f')
-        data_list.append(best_winrate)
-        best_score_lead = format(row.best_score_lead, '.1f')
-        data_list.append(best_score_lead)
-        overall_data_list.append(",".join(data_list))
+    lines = df["move_num"].astype(str)
+    for part in [df["color"], df["move"], format_float(df["winrate"] * 100), format_float(df["score_lead"]), \
+                 df["best_move"], format_float(df["best_winrate"] * 100), format_float(df["best_score_lead"])]:
+        lines = lines + "," + part.astype(str)
+    overall_data_list = lines.tolist()
 
     with open(args.output_file, "w", encoding="utf-8") as w:
         w.write("\n".join(overall_data_list))
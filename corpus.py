@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import argparse
+import glob
+import mmap
+import os
+import struct
+import sys
+from collections.abc import Mapping, MutableMapping
+from typing import Iterator, Optional
+
+from game_data import GameData
+from go_board import IllegalMoveError, gtp_to_point, point_to_gtp
+
+# Layout (little-endian):
+#   header   MAGIC, num_games (u32), then offsets of the game table, move array and string table (u64 each)
+#   games    one GAME_RECORD per game
+#   moves    int16 codes, initial stones followed by moves for each game
+#   strings  UTF-8 blob referenced by (offset, length) pairs in the game records
+MAGIC = b"IGOCORP1"
+HEADER = struct.Struct("<8sIQQQ")
+# stones_start, num_initial_stones, num_moves, board_x_size, board_y_size, komi,
+# (offset, length) of name, rules, player_black, player_white
+GAME_RECORD = struct.Struct("<QIIBBd8I")
+WHITE_FLAG = 0x200
+PASS_CODE = 0x1FF
+
+
+def encode_move(player: str, move: str, board_x_size: int, board_y_size: int) -> int:
+    point = gtp_to_point(move, board_x_size, board_y_size)
+    code = PASS_CODE if point is None else point
+    return code | WHITE_FLAG if player == "W" else code
+
+
+def decode_move(code: int, board_x_size: int, board_y_size: int) -> list[str]:
+    player = "W" if code & WHITE_FLAG else "B"
+    point = code & ~WHITE_FLAG
+    return [player, point_to_gtp(None if point == PASS_CODE else point, board_x_size, board_y_size)]
+
+
+def compile_corpus(game_data_dict: dict[str, GameData], filename: str) -> None:
+    """Write games to a packed corpus file that Corpus can open without any SGF parsing."""
+    records = bytearray()
+    moves = bytearray()
+    strings = bytearray()
+    num_codes = 0
+
+    def add_string(s: str) -> tuple[int, int]:
+        b = s.encode("utf-8")
+        offset = len(strings)
+        strings.extend(b)
+        return offset, len(b)
+
+    for name, game_data in game_data_dict.items():
+        bx, by = game_data.board_x_size, game_data.board_y_size
+        codes = [encode_move(p, m, bx, by) for p, m in game_data.initial_stones]
+        codes += [encode_move(p, m, bx, by) for p, m in game_data.moves]
+        moves.extend(struct.pack(f"<{len(codes)}h", *codes))
+        records.extend(
+            GAME_RECORD.pack(
+                num_codes,
+                len(game_data.initial_stones),
+                len(game_data.moves),
+                bx,
+                by,
+                game_data.komi,
+                *add_string(name),
+                *add_string(game_data.rules),
+                *add_string(game_data.player_black),
+                *add_string(game_data.player_white),
+            )
+        )
+        num_codes += len(codes)
+
+    games_offset = HEADER.size
+    moves_offset = games_offset + len(records)
+    strings_offset = moves_offset + len(moves)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(game_data_dict), games_offset, moves_offset, strings_offset))
+        f.write(records)
+        f.write(moves)
+        f.write(strings)
+    os.replace(tmp_filename, filename)
+
+
+class Corpus(Mapping[str, GameData]):
+    """Read-only, memory-mapped view of a compiled corpus. Games are decoded only when accessed."""
+
+    def __init__(self, filename: str) -> None:
+        self._file = open(filename, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._num_games, self._games_offset, self._moves_offset, self._strings_offset = HEADER.unpack_from(
+            self._mm, 0
+        )
+        assert magic == MAGIC, f"{filename} is not a compiled corpus"
+        self._index: Optional[dict[str, int]] = None
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
+
+    def __len__(self) -> int:
+        return self._num_games
+
+    def _record(self, i: int) -> tuple:
+        return GAME_RECORD.unpack_from(self._mm, self._games_offset + i * GAME_RECORD.size)
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self._strings_offset + offset
+        return self._mm[start : start + length].decode("utf-8")
+
+    def name(self, i: int) -> str:
+        record = self._record(i)
+        return self._string(record[6], record[7])
+
+    def __iter__(self) -> Iterator[str]:
+        return (self.name(i) for i in range(self._num_games))
+
+    def __getitem__(self, name: str) -> GameData:
+        if self._index is None:
+            self._index = dict((n, i) for i, n in enumerate(self))
+        return self.game(self._index[name])
+
+    def game(self, i: int) -> GameData:
+        stones_start, num_initial, num_moves, bx, by, komi, *strs = self._record(i)
+        codes = struct.unpack_from(f"<{num_initial + num_moves}h", self._mm, self._moves_offset + stones_start * 2)
+        initial_stones = [decode_move(c, bx, by) for c in codes[:num_initial]]
+        moves = [decode_move(c, bx, by) for c in codes[num_initial:]]
+        rules, player_black, player_white = (self._string(strs[j], strs[j + 1]) for j in (2, 4, 6))
+        return GameData(bx, by, komi, rules, initial_stones, moves, player_black, player_white)
+
+    def items(self) -> Iterator[tuple[str, GameData]]:  # type: ignore[override]
+        return ((self.name(i), self.game(i)) for i in range(self._num_games))
+
+
+class CorpusGames(MutableMapping[str, GameData]):
+    """The games of an open Corpus as a mutable mapping that still decodes each game only when it is accessed.
+
+    Deleting a game (e.g. drop_illegal_games) only removes its name, and overrides (GameData attribute values such
+    as komi or rules) are applied to every game as it is decoded, since changes to a returned GameData are lost.
+    """
+
+    def __init__(self, corpus: Corpus, overrides: Optional[dict[str, object]] = None) -> None:
+        self.corpus = corpus
+        self.overrides = overrides if overrides is not None else dict()
+        self._index = dict((name, i) for i, name in enumerate(corpus))
+        self._added: dict[str, GameData] = dict()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __getitem__(self, name: str) -> GameData:
+        i = self._index[name]
+        game_data = self._added[name] if i < 0 else self.corpus.game(i)
+        for attr, value in self.overrides.items():
+            setattr(game_data, attr, value)
+        return game_data
+
+    def __setitem__(self, name: str, game_data: GameData) -> None:
+        self._index[name] = -1
+        self._added[name] = game_data
+
+    def __delitem__(self, name: str) -> None:
+        del self._index[name]
+        self._added.pop(name, None)
+
+    def close(self) -> None:
+        self.corpus.close()
+
+
+def load_games(
+    sgf_dir: Optional[str] = None, corpus_file: Optional[str] = None, overrides: Optional[dict[str, object]] = None
+) -> MutableMapping[str, GameData]:
+    """Load games keyed by SGF file name, either from a compiled corpus or by parsing every SGF in a directory.
+
+    A corpus is kept open and its games are decoded on access (see CorpusGames). overrides sets GameData attributes
+    (e.g. {"komi": 7.5}) of every game.
+    """
+    if corpus_file is not None:
+        return CorpusGames(Corpus(corpus_file), overrides)
+    assert sgf_dir is not None
+    game_data_dict: dict[str, GameData] = dict()
+    for sgf_file in sorted(glob.glob(f"{os.path.abspath(sgf_dir)}/*.sgf")):
+        sgf_name = os.path.basename(sgf_file).replace(".sgf", "")
+        game_data = GameData.from_sgf(sgf_file)
+        for attr, value in (overrides or dict()).items():
+            setattr(game_data, attr, value)
+        game_data_dict[sgf_name] = game_data
+    return game_data_dict
+
+
+def drop_illegal_games(game_data_dict: MutableMapping[str, GameData]) -> list[str]:
+    """Remove the games that fail GameData.validate from game_data_dict and return their names."""
+    dropped = []
+    for name in sorted(game_data_dict.keys()):
+        try:
+            game_data_dict[name].validate()
+        except IllegalMoveError as e:
+            print(f"Skipping {name}: {e}", file=sys.stderr)
+            del game_data_dict[name]
+            dropped.append(name)
+    return dropped
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compile a directory of SGFs into a packed corpus file.")
+    parser.add_argument("-s", "--sgf_dir", required=True, help="SGF directory path.")
+    parser.add_argument("-o", "--output", required=True, help="Output corpus file path.")
+    args = parser.parse_args(argv)
+
+    game_data_dict: dict[str, GameData] = dict()
+    for sgf_file in sorted(glob.glob(f"{os.path.abspath(args.sgf_dir)}/*.sgf")):
+        sgf_name = os.path.basename(sgf_file).replace(".sgf", "")
+        try:
+            game_data = GameData.from_sgf(sgf_file)
+            game_data.validate()
+        except AssertionError:
+            print(f"Skip invalid SGF: {sgf_file}")
+            continue
+        except IllegalMoveError as e:
+            print(f"Skip invalid SGF: {sgf_file} ({e})")
+            continue
+        game_data_dict[sgf_name] = game_data
+
+    compile_corpus(game_data_dict, args.output)
+    print(f"{len(game_data_dict)} games written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
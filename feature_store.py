@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import os
+from typing import Optional, Sequence
+
+from go_board import MOVE_FEATURES
+
+# Columnar storage of the per-move features written by prompt_data_generator.py.
+#
+# A dataset is a directory of Parquet files partitioned by game (<dataset_dir>/game=<name>/part-0.parquet).
+# Lists (ownership, PVs) are stored as real list columns, so readers do not have to split strings, and
+# readers can load only the columns, games and move_num range they need. pyarrow is only required when
+# this format is used. Tables written with --board_features also have int16 go_board.MOVE_FEATURES columns.
+
+
+def _schema(board_features: bool = False):
+    import pyarrow as pa
+
+    move = pa.dictionary(pa.int16(), pa.string())
+    return pa.schema(
+        [
+            ("move_num", pa.int32()),
+            ("color", move),
+            ("move", move),
+            ("winrate", pa.float64()),
+            ("score_lead", pa.float64()),
+            ("ownership", pa.list_(pa.float64())),
+            ("ownership_diff", pa.list_(pa.float64())),
+            ("pv", pa.list_(pa.string())),
+            ("best_move", move),
+            ("best_winrate", pa.float64()),
+            ("best_score_lead", pa.float64()),
+            ("best_ownership", pa.list_(pa.float64())),
+            ("best_ownership_diff", pa.list_(pa.float64())),
+            ("best_pv", pa.list_(pa.string())),
+        ]
+        + ([(name, pa.int16()) for name in MOVE_FEATURES] if board_features else [])
+    )
+
+
+def write_game_features(features: dict[str, list], game_name: str, dataset_dir: str) -> None:
+    """Write (or replace) the feature table of one game."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _schema(all(name in features for name in MOVE_FEATURES))
+    table = pa.Table.from_pydict(dict((name, features[name]) for name in schema.names), schema=schema)
+    game_dir = os.path.join(dataset_dir, f"game={game_name}")
+    os.makedirs(game_dir, exist_ok=True)
+    tmp_path = os.path.join(game_dir, ".part-0.parquet.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, os.path.join(game_dir, "part-0.parquet"))
+
+
+def read_features(
+    dataset_dir: str,
+    columns: Optional[Sequence[str]] = None,
+    games: Optional[Sequence[str]] = None,
+    move_range: Optional[tuple[int, int]] = None,
+):
+    """Load features as a pandas DataFrame with a "game" column.
+
+    Only the requested columns are read, games are pruned by partition, and move_range (inclusive) is
+    pushed down to the Parquet row groups.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(pa.schema([("game", pa.string())]), flavor="hive")
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning=partitioning)
+    expr = None
+    if games is not None:
+        expr = ds.field("game").isin(list(games))
+    if move_range is not None:
+        move_expr = (ds.field("move_num") >= move_range[0]) & (ds.field("move_num") <= move_range[1])
+        expr = move_expr if expr is None else expr & move_expr
+    if columns is not None:
+        columns = ["game"] + [c for c in columns if c != "game"]
+    table = dataset.to_table(columns=columns, filter=expr)
+    df = table.to_pandas()
+    for name in ("game", "color", "move", "best_move"):
+        if name in df.columns:
+            df[name] = df[name].astype(str)
+    sort_columns = ["game", "move_num"] if "move_num" in df.columns else ["game"]
+    return df.sort_values(sort_columns, kind="stable").reset_index(drop=True)
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import json
+from typing import Optional
+
+from pysgf import SGF, SGFNode
+
+from go_board import validate_game
+
+SUPPORTED_RULES = (
+    "tromp-taylor",
+    "chinese",
+    "chinese-ogs",
+    "chinese-kgs",
+    "japanese",
+    "korean",
+    "stone-scoring",
+    "aga",
+    "bga",
+    "new-zealand",
+    "aga-button",
+)
+
+
+class GameData:
+    def __init__(
+        self,
+        board_x_size: int,
+        board_y_size: int,
+        komi: float,
+        rules: str,
+        initial_stones: list[list[str]],
+        moves: list[list[str]],
+        player_black: str,
+        player_white: str,
+    ) -> None:
+        self.board_x_size = board_x_size
+        self.board_y_size = board_y_size
+        self.komi = komi
+        self.rules = rules
+        self.initial_stones = initial_stones
+        self.moves = moves
+        self.player_black = player_black
+        self.player_white = player_white
+
+    @staticmethod
+    def from_sgf(filename: str) -> GameData:
+        return GameData.from_sgf_root(SGF.parse_file(filename, "utf-8"), filename)
+
+    @staticmethod
+    def from_sgf_string(sgf: str, name: str = "<string>") -> GameData:
+        return GameData.from_sgf_root(SGF.parse_sgf(sgf), name)
+
+    @staticmethod
+    def from_sgf_root(root: SGFNode, filename: str) -> GameData:
+        assert root.get_property("SZ") is not None
+        bx, by = root.board_size
+        assert 0 <= bx <= 19 and 0 <= by <= 19
+
+        if root.get_property("KM") is None:
+            print(f"No KM property in {filename}")
+        if root.komi == 375:
+            print("Interpret komi 375 as 7.5")
+            root.set_property("KM", 7.5)
+
+        if root.get_property("RU") is None:
+            print(f"No RU property in {filename}")
+            if root.komi == 6.5:
+                root.set_property("RU", "japanese")
+            elif root.komi == 7.5:
+                root.set_property("RU", "chinese")
+
+        initial_stones = [[m.player, m.gtp()] for m in root.move_with_placements if not m.is_pass]
+
+        nodes = [root]
+        node = root
+        while node.children:
+            assert len(node.children) == 1
+            node = node.children[0]
+            nodes.append(node)
+        assert isinstance(node, SGFNode)
+        assert node.nodes_from_root == nodes
+        moves: list[list[str]] = []
+        prev_player = ""
+        for node in nodes[1:]:
+            assert node.move is not None
+            m = node.move
+            if m.player == prev_player:
+                moves.append([m.PLAYERS.replace(m.player, ""), "pass"])
+            moves.append([m.player, m.gtp()])
+            prev_player = m.player
+        while moves and moves[-1][1].lower() == "pass":
+            moves.pop()
+        assert moves
+
+        player_black = "player_1"
+        if root.get_property("PB") is not None:
+            player_black = root.get_property("PB")
+        player_white = "player_2"
+        if root.get_property("PW") is not None:
+            player_white = root.get_property("PW")
+
+        return GameData(bx, by, root.komi, root.ruleset, initial_stones, moves, player_black, player_white)
+
+    def validate(self) -> None:
+        """Replay the game and raise go_board.IllegalMoveError at its first bad coordinate or illegal move."""
+        validate_game(self.board_x_size, self.board_y_size, self.initial_stones, self.moves, self.rules)
+
+    def to_query(self, id_: str, max_visits: Optional[int] = None, ownership: Optional[bool] = None) -> str:
+        return json.dumps(self.to_query_dict(id_, max_visits, ownership))
+
+    def to_query_dict(self, id_: str, max_visits: Optional[int] = None, ownership: Optional[bool] = None) -> dict:
+        assert 1 <= self.board_x_size <= 19 and 1 <= self.board_y_size <= 19
+        assert abs(self.komi) <= 150
+        assert self.komi * 10 % 5 == 0
+        assert self.rules.lower() in SUPPORTED_RULES
+
+        query_dict = {
+            "id": f"{id_}",
+            "boardXSize": self.board_x_size,
+            "boardYSize": self.board_y_size,
+            "komi": self.komi,
+            "rules": self.rules,
+            "initialStones": self.initial_stones,
+            "moves": self.moves,
+            "analyzeTurns": list(range(len(self.moves) + 1)),
+        }
+        if max_visits is not None:
+            assert max_visits >= 1
+            query_dict["maxVisits"] = max_visits
+        if ownership is not None:
+            query_dict["includeMovesOwnership"] = ownership
+
+        return query_dict
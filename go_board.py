@@ -0,0 +1,375 @@
+from __future__ import annotations
+
+import functools
+import random
+from typing import Optional
+
+GTP_COLUMNS = "ABCDEFGHJKLMNOPQRST"
+
+EMPTY = 0
+BLACK = 1
+WHITE = 2
+COLORS = {"B": BLACK, "W": WHITE}
+
+# (swap_xy, flip_x, flip_y); the transposing ones are only valid on square boards.
+SYMMETRIES = [(swap, fx, fy) for swap in (False, True) for fx in (False, True) for fy in (False, True)]
+
+_ZOBRIST_RNG = random.Random(20230401)
+ZOBRIST = [[_ZOBRIST_RNG.getrandbits(64) for _ in range(19 * 19)] for _ in range(3)]
+ZOBRIST_WHITE_TO_MOVE = _ZOBRIST_RNG.getrandbits(64)
+ZOBRIST_KO = [_ZOBRIST_RNG.getrandbits(64) for _ in range(19 * 19)]
+
+
+# Width of the corner/edge bands of the default 3x3 regions (5 lines on 19x19).
+def edge_band_width(size: int) -> int:
+    return (size * 5 + 9) // 19
+
+
+def board_region(point: int, board_x_size: int, board_y_size: int) -> int:
+    """Index of the 3x3 region (corners, edges and center, top-left to bottom-right) that contains point."""
+
+    def band(v: int, size: int) -> int:
+        w = edge_band_width(size)
+        return 0 if v < w else (2 if v >= size - w else 1)
+
+    y, x = divmod(point, board_x_size)
+    return band(y, board_y_size) * 3 + band(x, board_x_size)
+
+
+def gtp_to_point(move: str, board_x_size: int, board_y_size: int) -> Optional[int]:
+    """Convert a GTP coordinate to a point index (row-major from the top-left, as in KataGo ownership). None for pass."""
+    if move.lower() == "pass":
+        return None
+    x = GTP_COLUMNS.index(move[0].upper())
+    y = board_y_size - int(move[1:])
+    assert 0 <= x < board_x_size and 0 <= y < board_y_size, move
+    return y * board_x_size + x
+
+
+def point_to_gtp(point: Optional[int], board_x_size: int, board_y_size: int) -> str:
+    if point is None:
+        return "pass"
+    y, x = divmod(point, board_x_size)
+    return f"{GTP_COLUMNS[x]}{board_y_size - y}"
+
+
+def num_symmetries(board_x_size: int, board_y_size: int) -> int:
+    return 8 if board_x_size == board_y_size else 4
+
+
+def transform_point(point: int, sym: int, board_x_size: int, board_y_size: int) -> int:
+    swap, fx, fy = SYMMETRIES[sym]
+    y, x = divmod(point, board_x_size)
+    if fx:
+        x = board_x_size - 1 - x
+    if fy:
+        y = board_y_size - 1 - y
+    if swap:
+        x, y = y, x
+    return y * board_x_size + x
+
+
+def inverse_symmetry(sym: int) -> int:
+    swap, fx, fy = SYMMETRIES[sym]
+    if not swap:
+        return sym
+    return SYMMETRIES.index((swap, fy, fx))
+
+
+def transform_gtp(move: str, sym: int, board_x_size: int, board_y_size: int) -> str:
+    point = gtp_to_point(move, board_x_size, board_y_size)
+    if point is None:
+        return move
+    return point_to_gtp(transform_point(point, sym, board_x_size, board_y_size), board_x_size, board_y_size)
+
+
+# Rules under which KataGo allows a move that captures its own group of two or more stones. Single-stone suicide is
+# illegal under every rule set.
+MULTI_STONE_SUICIDE_RULES = ("tromp-taylor", "new-zealand")
+
+# Columns returned by move_features
+MOVE_FEATURES = ("region", "line", "captures", "liberties", "ataris")
+
+
+class IllegalMoveError(ValueError):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def _gtp_points(board_x_size: int, board_y_size: int) -> dict[str, Optional[int]]:
+    points: dict[str, Optional[int]] = dict(
+        (point_to_gtp(p, board_x_size, board_y_size), p) for p in range(board_x_size * board_y_size)
+    )
+    points["PASS"] = None
+    return points
+
+
+def parse_move(move: str, board_x_size: int, board_y_size: int) -> Optional[int]:
+    """gtp_to_point that raises IllegalMoveError for a malformed or off-board coordinate."""
+    try:
+        return _gtp_points(board_x_size, board_y_size)[move.upper()]
+    except KeyError:
+        raise IllegalMoveError(f"bad coordinate {move}") from None
+
+
+@functools.lru_cache(maxsize=None)
+def _neighbor_table(board_x_size: int, board_y_size: int) -> tuple[tuple[int, ...], ...]:
+    neighbors = []
+    for p in range(board_x_size * board_y_size):
+        y, x = divmod(p, board_x_size)
+        n = []
+        if x > 0:
+            n.append(p - 1)
+        if x < board_x_size - 1:
+            n.append(p + 1)
+        if y > 0:
+            n.append(p - board_x_size)
+        if y < board_y_size - 1:
+            n.append(p + board_x_size)
+        neighbors.append(tuple(n))
+    return tuple(neighbors)
+
+
+@functools.lru_cache(maxsize=None)
+def _symmetry_table(board_x_size: int, board_y_size: int) -> tuple[tuple[int, ...], ...]:
+    return tuple(
+        tuple(transform_point(p, s, board_x_size, board_y_size) for p in range(board_x_size * board_y_size))
+        for s in range(num_symmetries(board_x_size, board_y_size))
+    )
+
+
+class Board:
+    """Board with captures and simple ko, optionally keeping a Zobrist hash for every symmetry of the position.
+
+    Chains are tracked incrementally: every stone points to the head of its chain, and each head holds the chain's
+    stones and liberties, so a move only touches its neighboring chains instead of flood-filling the board.
+    """
+
+    def __init__(self, board_x_size: int, board_y_size: int, track_hashes: bool = True) -> None:
+        assert 1 <= board_x_size <= 19 and 1 <= board_y_size <= 19
+        self.board_x_size = board_x_size
+        self.board_y_size = board_y_size
+        num_points = board_x_size * board_y_size
+        self.stones = [EMPTY] * num_points
+        self.ko_point: Optional[int] = None
+        # color that may not play at ko_point on the next move
+        self.ko_color = EMPTY
+        self.neighbors = _neighbor_table(board_x_size, board_y_size)
+        self.num_syms = num_symmetries(board_x_size, board_y_size) if track_hashes else 0
+        self.sym_points = _symmetry_table(board_x_size, board_y_size) if track_hashes else ()
+        self.hashes = [0] * self.num_syms
+        self._head = [-1] * num_points
+        self._chain_stones: list[list[int]] = [[] for _ in range(num_points)]
+        self._chain_liberties: list[set[int]] = [set() for _ in range(num_points)]
+
+    def _set(self, point: int, color: int) -> None:
+        old = self.stones[point]
+        for s in range(self.num_syms):
+            q = self.sym_points[s][point]
+            if old != EMPTY:
+                self.hashes[s] ^= ZOBRIST[old][q]
+            if color != EMPTY:
+                self.hashes[s] ^= ZOBRIST[color][q]
+        self.stones[point] = color
+
+    def _add_stone(self, point: int, color: int) -> int:
+        """Put a stone, merging it with its own chains and taking the liberty from the others. Return its chain head."""
+        self._set(point, color)
+        stones = self.stones
+        head = point
+        self._head[point] = point
+        self._chain_stones[point] = [point]
+        neighbors = self.neighbors[point]
+        self._chain_liberties[point] = set(n for n in neighbors if stones[n] == EMPTY)
+        for n in neighbors:
+            c = stones[n]
+            if c == EMPTY:
+                continue
+            other = self._head[n]
+            self._chain_liberties[other].discard(point)
+            if c == color and other != head:
+                # merge the smaller chain into the larger one
+                if len(self._chain_stones[other]) > len(self._chain_stones[head]):
+                    head, other = other, head
+                for p in self._chain_stones[other]:
+                    self._head[p] = head
+                self._chain_stones[head].extend(self._chain_stones[other])
+                self._chain_liberties[head] |= self._chain_liberties[other]
+        return head
+
+    def _remove_chain(self, head: int) -> list[int]:
+        removed = self._chain_stones[head]
+        for p in removed:
+            self._set(p, EMPTY)
+            self._head[p] = -1
+        for p in removed:
+            for n in self.neighbors[p]:
+                if self.stones[n] != EMPTY:
+                    self._chain_liberties[self._head[n]].add(p)
+        return removed
+
+    def group_and_liberties(self, point: int) -> tuple[list[int], set[int]]:
+        head = self._head[point]
+        return list(self._chain_stones[head]), set(self._chain_liberties[head])
+
+    def chain_head(self, point: int) -> int:
+        """A point that identifies the chain of the stone at point (-1 if empty)."""
+        return self._head[point]
+
+    def num_liberties(self, point: int) -> int:
+        return len(self._chain_liberties[self._head[point]])
+
+    def place(self, player: str, point: int) -> None:
+        """Put a setup stone without capture checks."""
+        old = self.stones[point]
+        if old != EMPTY:
+            # replacing a stone may split its chain; rebuild the chain from its other stones
+            rest = [p for p in self._remove_chain(self._head[point]) if p != point]
+            for p in rest:
+                self._add_stone(p, old)
+        self._add_stone(point, COLORS[player])
+
+    def play(self, player: str, point: Optional[int]) -> int:
+        """Play a move and return the number of captured stones."""
+        self.ko_point = None
+        if point is None:
+            return 0
+        color = COLORS[player]
+        opponent = BLACK + WHITE - color
+        self._add_stone(point, color)
+        captured: list[int] = []
+        for n in self.neighbors[point]:
+            if self.stones[n] == opponent and not self._chain_liberties[self._head[n]]:
+                captured.extend(self._remove_chain(self._head[n]))
+        head = self._head[point]
+        if not self._chain_liberties[head]:
+            self._remove_chain(head)
+        elif len(captured) == 1 and len(self._chain_stones[head]) == 1 and len(self._chain_liberties[head]) == 1:
+            self.ko_point = captured[0]
+            self.ko_color = opponent
+        return len(captured)
+
+    def illegal_reason(self, player: str, point: Optional[int], multi_stone_suicide: bool = False) -> Optional[str]:
+        """Why playing point would be illegal (occupied point, ko or suicide), or None for a legal move."""
+        if point is None:
+            return None
+        if self.stones[point] != EMPTY:
+            return "point is occupied"
+        color = COLORS[player]
+        if point == self.ko_point and color == self.ko_color:
+            return "retakes a ko"
+        own_chain = False
+        for n in self.neighbors[point]:
+            c = self.stones[n]
+            if c == EMPTY:
+                return None
+            num_liberties = len(self._chain_liberties[self._head[n]])
+            if c == color:
+                if num_liberties > 1:
+                    return None
+                own_chain = True
+            elif num_liberties == 1:
+                return None
+        if own_chain and multi_stone_suicide:
+            return None
+        return "suicide"
+
+    def canonical_hash(self, player_to_move: str) -> tuple[int, int]:
+        """Return (hash, symmetry) where hash is the smallest over all board symmetries and symmetry maps this position onto it."""
+        assert self.num_syms > 0
+        best: Optional[tuple[int, int]] = None
+        for s in range(self.num_syms):
+            h = self.hashes[s]
+            if player_to_move == "W":
+                h ^= ZOBRIST_WHITE_TO_MOVE
+            if self.ko_point is not None:
+                h ^= ZOBRIST_KO[self.sym_points[s][self.ko_point]]
+            if best is None or h < best[0]:
+                best = (h, s)
+        assert best is not None
+        return best
+
+
+def position_hashes(
+    board_x_size: int, board_y_size: int, initial_stones: list[list[str]], moves: list[list[str]], max_turns: int
+) -> list[tuple[int, int]]:
+    """Canonical (hash, symmetry) of the position before each of the first max_turns turns."""
+    board = Board(board_x_size, board_y_size)
+    for player, move in initial_stones:
+        point = gtp_to_point(move, board_x_size, board_y_size)
+        if point is not None:
+            board.place(player, point)
+    hashes = []
+    for turn in range(min(max_turns, len(moves) + 1)):
+        if turn < len(moves):
+            player_to_move = moves[turn][0]
+        else:
+            player_to_move = "B" if moves[-1][0] == "W" else "W"
+        hashes.append(board.canonical_hash(player_to_move))
+        if turn < len(moves):
+            player, move = moves[turn]
+            board.play(player, gtp_to_point(move, board_x_size, board_y_size))
+    return hashes
+
+
+def validate_game(
+    board_x_size: int, board_y_size: int, initial_stones: list[list[str]], moves: list[list[str]], rules: str
+) -> None:
+    """Replay a game and raise IllegalMoveError at its first bad coordinate or illegal move."""
+    if not (1 <= board_x_size <= 19 and 1 <= board_y_size <= 19):
+        raise IllegalMoveError(f"unsupported board size {board_x_size}x{board_y_size}")
+    board = Board(board_x_size, board_y_size, track_hashes=False)
+    for player, move in initial_stones:
+        if player not in COLORS:
+            raise IllegalMoveError(f"setup stone {move} has no color")
+        point = parse_move(move, board_x_size, board_y_size)
+        if point is not None:
+            board.place(player, point)
+    multi_stone_suicide = rules.lower() in MULTI_STONE_SUICIDE_RULES
+    for turn, (player, move) in enumerate(moves):
+        if player not in COLORS:
+            raise IllegalMoveError(f"move {turn + 1}: {move} has no color")
+        try:
+            point = parse_move(move, board_x_size, board_y_size)
+        except IllegalMoveError as e:
+            raise IllegalMoveError(f"move {turn + 1}: {e}") from None
+        reason = board.illegal_reason(player, point, multi_stone_suicide)
+        if reason is not None:
+            raise IllegalMoveError(f"move {turn + 1}: {player} {move} {reason}")
+        board.play(player, point)
+
+
+def move_features(
+    board_x_size: int, board_y_size: int, initial_stones: list[list[str]], moves: list[list[str]]
+) -> dict[str, list[int]]:
+    """Local features of every move, as a dict of columns aligned with moves.
+
+    region is the 3x3 region index of the move (as in the ownership columns) and line its distance from the nearest
+    edge (1 = first line); captures counts the captured stones, liberties those of the played chain afterwards and
+    ataris the opponent chains adjacent to the move left with one liberty. Passes get region -1 and zeros.
+    """
+    board = Board(board_x_size, board_y_size, track_hashes=False)
+    for player, move in initial_stones:
+        point = parse_move(move, board_x_size, board_y_size)
+        if point is not None:
+            board.place(player, point)
+    features: dict[str, list[int]] = dict((name, []) for name in MOVE_FEATURES)
+    for player, move in moves:
+        point = parse_move(move, board_x_size, board_y_size)
+        if point is None:
+            board.play(player, None)
+            for name in MOVE_FEATURES:
+                features[name].append(-1 if name == "region" else 0)
+            continue
+        y, x = divmod(point, board_x_size)
+        features["region"].append(board_region(point, board_x_size, board_y_size))
+        features["line"].append(min(x, y, board_x_size - 1 - x, board_y_size - 1 - y) + 1)
+        features["captures"].append(board.play(player, point))
+        opponent = BLACK + WHITE - COLORS[player]
+        features["liberties"].append(board.num_liberties(point) if board.stones[point] != EMPTY else 0)
+        atari_chains = set()
+        for n in board.neighbors[point]:
+            if board.stones[n] == opponent and board.num_liberties(n) == 1:
+                atari_chains.add(board.chain_head(n))
+        features["ataris"].append(len(atari_chains))
+    return features
@@ -0,0 +1,51 @@
+"""Single entry point of the IgoAdviser tools.
+
+    python igoadviser.py <command> [options]
+    python igoadviser.py <command> -h
+
+Each command runs the main() of its module, which is only imported when that command runs, so e.g. "analyze"
+does not load pandas and "prompts" does not load pysgf. "pipeline" chains extract, analyze, features, averages
+and prompts in one process (see pipeline.py).
+"""
+from __future__ import annotations
+
+import argparse
+import importlib
+import sys
+from typing import Optional
+
+# command -> (module, description)
+COMMANDS = {
+    "extract": ("sgf_extractor", "Filter SGFs by board size, komi and number of moves"),
+    "corpus": ("corpus", "Compile a directory of SGFs into a packed corpus file"),
+    "analyze": ("analyze", "Analyze games with KataGo and write the per-player result CSV"),
+    "results": ("result_index", "List or print the engine responses of a result log"),
+    "features": ("prompt_data_generator", "Write the per-move features of analyzed games"),
+    "averages": ("calc_average", "Average a result CSV over all games, per color and per player"),
+    "prompt": ("chatgpt_prompt_generator", "Write the prompt of one move"),
+    "overall": ("chatgpt_prompt_generator_overall", "Write the move summary of a feature CSV"),
+    "prompts": ("batch_prompt_generator", "Write the prompts of many moves as JSON lines"),
+    "daemon": ("analysis_daemon", "Run or query the analysis daemon"),
+    "pipeline": ("pipeline", "Run extract, analyze, features, averages and prompts in one process"),
+}
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="igoadviser",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n" + "\n".join(f"  {name:<10} {description}" for name, (_, description) in COMMANDS.items()),
+    )
+    parser.add_argument("command", choices=COMMANDS, metavar="command", help="One of the commands below")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Options of the command")
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(COMMANDS[args.command][0])
+    # The command's parser takes its usage line from sys.argv[0]
+    sys.argv[0] = f"igoadviser {args.command}"
+    module.main(args.args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# Lightweight run instrumentation for analyze.py.
+#
+# Stages are timed with Metrics.timer("name") or Metrics.observe("name", seconds) and kept as count / total /
+# min / max, counters only go up (turns, visits, games) and gauges hold the current value (queries in flight).
+# A MetricsExporter rewrites a JSON or Prometheus text file every few seconds so a run can be watched or
+# scraped while it is going, and Metrics.summary() gives the per-stage table printed at exit.
+
+
+class StageStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_sec": self.total,
+            "mean_sec": self.total / self.count if self.count else 0.0,
+            "min_sec": self.min if self.count else 0.0,
+            "max_sec": self.max,
+        }
+
+
+class Metrics:
+    """Thread-safe stage timers, counters and gauges of one run."""
+
+    def __init__(self) -> None:
+        self.start_time = time.monotonic()
+        self._lock = threading.Lock()
+        self._stages: dict[str, StageStats] = dict()
+        self._counters: dict[str, float] = dict()
+        self._gauges: dict[str, float] = dict()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = StageStats()
+            stats.add(seconds)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = time.monotonic() - self.start_time
+            rates = dict(
+                (f"{name}_per_sec", value / elapsed if elapsed > 0 else 0.0) for name, value in self._counters.items()
+            )
+            return {
+                "elapsed_sec": elapsed,
+                "stages": dict((name, stats.to_dict()) for name, stats in self._stages.items()),
+                "counters": dict(self._counters),
+                "rates": rates,
+                "gauges": dict(self._gauges),
+            }
+
+    def to_prometheus(self, prefix: str = "igoadviser") -> str:
+        snapshot = self.snapshot()
+        lines = [f"{prefix}_elapsed_seconds {snapshot['elapsed_sec']:.6f}"]
+        for name, value in snapshot["counters"].items():
+            lines.append(f"{prefix}_{name}_total {value:g}")
+        for name, value in snapshot["rates"].items():
+            lines.append(f"{prefix}_{name} {value:.6f}")
+        for name, value in snapshot["gauges"].items():
+            lines.append(f"{prefix}_{name} {value:g}")
+        for name, stats in snapshot["stages"].items():
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stats["total_sec"]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_max{{stage="{name}"}} {stats["max_sec"]:.6f}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        snapshot = self.snapshot()
+        lines = [f"elapsed: {snapshot['elapsed_sec']:.1f}s"]
+        lines.append(f"{'stage':<20}{'count':>10}{'total(s)':>12}{'mean(ms)':>12}{'max(ms)':>12}")
+        for name, stats in snapshot["stages"].items():
+            lines.append(
+                f"{name:<20}{stats['count']:>10}{stats['total_sec']:>12.3f}"
+                f"{stats['mean_sec'] * 1000:>12.2f}{stats['max_sec'] * 1000:>12.2f}"
+            )
+        for name, value in snapshot["counters"].items():
+            lines.append(f"{name}: {value:g} ({snapshot['rates'][f'{name}_per_sec']:.1f}/s)")
+        return "\n".join(lines)
+
+
+class MetricsExporter:
+    """Rewrites a metrics file every interval seconds (JSON, or Prometheus text for .prom files) until stopped."""
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = 10.0, fmt: Optional[str] = None) -> None:
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.fmt = fmt or ("prometheus" if path.endswith(".prom") else "json")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> MetricsExporter:
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.write()
+
+    def write(self) -> None:
+        if self.fmt == "prometheus":
+            content = self.metrics.to_prometheus()
+        else:
+            content = json.dumps(self.metrics.snapshot(), indent=2)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, self.path)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.write()
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import argparse
+import os
+import re
+import sys
+from collections.abc import Mapping, MutableMapping
+from typing import Callable, Optional
+
+from corpus import drop_illegal_games, load_games
+from game_data import GameData
+from metrics import Metrics
+
+# The whole workflow in one process: extract (sgf_extractor.py) -> analyze (analyze.py) -> features
+# (prompt_data_generator.py) -> averages (calc_average.py) -> prompts (batch_prompt_generator.py).
+#
+# Games are passed on in memory, and the statistics and features of each game are computed as soon as the engine
+# is done with it (only those are kept), so the filtered SGF directory, the result CSV and the feature CSV of the
+# script-by-script workflow are never written. Ownership is only requested when prompts are written. The engine
+# responses still go to <katago_result_dir>/all.txt (indexed by the result cache), so that a killed run can be started
+# again and later runs can rescore or regenerate features without the engine.
+#
+# pandas is only imported for the averages and prompts steps.
+
+
+def extract_games(input_dir: str, boardsize: int, min_move_count: int) -> dict[str, GameData]:
+    """Games of the SGFs in input_dir that pass the sgf_extractor.py checks, with their content fixed the same way."""
+    from sgf_extractor import extract_string, iter_input_files
+
+    game_data_dict: dict[str, GameData] = dict()
+    paths = sorted(iter_input_files(input_dir))
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+        except (UnicodeDecodeError, OSError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            continue
+        fixed_content, messages = extract_string(content, boardsize, min_move_count)
+        for message in messages:
+            print(f"{path}: {message}")
+        if fixed_content is None:
+            continue
+        name = os.path.basename(path).replace(".sgf", "")
+        try:
+            game_data_dict[name] = GameData.from_sgf_string(fixed_content, name)
+        except AssertionError:
+            print(f"Skip invalid SGF: {path}")
+    print(f"{len(game_data_dict)}/{len(paths)} files extracted.")
+    return game_data_dict
+
+
+def analyze_games(
+    game_data_dict: Mapping[str, GameData],
+    engine_cmds: list[list[str]],
+    katago_result_dir: str,
+    max_in_flight: int,
+    on_game_complete: Callable[[str, list[dict]], None],
+    max_visits: Optional[int] = None,
+    ownership: bool = False,
+    use_cache: bool = True,
+    metrics: Optional[Metrics] = None,
+) -> None:
+    """Analyze the games, passing the responses of each game to on_game_complete as soon as it is done."""
+    from analyze import AnalysisDriver, GameQueries, ResultCache
+
+    os.makedirs(katago_result_dir, exist_ok=True)
+    cache = ResultCache(f"{katago_result_dir}/cache", engine_cmds) if use_cache else None
+    driver = AnalysisDriver(
+        engine_cmds,
+        f"{katago_result_dir}/all.txt",
+        max_in_flight,
+        on_game_complete,
+        cache=cache,
+        metrics=metrics,
+    )
+    try:
+        driver.run(GameQueries(game_data_dict, max_visits, ownership or None))
+    except BaseException:
+        if driver.pool is not None:
+            driver.pool.kill()
+        raise
+
+
+class GameOutputs:
+    """What the averages and prompts steps keep of each analyzed game: its result CSV rows and its feature table.
+
+    Both are computed as soon as a game is done, so the engine responses (with their ownership arrays) are not
+    kept for the rest of the run.
+    """
+
+    def __init__(
+        self,
+        game_data_dict: Mapping[str, GameData],
+        stats: bool,
+        features: bool,
+        region_grid: int = 3,
+        board_features: bool = False,
+    ) -> None:
+        self.game_data_dict = game_data_dict
+        self.stats = stats
+        self.features = features
+        self.region_grid = region_grid
+        self.board_features = board_features
+        self.stats_rows: dict[str, list[str]] = dict()
+        self.feature_tables: dict[str, dict[str, list]] = dict()
+
+    def add_game(self, name: str, katago_results: list[dict]) -> None:
+        game_data = self.game_data_dict[name]
+        if self.stats:
+            from analyze import DEFAULT_METRICS, compute_game_stats, game_stats_rows
+
+            self.stats_rows[name] = game_stats_rows(compute_game_stats(katago_results, game_data), DEFAULT_METRICS)
+        if self.features:
+            from prompt_data_generator import compute_features
+
+            self.feature_tables[name] = compute_features(
+                katago_results, game_data, region_grid=self.region_grid, board_features=self.board_features
+            )
+
+    def write_averages(self, output_file: str, develop: bool = False, by_player: bool = False) -> None:
+        """calc_average.py output of the games, from the rows analyze.py would have written to the result CSV."""
+        from analyze import DEFAULT_METRICS, WINRATE_THRESHOLDS, csv_header
+        from calc_average import RunningStats, write_averages
+
+        rs = RunningStats()
+        rs.add_rows(
+            csv_header(WINRATE_THRESHOLDS, DEFAULT_METRICS),
+            [row for name in sorted(self.stats_rows.keys()) for row in self.stats_rows[name]],
+        )
+        write_averages(rs, output_file, develop, by_player)
+
+    def write_prompts(self, output_file: str, selectors: list[tuple[str, int]], rule: Optional[str] = None) -> int:
+        """batch_prompt_generator.py output of the selected moves."""
+        import pandas as pd
+
+        from batch_prompt_generator import select_rows, write_prompts
+
+        frames = []
+        for name in sorted(self.feature_tables.keys()):
+            frame = pd.DataFrame(self.feature_tables[name])
+            frame.insert(0, "game", name)
+            frames.append(frame)
+        if not frames:
+            return write_prompts(pd.DataFrame(), [], output_file)
+        df = pd.concat(frames, ignore_index=True)
+        return write_prompts(df, select_rows(df, selectors, rule), output_file)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Run extract, analyze, features, averages and prompts in one process.")
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("-d", "--input_dir", help="Raw SGF directory, filtered as sgf_extractor.py does")
+    input_group.add_argument("-s", "--sgf_dir", help="SGF directory that needs no filtering")
+    input_group.add_argument("-c", "--corpus", help="Compiled corpus file (see corpus.py)")
+    parser.add_argument("-b", "--boardsize", type=int, default=19, help="Board size (--input_dir)")
+    parser.add_argument("-m", "--min_move_count", type=int, default=50, help="Minimum number of moves (--input_dir)")
+    parser.add_argument(
+        "-e", "--engine_command", action="append", required=True, help="KataGo analysis engine command (repeatable)"
+    )
+    parser.add_argument("--max_in_flight", type=int, default=16, help="Maximum number of games queued per engine")
+    parser.add_argument("--max_visits", type=int, help="Override maxVisits in config if specified")
+    parser.add_argument("-k", "--katago_result_dir", default="katago_results")
+    parser.add_argument("--no_cache", action="store_true", help="Do not read or write the analysis result cache")
+    parser.add_argument("--averages_output", help="calc_average.py output file (<name>-all/-black/-white<ext>)")
+    parser.add_argument("--develop", action="store_true", help="Also write standard deviations to the averages")
+    parser.add_argument("--by_player", action="store_true", help="Also write per-player averages")
+    parser.add_argument("--prompts_output", help="Prompts JSONL file (see batch_prompt_generator.py)")
+    parser.add_argument("--select", action="append", default=[], help="Prompt target as game:move_num (repeatable)")
+    parser.add_argument("--rule", help='Prompt row filter expression, e.g. "score_loss > 3"')
+    parser.add_argument("--region_grid", type=int, default=3, help="Split the board into N x N ownership regions.")
+    parser.add_argument(
+        "--board_features", action="store_true", help="Add the go_board move features to the feature tables"
+    )
+    args = parser.parse_args(argv)
+    if args.averages_output is None and args.prompts_output is None:
+        parser.error("--averages_output or --prompts_output is required")
+    if args.prompts_output is None and (args.select or args.rule):
+        parser.error("--select and --rule need --prompts_output")
+
+    metrics = Metrics()
+    game_data_dict: MutableMapping[str, GameData]
+    with metrics.timer("parse"):
+        if args.input_dir is not None:
+            game_data_dict = extract_games(args.input_dir, args.boardsize, args.min_move_count)
+        else:
+            game_data_dict = load_games(args.sgf_dir, args.corpus)
+    metrics.inc("games_loaded", len(game_data_dict))
+    if args.corpus is None:
+        # corpus.py already validated the games of a compiled corpus
+        with metrics.timer("validate"):
+            metrics.inc("games_invalid", len(drop_illegal_games(game_data_dict)))
+    if not game_data_dict:
+        sys.exit()
+
+    engine_cmds = [re.split(r"\s+", cmd.strip()) for cmd in args.engine_command]
+    outputs = GameOutputs(
+        game_data_dict,
+        args.averages_output is not None,
+        args.prompts_output is not None,
+        args.region_grid,
+        args.board_features,
+    )
+    analyze_games(
+        game_data_dict,
+        engine_cmds,
+        os.path.abspath(args.katago_result_dir),
+        args.max_in_flight,
+        outputs.add_game,
+        args.max_visits,
+        # only the features of the prompts need ownership, which costs engine time
+        args.prompts_output is not None,
+        not args.no_cache,
+        metrics,
+    )
+
+    if args.averages_output is not None:
+        with metrics.timer("averages"):
+            outputs.write_averages(args.averages_output, args.develop, args.by_player)
+    if args.prompts_output is not None:
+        from batch_prompt_generator import parse_selector
+
+        with metrics.timer("prompts"):
+            selectors = [parse_selector(s) for s in args.select]
+            num_prompts = outputs.write_prompts(args.prompts_output, selectors, args.rule)
+        print(f"{num_prompts} prompts written to {args.prompts_output}")
+    print(metrics.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import argparse
+import json
+import mmap
+import os
+import sys
+from typing import Iterator, Optional
+
+# Random access to the engine responses stored in a result log (katago_results/all.txt).
+#
+# The log holds one JSON response per line, appended a complete game at a time, and <log>.idx is a TSV sidecar
+# with one "id<TAB>turnNumber<TAB>offset<TAB>length<TAB>game offset" line per response, the game offset being
+# where the game's first response starts. Readers load the small index, mmap the log and parse only the lines of
+# the games/turns they ask for. A game written again later (e.g. by a rerun analyzing other turns) supersedes
+# the whole earlier copy. Index lines without a game offset (from build_index or older writers) only supersede
+# the same turns, since the responses of different games may be interleaved in such logs.
+
+
+def index_path(log_path: str) -> str:
+    return f"{log_path}.idx"
+
+
+class ResultLogWriter:
+    def __init__(self, log_path: str, fsync: bool = True) -> None:
+        self.log_path = log_path
+        self.fsync = fsync
+        self._log = open(log_path, "ab")
+        self._index = open(index_path(log_path), "a", encoding="utf-8")
+
+    def append_game(self, id_: str, katago_results: list[dict], moves: Optional[list[list[str]]] = None) -> None:
+        assert "\t" not in id_ and "\n" not in id_, id_
+        offset = game_offset = self._log.seek(0, os.SEEK_END)
+        entries = []
+        for line_dict in sorted(katago_results, key=lambda d: d["turnNumber"]):
+            if line_dict.get("id") != id_:
+                line_dict = dict(line_dict, id=id_)
+            line = f"{json.dumps(line_dict)}\n".encode("utf-8")
+            self._log.write(line)
+            entries.append(f"{id_}\t{line_dict['turnNumber']}\t{offset}\t{len(line)}\t{game_offset}\n")
+            offset += len(line)
+        # The data is on disk before the index points to it, and both are before the caller journals the game
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self._index.write("".join(entries))
+        self._index.flush()
+        if self.fsync:
+            os.fsync(self._index.fileno())
+
+    def close(self) -> None:
+        self._log.close()
+        self._index.close()
+
+    def __enter__(self) -> ResultLogWriter:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def build_index(log_path: str) -> None:
+    """(Re)write the index of a log by scanning it, e.g. for a log written before indexes existed.
+
+    Lines that are not final per-turn responses (errors, warnings, isDuringSearch reports) are skipped.
+    """
+    tmp_path = f"{index_path(log_path)}.tmp"
+    with open(log_path, "rb") as f, open(tmp_path, "w", encoding="utf-8") as w:
+        offset = 0
+        for line in f:
+            try:
+                line_dict = json.loads(line)
+            except json.JSONDecodeError:
+                line_dict = dict()
+            if "turnNumber" in line_dict and "error" not in line_dict and not line_dict.get("isDuringSearch", False):
+                w.write(f"{line_dict['id']}\t{line_dict['turnNumber']}\t{offset}\t{len(line)}\n")
+            offset += len(line)
+    os.replace(tmp_path, index_path(log_path))
+
+
+class ResultLog:
+    """Read-only view of a result log through its index (built first if missing)."""
+
+    def __init__(self, log_path: str) -> None:
+        self.log_path = log_path
+        if not os.path.isfile(index_path(log_path)):
+            build_index(log_path)
+        self._entries: dict[str, dict[int, tuple[int, int]]] = dict()
+        game_offsets: dict[str, int] = dict()
+        log_size = os.path.getsize(log_path)
+        with open(index_path(log_path), "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) not in (4, 5):
+                    continue
+                offset, length = int(fields[2]), int(fields[3])
+                if offset + length > log_size:
+                    continue
+                entries = self._entries.setdefault(fields[0], dict())
+                if len(fields) == 5:
+                    game_offset = int(fields[4])
+                    if game_offsets.get(fields[0]) != game_offset:
+                        entries.clear()
+                    game_offsets[fields[0]] = game_offset
+                entries[int(fields[1])] = (offset, length)
+        self._file = open(log_path, "rb")
+        self._mmap: Optional[mmap.mmap] = None
+        if log_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, id_: object) -> bool:
+        return id_ in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def games(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def turns(self, id_: str) -> list[int]:
+        return sorted(self._entries[id_])
+
+    def load_turn(self, id_: str, turn: int) -> dict:
+        assert self._mmap is not None
+        offset, length = self._entries[id_][turn]
+        return json.loads(self._mmap[offset : offset + length])
+
+    def load(self, id_: str, turns: Optional[list[int]] = None) -> list[dict]:
+        """Responses of a game sorted by turnNumber, optionally only the given turns."""
+        return [self.load_turn(id_, t) for t in (self.turns(id_) if turns is None else sorted(turns))]
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> ResultLog:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log_file", help="Result log, e.g. katago_results/all.txt")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the index from the log")
+    parser.add_argument("-g", "--game", help="Print the responses of this game as JSON lines")
+    parser.add_argument("-t", "--turn", type=int, action="append", help="Only these turns of --game (repeatable)")
+    args = vars(parser.parse_args(argv))
+
+    if args["rebuild"]:
+        build_index(args["log_file"])
+    with ResultLog(args["log_file"]) as result_log:
+        if args["game"] is None:
+            for id_ in result_log.games():
+                print(f"{id_}\t{len(result_log.turns(id_))}")
+        elif args["game"] not in result_log:
+            print(f"{args['game']} not found in {args['log_file']}", file=sys.stderr)
+            sys.exit(1)
+        else:
+            for line_dict in result_log.load(args["game"], args["turn"]):
+                print(json.dumps(line_dict))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import json
+import math
+import mmap
+import os
+import struct
+import zlib
+from typing import Iterator, Optional, Union
+
+import numpy as np
+
+from go_board import gtp_to_point
+from result_index import ResultLog
+
+# Compact binary store of engine responses (katago_results/all.bin), an alternative to the JSON result log.
+#
+# Only the fields the tools read are kept: rootInfo (currentPlayer, winrate, scoreLead, scoreStdev, visits) and
+# per candidate move, order, visits, winrate, scoreLead, prior, pv and isSymmetryOf. Ownership is kept only for
+# the played move and the best move, quantized to float16 (default) or int8. Of a full policy (includePolicy) only
+# the played move's value and its rank among all points are kept (as playedPolicy and playedPolicyRank, which
+# analyze.py's policy_rank reads), and only on square boards, where the policy length gives the board size. Each game is one zlib-compressed
+# block appended to the store; <store>.idx is a TSV sidecar with one "id<TAB>offset<TAB>length" line per block,
+# and a game written again later supersedes the earlier block.
+#
+# Block layout (little endian, before compression):
+#   header  "<4sIIIB"  magic, header JSON length, number of candidates, points per ownership row, ownership dtype code
+#   JSON    per turn [turnNumber, currentPlayer, [[move, pv (space separated), isSymmetryOf or "", has ownership]...]]
+#           followed by [played policy, rank] if the turn had a policy (blocks of older writers never do)
+#   float64 per turn  winrate, scoreLead, scoreStdev, visits
+#   float64 per candidate  visits, winrate, scoreLead, prior
+#   ownership rows (board x * board y each) of the candidates with ownership, in candidate order
+
+MAGIC = b"IGOR"
+# What loading a torn or corrupt record of a result log or store raises (json.JSONDecodeError is a ValueError)
+RECORD_ERRORS = (KeyError, ValueError, IndexError, AssertionError, zlib.error, struct.error)
+BLOCK_HEADER = "<4sIIIB"
+OWNERSHIP_DTYPES = {"float16": 0, "int8": 1}
+INT8_SCALE = 127.0
+
+
+def _moves_equal(a: str, b: str) -> bool:
+    return a.lower() == b.lower()
+
+
+def _played_policy(policy: Optional[list[float]], played: Optional[str]) -> Optional[list[float]]:
+    """[policy value, 1-based rank among all points] of the played move, if the board size can be told."""
+    if policy is None or played is None:
+        return None
+    board_size = math.isqrt(len(policy) - 1)
+    if board_size * board_size != len(policy) - 1:
+        return None
+    point = gtp_to_point(played, board_size, board_size)
+    value = policy[board_size * board_size if point is None else point]
+    return [value, 1 + sum(p > value for p in policy)]
+
+
+def encode_game(katago_results: list[dict], moves: list[list[str]], ownership_dtype: str = "float16") -> bytes:
+    katago_results = sorted(katago_results, key=lambda d: d["turnNumber"])
+    turns = []
+    root_values = []
+    candidate_values = []
+    ownership_rows = []
+    for line_dict in katago_results:
+        turn = line_dict["turnNumber"]
+        root_info = line_dict["rootInfo"]
+        move_infos = sorted(line_dict["moveInfos"], key=lambda m: m["order"])
+        played = moves[turn][1] if turn < len(moves) else None
+        candidates = []
+        for i, move_info in enumerate(move_infos):
+            keep_ownership = "ownership" in move_info and (
+                i == 0 or (played is not None and _moves_equal(played, move_info["move"]))
+            )
+            if keep_ownership:
+                ownership_rows.append(move_info["ownership"])
+            candidates.append(
+                [move_info["move"], " ".join(move_info.get("pv", [])), move_info.get("isSymmetryOf", ""), keep_ownership]
+            )
+            candidate_values.append(
+                [move_info["visits"], move_info["winrate"], move_info["scoreLead"], move_info.get("prior", 0.0)]
+            )
+        turn_entry = [turn, root_info["currentPlayer"], candidates]
+        played_policy = _played_policy(line_dict.get("policy"), played)
+        if played_policy is not None:
+            turn_entry.append(played_policy)
+        turns.append(turn_entry)
+        root_values.append([root_info["winrate"], root_info["scoreLead"], root_info["scoreStdev"], root_info["visits"]])
+
+    ownership = np.asarray(ownership_rows, dtype=np.float64) if ownership_rows else np.zeros((0, 0))
+    if ownership_dtype == "int8":
+        ownership_bytes = np.clip(np.rint(ownership * INT8_SCALE), -127, 127).astype(np.int8).tobytes()
+    else:
+        ownership_bytes = ownership.astype("<f2").tobytes()
+    header_json = json.dumps(turns, separators=(",", ":")).encode("utf-8")
+    payload = b"".join(
+        [
+            struct.pack(
+                BLOCK_HEADER,
+                MAGIC,
+                len(header_json),
+                len(candidate_values),
+                ownership.shape[1],
+                OWNERSHIP_DTYPES[ownership_dtype],
+            ),
+            header_json,
+            np.asarray(root_values, dtype="<f8").tobytes(),
+            np.asarray(candidate_values, dtype="<f8").tobytes(),
+            ownership_bytes,
+        ]
+    )
+    return zlib.compress(payload, 6)
+
+
+def decode_game(block: bytes, id_: str) -> list[dict]:
+    """Responses of a game as JSON-like dicts (ownership as lists of floats), sorted by turnNumber."""
+    payload = zlib.decompress(block)
+    magic, header_length, num_candidates, num_points, dtype_code = struct.unpack_from(BLOCK_HEADER, payload)
+    assert magic == MAGIC
+    pos = struct.calcsize(BLOCK_HEADER)
+    turns = json.loads(payload[pos : pos + header_length])
+    pos += header_length
+    root_values = np.frombuffer(payload, dtype="<f8", count=len(turns) * 4, offset=pos).reshape(-1, 4).tolist()
+    pos += len(turns) * 4 * 8
+    candidate_values = np.frombuffer(payload, dtype="<f8", count=num_candidates * 4, offset=pos).reshape(-1, 4).tolist()
+    pos += num_candidates * 4 * 8
+    if dtype_code == OWNERSHIP_DTYPES["int8"]:
+        ownership = np.frombuffer(payload, dtype=np.int8, offset=pos).astype(np.float64) / INT8_SCALE
+    else:
+        ownership = np.frombuffer(payload, dtype="<f2", offset=pos).astype(np.float64)
+    ownership_rows = iter(ownership.reshape(-1, num_points).tolist() if num_points else [])
+
+    katago_results = []
+    candidate_index = 0
+    for turn_entry, (winrate, score_lead, score_stdev, visits) in zip(turns, root_values):
+        turn, current_player, candidates = turn_entry[:3]
+        move_infos = []
+        for order, (move, pv, symmetry_of, has_ownership) in enumerate(candidates):
+            c_visits, c_winrate, c_score_lead, prior = candidate_values[candidate_index]
+            candidate_index += 1
+            move_info: dict = {
+                "move": move,
+                "order": order,
+                "visits": int(c_visits),
+                "winrate": c_winrate,
+                "scoreLead": c_score_lead,
+                "prior": prior,
+                "pv": pv.split(" ") if pv else [],
+            }
+            if symmetry_of:
+                move_info["isSymmetryOf"] = symmetry_of
+            if has_ownership:
+                move_info["ownership"] = next(ownership_rows)
+            move_infos.append(move_info)
+        line_dict = {
+            "id": id_,
+            "isDuringSearch": False,
+            "turnNumber": turn,
+            "moveInfos": move_infos,
+            "rootInfo": {
+                "currentPlayer": current_player,
+                "winrate": winrate,
+                "scoreLead": score_lead,
+                "scoreStdev": score_stdev,
+                "visits": int(visits),
+            },
+        }
+        if len(turn_entry) > 3:
+            line_dict["playedPolicy"], line_dict["playedPolicyRank"] = turn_entry[3][0], int(turn_entry[3][1])
+        katago_results.append(line_dict)
+    return katago_results
+
+
+class ResultStoreWriter:
+    def __init__(self, store_path: str, ownership_dtype: str = "float16", fsync: bool = True) -> None:
+        assert ownership_dtype in OWNERSHIP_DTYPES
+        self.store_path = store_path
+        self.ownership_dtype = ownership_dtype
+        self.fsync = fsync
+        self._store = open(store_path, "ab")
+        self._index = open(f"{store_path}.idx", "a", encoding="utf-8")
+
+    def append_game(self, id_: str, katago_results: list[dict], moves: Optional[list[list[str]]] = None) -> None:
+        assert "\t" not in id_ and "\n" not in id_, id_
+        assert moves is not None
+        block = encode_game(katago_results, moves, self.ownership_dtype)
+        offset = self._store.seek(0, os.SEEK_END)
+        self._store.write(block)
+        # The data is on disk before the index points to it, and both are before the caller journals the game
+        self._store.flush()
+        if self.fsync:
+            os.fsync(self._store.fileno())
+        self._index.write(f"{id_}\t{offset}\t{len(block)}\n")
+        self._index.flush()
+        if self.fsync:
+            os.fsync(self._index.fileno())
+
+    def close(self) -> None:
+        self._store.close()
+        self._index.close()
+
+    def __enter__(self) -> ResultStoreWriter:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+class ResultStore:
+    def __init__(self, store_path: str) -> None:
+        self.store_path = store_path
+        self._blocks: dict[str, tuple[int, int]] = dict()
+        store_size = os.path.getsize(store_path)
+        with open(f"{store_path}.idx", "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 3:
+                    continue
+                offset, length = int(fields[1]), int(fields[2])
+                if offset + length <= store_size:
+                    self._blocks[fields[0]] = (offset, length)
+        self._file = open(store_path, "rb")
+        self._mmap: Optional[mmap.mmap] = None
+        if store_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, id_: object) -> bool:
+        return id_ in self._blocks
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def games(self) -> Iterator[str]:
+        return iter(self._blocks)
+
+    def load(self, id_: str, turns: Optional[list[int]] = None) -> list[dict]:
+        assert self._mmap is not None
+        offset, length = self._blocks[id_]
+        katago_results = decode_game(self._mmap[offset : offset + length], id_)
+        if turns is not None:
+            turn_set = set(turns)
+            katago_results = [d for d in katago_results if d["turnNumber"] in turn_set]
+        return katago_results
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> ResultStore:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def load_katago_results(katago_result_file: str) -> list[dict]:
+    with open(katago_result_file, "r") as f:
+        return sorted(map(lambda x: json.loads(x), f.read().strip().split("\n")), key=lambda d: d["turnNumber"])
+
+
+def load_game_results(
+    katago_result_dir: str, sgf_name: str, result_log: Optional[Union[ResultStore, ResultLog]]
+) -> list[dict]:
+    # Results of analyze.py runs are read from all.bin or through the all.txt index; per-game files are from older runs
+    if result_log is not None and sgf_name in result_log:
+        return result_log.load(sgf_name)
+    return load_katago_results(f"{katago_result_dir}/{sgf_name}.txt")
+
+
+def open_results(katago_result_dir: str) -> Optional[Union[ResultStore, ResultLog]]:
+    """The stored results of a result directory: all.bin if analyze.py wrote one, otherwise all.txt, or None."""
+    if os.path.isfile(f"{katago_result_dir}/all.bin.idx"):
+        return ResultStore(f"{katago_result_dir}/all.bin")
+    if os.path.isfile(f"{katago_result_dir}/all.txt"):
+        return ResultLog(f"{katago_result_dir}/all.txt")
+    return None
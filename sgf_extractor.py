@@ -1,6 +1,11 @@
 import argparse
+import itertools
 import os
-import glob
+import re
+from multiprocessing import Pool
+
+# One property value, with the property name if it starts a new property (empty for AB[aa][bb]-style lists).
+PROPERTY_RE = re.compile(r"([A-Za-z]*)\s*\[((?:\\.|[^\]\\])*)\]", re.S)
 
 
 class sgf_data():
@@ -12,101 +17,126 @@ class sgf_data():
         self.move_cnt = 0
         self.content = ""
         self.is_save = True
+        self.messages = []
 
     def import_file(self, file_path):
         with open(file_path, 'r', encoding='utf-8') as f:
-            # print(file_path)
-            self.content = f.read()
-            lines = self.content.split("\n")
-            for line in lines:
-                sgf_str = line.rstrip("\n")
-                while len(sgf_str) > 3:
-                    open_br = sgf_str.find("[")
-                    close_br = sgf_str.find("]")
-                    if open_br < 0 or close_br < 0:
-                        # print("[Error] open_br < 0 or close_br < 0 -> %s" % file_path)
-                        break
-                    elif close_br == 0:
-                        # print("[Error] close_br == 0 -> %s" % file_path)
-                        sgf_str = sgf_str[close_br + 1:]
-                        continue
-
-                    # print(f"sgf_str[0:open_br]: {sgf_str[0:open_br]}")
-                    key = sgf_str[0:open_br].lstrip(";").replace(' ', '')
-                    # print(f"key: {key}")
-                    val = sgf_str[open_br + 1:close_br]
-                    # print(f"val: {val}")
-
-                    if key == "SZ":
-                        if val == str(self.size):
-                            self.size = int(val)
-                        else:
-                            self.is_save = False
-                            print(f"{self.size}路盤ではありません。")
-                    elif key == "KM":
-                        if val == "375":
+            self.import_string(f.read())
+
+    def import_string(self, content):
+        self.content = content
+        key = ""
+        for m in PROPERTY_RE.finditer(content):
+            if m.group(1):
+                key = m.group(1)
+            val = m.group(2)
+
+            if key == "SZ":
+                if val == str(self.size):
+                    self.size = int(val)
+                else:
+                    self.is_save = False
+                    self.messages.append(f"{self.size}路盤ではありません。")
+            elif key == "KM":
+                if val == "375":
+                    self.komi = 7.5
+                elif val == "0":
+                    if "HA[0]" in self.content:
+                        if "RU[Japanese]" in self.content:
+                            self.komi = 6.5
+                        elif "RU[Chinese]" in self.content:
                             self.komi = 7.5
-                        elif val == "0":
-                            if "HA[0]" in self.content:
-                                if "RU[Japanese]" in self.content:
-                                    self.komi = 6.5
-                                elif "RU[Chinese]" in self.content:
-                                    self.komi = 7.5
-                            else:
-                                self.is_save = False
-                                print(f"コミ({val})は互先のものではありません。")
-                    elif key == "B" or key == "W":
-                        # print(val)
-                        if key == "B":
-                            self.history.append(val)
-                        elif key == "W":
-                            self.history.append(val)
-                        self.move_cnt += 1
-
-                    # print(sgf_str)
-                    sgf_str = sgf_str[close_br + 1:]
-
-
-def main():
+                    else:
+                        self.is_save = False
+                        self.messages.append(f"コミ({val})は互先のものではありません。")
+            elif (key == "B" or key == "W") and m.group(1):
+                self.history.append(val)
+                self.move_cnt += 1
+
+    def check_move_count(self, min_move_count):
+        if self.is_save and self.move_cnt < min_move_count:
+            self.is_save = False
+            self.messages.append(f"最低必要手数({str(min_move_count)})を満たしていません。")
+
+    def fixed_content(self):
+        content = self.content
+        if "KM[375]" in self.content:
+            content = self.content.replace("KM[375]", "KM[7.5]")
+        elif "KM[0]" in self.content and "RU[Japanese]" in self.content:
+            if "HA[0]" in self.content:
+                if "RU[Japanese]" in self.content:
+                    content = self.content.replace("KM[0]", "KM[6.5]")
+                elif "RU[Chinese]" in self.content:
+                    content = self.content.replace("KM[0]", "KM[7.5]")
+        return content
+
+
+def extract_string(content, boardsize, min_move_count):
+    """Check the content of one SGF. Returns the fixed content (None if it does not pass) and the messages."""
+    sd = sgf_data(boardsize)
+    sd.import_string(content)
+    sd.check_move_count(min_move_count)
+    return (sd.fixed_content() if sd.is_save else None), sd.messages
+
+
+def filter_file(task):
+    """Check one SGF and write it to the output directory if it passes. Runs in a worker process."""
+    sgf, out_dir, boardsize, min_move_count = task
+    try:
+        with open(sgf, 'r', encoding='utf-8') as f:
+            content = f.read()
+    except (UnicodeDecodeError, OSError) as e:
+        return sgf, False, [f"読み込みに失敗しました。({e})"]
+    fixed_content, messages = extract_string(content, boardsize, min_move_count)
+    if fixed_content is not None and out_dir:
+        out_path = os.path.join(out_dir, os.path.basename(sgf))
+        with open(out_path, "w", encoding="utf-8") as w:
+            w.write(fixed_content)
+    return sgf, fixed_content is not None, messages
+
+
+def iter_input_files(input_dir):
+    with os.scandir(input_dir) as it:
+        for entry in it:
+            if not entry.name.startswith("."):
+                yield entry.path
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_dir", "-d", help="Input SGFs directory path.", type=str)
     parser.add_argument("--output_dir", "-o", help="Output SGFs directory path.", type=str)
     parser.add_argument("--boardsize", "-b", default=19, help="Board size.", type=int)
     parser.add_argument("--min_move_count", "-m", default=50, help="Minimum movement number.", type=int)
-    args = parser.parse_args()
-
-    input_files = []
-    if args.input_dir:
-        input_files = glob.glob(os.path.join(args.input_dir, "*"))
+    parser.add_argument("--jobs", "-j", default=os.cpu_count(), help="Number of worker processes.", type=int)
+    args = parser.parse_args(argv)
 
+    out_dir = None
     if args.output_dir:
         out_dir = args.output_dir
         if not os.path.exists(out_dir):
             os.mkdir(out_dir)
 
-    sd_list = []
-    for sgf in input_files:
-        print(sgf)
-        sd_list.append(sgf_data(args.boardsize))
-        sd_list[-1].import_file(sgf)
-
-    for i, sd in enumerate(sd_list):
-        if sd.is_save and sd.move_cnt < args.min_move_count:
-            sd.is_save = False
-            print(f"最低必要手数({str(args.min_move_count)})を満たしていません。")
-        content = sd.content
-        if "KM[375]" in sd.content:
-            content = sd.content.replace("KM[375]", "KM[7.5]")
-        elif "KM[0]" in sd.content and "RU[Japanese]" in sd.content:
-            if "HA[0]" in sd.content:
-                if "RU[Japanese]" in sd.content:
-                    content = sd.content.replace("KM[0]", "KM[6.5]")
-                elif "RU[Chinese]" in sd.content:
-                    content = sd.content.replace("KM[0]", "KM[7.5]")
-        if sd.is_save:
-            out_path = os.path.join(out_dir, os.path.basename(input_files[i]))
-            with open(out_path, "w", encoding="utf-8") as w:
-                w.write(content)
+    input_files = iter_input_files(args.input_dir) if args.input_dir else iter([])
+    tasks = ((sgf, out_dir, args.boardsize, args.min_move_count) for sgf in input_files)
+
+    # Pool.imap consumes its whole input up front, so feed it in bounded batches.
+    chunksize = 64
+    batch_size = args.jobs * chunksize * 4
+    num_saved = 0
+    num_files = 0
+    with Pool(args.jobs) as pool:
+        while True:
+            batch = list(itertools.islice(tasks, batch_size))
+            if not batch:
+                break
+            for sgf, is_save, messages in pool.imap_unordered(filter_file, batch, chunksize):
+                print(sgf)
+                for message in messages:
+                    print(message)
+                num_files += 1
+                num_saved += is_save
+    print(f"{num_saved}/{num_files} files saved.")
 
 if __name__ == "__main__":
     main()
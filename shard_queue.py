@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional, Union
+
+from result_index import ResultLogWriter
+from result_store import ResultStoreWriter, open_results
+
+# Work queue for running analyze.py on several machines that share a filesystem (e.g. an NFS mount).
+#
+# The games are split once into numbered batches of sorted game names, recorded in <queue_dir>/plan.json by
+# whichever worker starts first. A worker claims a batch by creating <batch>.claim with O_CREAT | O_EXCL,
+# which only one creator wins, and keeps the claim's mtime fresh while it works. A claim not refreshed for
+# claim_timeout seconds (its worker died) can be taken over. Each attempt writes its responses and a CSV sorted
+# by game name to <result_dir>/shards/<batch>.<worker>/, and <batch>.done names the attempt that finished.
+# merge_shards concatenates the finished batches in plan order into one result CSV and one result log/store,
+# so the merged output does not depend on how many workers there were or which batch finished first.
+#
+# Two workers may race to take over the same stale claim; at worst a batch is then analyzed twice, and either
+# complete attempt can be merged.
+
+PLAN_FILENAME = "plan.json"
+SHARDS_DIRNAME = "shards"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Batch:
+    def __init__(self, name: str, games: list[str], output_dir: str) -> None:
+        self.name = name
+        self.games = games
+        self.output_dir = output_dir
+
+
+class ShardQueue:
+    def __init__(
+        self,
+        queue_dir: str,
+        result_dir: str,
+        games: list[str],
+        batch_size: int,
+        worker_id: Optional[str] = None,
+        claim_timeout: float = 600.0,
+    ) -> None:
+        assert batch_size >= 1
+        self.queue_dir = queue_dir
+        self.result_dir = result_dir
+        self.worker_id = worker_id or default_worker_id()
+        assert "/" not in self.worker_id and "\t" not in self.worker_id, self.worker_id
+        self.claim_timeout = claim_timeout
+        os.makedirs(queue_dir, exist_ok=True)
+        self.batches = self._load_or_create_plan(sorted(games), batch_size)
+
+    def _load_or_create_plan(self, games: list[str], batch_size: int) -> dict[str, list[str]]:
+        plan_path = f"{self.queue_dir}/{PLAN_FILENAME}"
+        if not os.path.isfile(plan_path):
+            batches = [games[i : i + batch_size] for i in range(0, len(games), batch_size)]
+            plan = {"batch_size": batch_size, "batches": dict((f"batch{i:05d}", b) for i, b in enumerate(batches))}
+            tmp_path = f"{plan_path}.{self.worker_id}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(plan, f, ensure_ascii=False, indent=1)
+            # link fails if another worker created the plan first; its plan is then used
+            try:
+                os.link(tmp_path, plan_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        with open(plan_path, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+        planned = set(g for b in plan["batches"].values() for g in b)
+        unplanned = [g for g in games if g not in planned]
+        if unplanned:
+            print(f"{len(unplanned)} games are not in {plan_path} and will not be analyzed", file=sys.stderr)
+        return plan["batches"]
+
+    def _path(self, batch_name: str, suffix: str) -> str:
+        return f"{self.queue_dir}/{batch_name}{suffix}"
+
+    def is_done(self, batch_name: str) -> bool:
+        return os.path.isfile(self._path(batch_name, ".done"))
+
+    def missing_batches(self) -> list[str]:
+        return [name for name in self.batches if not self.is_done(name)]
+
+    def claim_next(self) -> Optional[Batch]:
+        """Claim the first unclaimed batch, or else take over a stale claim. None when no batch is left."""
+        stale = []
+        for name in self.batches:
+            if self.is_done(name):
+                continue
+            if self._create_claim(name):
+                return self._batch(name)
+            if self._is_stale(name):
+                stale.append(name)
+        for name in stale:
+            stale_path = self._path(name, f".claim.stale.{self.worker_id}")
+            try:
+                os.rename(self._path(name, ".claim"), stale_path)
+            except FileNotFoundError:
+                continue
+            if self._create_claim(name):
+                print(f"Took over stale claim of {name}", file=sys.stderr)
+                return self._batch(name)
+        return None
+
+    def _batch(self, name: str) -> Batch:
+        return Batch(name, self.batches[name], f"{self.result_dir}/{SHARDS_DIRNAME}/{name}.{self.worker_id}")
+
+    def _create_claim(self, name: str) -> bool:
+        try:
+            fd = os.open(self._path(name, ".claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"worker": self.worker_id, "host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}, f)
+        return True
+
+    def _is_stale(self, name: str) -> bool:
+        try:
+            mtime = os.path.getmtime(self._path(name, ".claim"))
+        except FileNotFoundError:
+            return False
+        # mtime is set by the file server; claim_timeout must comfortably exceed the clock skew between nodes
+        return time.time() - mtime > self.claim_timeout
+
+    @contextmanager
+    def holding(self, batch: Batch) -> Iterator[None]:
+        """Keep the claim of a batch fresh while it is analyzed, and give it up if the analysis fails."""
+        stop = threading.Event()
+
+        def refresh() -> None:
+            while not stop.wait(self.claim_timeout / 4):
+                try:
+                    os.utime(self._path(batch.name, ".claim"))
+                except FileNotFoundError:
+                    pass
+
+        thread = threading.Thread(target=refresh, daemon=True)
+        thread.start()
+        try:
+            yield
+        except BaseException:
+            self.release(batch)
+            raise
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, batch: Batch) -> None:
+        done_path = self._path(batch.name, ".done")
+        tmp_path = f"{done_path}.{self.worker_id}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"worker": self.worker_id, "dir": os.path.basename(batch.output_dir)}, f)
+        os.replace(tmp_path, done_path)
+
+    def release(self, batch: Batch) -> None:
+        try:
+            os.remove(self._path(batch.name, ".claim"))
+        except FileNotFoundError:
+            pass
+
+    def finished_dirs(self) -> list[tuple[str, str]]:
+        """(batch, output directory of its finished attempt) of every finished batch, in plan order."""
+        dirs = []
+        for name in self.batches:
+            if self.is_done(name):
+                with open(self._path(name, ".done"), "r", encoding="utf-8") as f:
+                    dirname = json.load(f)["dir"]
+                dirs.append((name, f"{self.result_dir}/{SHARDS_DIRNAME}/{dirname}"))
+        return dirs
+
+
+def merge_shards(
+    shard_queue: ShardQueue,
+    result_csv: str,
+    result_filename: str,
+    result_format: str = "json",
+    ownership_dtype: str = "float16",
+    moves: Optional[dict[str, list[list[str]]]] = None,
+) -> None:
+    """Write the result CSV and the result log/store of all finished batches, in plan order then game order.
+
+    moves (game name -> moves) is needed to write a binary store. Both outputs replace any existing file.
+    """
+    header: Optional[str] = None
+    rows: list[str] = []
+    tmp_filename = f"{result_filename}.merge"
+    for path in (tmp_filename, f"{tmp_filename}.idx"):
+        if os.path.exists(path):
+            os.remove(path)
+    if result_format == "binary":
+        writer: Union[ResultLogWriter, ResultStoreWriter] = ResultStoreWriter(tmp_filename, ownership_dtype, fsync=False)
+    else:
+        # a merge cut short is simply run again, so the files are synced once when complete, not per game
+        writer = ResultLogWriter(tmp_filename, fsync=False)
+    with writer:
+        for name, output_dir in shard_queue.finished_dirs():
+            csv_path = f"{output_dir}/result.csv"
+            if os.path.isfile(csv_path):
+                with open(csv_path, "r", encoding="utf-8") as f:
+                    batch_header = f.readline() + f.readline()
+                    if header is None:
+                        header = batch_header
+                    elif batch_header != header:
+                        raise RuntimeError(f"{csv_path} was written with different winrate thresholds or metrics")
+                    rows.extend(f.readlines())
+            stored_results = open_results(output_dir)
+            if stored_results is None:
+                continue
+            with stored_results:
+                for id_ in shard_queue.batches[name]:
+                    if id_ not in stored_results:
+                        print(f"No stored result for {id_} in {output_dir}", file=sys.stderr)
+                        continue
+                    writer.append_game(id_, stored_results.load(id_), None if moves is None else moves[id_])
+    for path in (tmp_filename, f"{tmp_filename}.idx"):
+        with open(path, "rb") as f:
+            os.fsync(f.fileno())
+    os.replace(tmp_filename, result_filename)
+    os.replace(f"{tmp_filename}.idx", f"{result_filename}.idx")
+
+    if header is not None:
+        tmp_csv = f"{result_csv}.merge"
+        with open(tmp_csv, "w", encoding="utf-8") as f:
+            f.write(header)
+            f.writelines(rows)
+        os.replace(tmp_csv, result_csv)
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import pytest
+
+from go_board import (
+    EMPTY,
+    Board,
+    IllegalMoveError,
+    gtp_to_point,
+    inverse_symmetry,
+    num_symmetries,
+    point_to_gtp,
+    transform_gtp,
+    transform_point,
+    validate_game,
+)
+
+BOARD_SIZES = [(19, 19), (9, 9), (13, 9), (1, 1)]
+
+# B E5 is captured by W D5, which may not be recaptured at once
+KO_MOVES = [["B", "C5"], ["W", "E6"], ["B", "D6"], ["W", "E4"], ["B", "D4"], ["W", "F5"], ["B", "E5"], ["W", "D5"]]
+
+
+def play(board: Board, moves: list[list[str]]) -> int:
+    captured = 0
+    for player, move in moves:
+        captured = board.play(player, gtp_to_point(move, board.board_x_size, board.board_y_size))
+    return captured
+
+
+@pytest.mark.parametrize("board_x_size, board_y_size", BOARD_SIZES)
+def test_gtp_round_trip(board_x_size: int, board_y_size: int) -> None:
+    for point in range(board_x_size * board_y_size):
+        assert gtp_to_point(point_to_gtp(point, board_x_size, board_y_size), board_x_size, board_y_size) == point
+    assert gtp_to_point("pass", board_x_size, board_y_size) is None
+    assert point_to_gtp(None, board_x_size, board_y_size) == "pass"
+
+
+def test_gtp_coordinates() -> None:
+    assert gtp_to_point("A19", 19, 19) == 0
+    assert gtp_to_point("T1", 19, 19) == 19 * 19 - 1
+    assert gtp_to_point("j1", 9, 9) == 80
+    assert point_to_gtp(8, 9, 9) == "J9"
+
+
+@pytest.mark.parametrize("board_x_size, board_y_size", BOARD_SIZES)
+def test_transforms_are_permutations_undone_by_their_inverse(board_x_size: int, board_y_size: int) -> None:
+    points = range(board_x_size * board_y_size)
+    for sym in range(num_symmetries(board_x_size, board_y_size)):
+        transformed = [transform_point(p, sym, board_x_size, board_y_size) for p in points]
+        assert sorted(transformed) == list(points)
+        inverse = inverse_symmetry(sym)
+        assert [transform_point(p, inverse, board_x_size, board_y_size) for p in transformed] == list(points)
+
+
+def test_transform_gtp() -> None:
+    assert transform_gtp("pass", 5, 19, 19) == "pass"
+    assert transform_gtp("D4", 0, 19, 19) == "D4"
+    assert set(transform_gtp("D4", sym, 19, 19) for sym in range(8)) == {"D4", "D16", "Q4", "Q16"}
+    assert set(transform_gtp("C3", sym, 19, 19) for sym in range(8)) == {"C3", "C17", "R3", "R17"}
+    for sym in range(8):
+        assert transform_gtp(transform_gtp("C5", sym, 19, 19), inverse_symmetry(sym), 19, 19) == "C5"
+
+
+def test_canonical_hash_is_the_same_for_every_symmetry() -> None:
+    moves = [["B", "C3"], ["W", "D4"], ["B", "E3"], ["W", "pass"]]
+    hashes = set()
+    for sym in range(8):
+        board = Board(9, 9)
+        play(board, [[player, transform_gtp(move, sym, 9, 9)] for player, move in moves])
+        hashes.add(board.canonical_hash("B")[0])
+    assert len(hashes) == 1
+    board = Board(9, 9)
+    play(board, moves)
+    assert board.canonical_hash("W")[0] not in hashes
+
+
+def test_capture() -> None:
+    board = Board(9, 9)
+    assert play(board, [["B", "A1"], ["W", "A2"], ["B", "J9"]]) == 0
+    assert play(board, [["W", "B1"]]) == 1
+    assert board.stones[gtp_to_point("A1", 9, 9)] == EMPTY
+    assert board.num_liberties(gtp_to_point("A2", 9, 9)) == 3
+
+
+def test_capture_of_a_chain_merged_from_several() -> None:
+    board = Board(9, 9)
+    play(board, [["B", "A1"], ["B", "C1"], ["B", "B1"], ["W", "A2"], ["W", "B2"], ["W", "C2"]])
+    stones, liberties = board.group_and_liberties(gtp_to_point("A1", 9, 9))
+    assert len(stones) == 3 and liberties == {gtp_to_point("D1", 9, 9)}
+    assert play(board, [["W", "D1"]]) == 3
+    assert all(board.stones[gtp_to_point(move, 9, 9)] == EMPTY for move in ("A1", "B1", "C1"))
+
+
+def test_ko() -> None:
+    board = Board(9, 9)
+    assert play(board, KO_MOVES) == 1
+    e5 = gtp_to_point("E5", 9, 9)
+    assert board.stones[e5] == EMPTY
+    assert board.illegal_reason("B", e5) == "retakes a ko"
+    # the ko is only banned for the next move
+    play(board, [["B", "J9"], ["W", "J1"]])
+    assert board.illegal_reason("B", e5) is None
+    assert play(board, [["B", "E5"]]) == 1
+
+
+def test_suicide() -> None:
+    board = Board(9, 9)
+    play(board, [["W", "A2"], ["W", "B2"], ["W", "C1"], ["B", "A1"]])
+    assert board.illegal_reason("B", gtp_to_point("B1", 9, 9)) == "suicide"
+    assert board.illegal_reason("B", gtp_to_point("B1", 9, 9), multi_stone_suicide=True) is None
+    board = Board(9, 9)
+    play(board, [["W", "A2"], ["W", "B1"]])
+    assert board.illegal_reason("B", gtp_to_point("A1", 9, 9), multi_stone_suicide=True) == "suicide"
+    assert board.illegal_reason("W", gtp_to_point("A2", 9, 9)) == "point is occupied"
+
+
+def test_validate_game() -> None:
+    validate_game(9, 9, [], KO_MOVES + [["B", "J9"], ["W", "J1"], ["B", "E5"]], "japanese")
+    with pytest.raises(IllegalMoveError, match="move 9: B E5 retakes a ko"):
+        validate_game(9, 9, [], KO_MOVES + [["B", "E5"]], "japanese")
+    with pytest.raises(IllegalMoveError, match="move 2"):
+        validate_game(9, 9, [["B", "E5"]], [["W", "D4"], ["B", "E5"]], "japanese")
+    suicide = [["W", "A2"], ["B", "J9"], ["W", "B2"], ["B", "J8"], ["W", "C1"], ["B", "A1"], ["W", "J1"], ["B", "B1"]]
+    with pytest.raises(IllegalMoveError, match="move 8: B B1 suicide"):
+        validate_game(9, 9, [], suicide, "japanese")
+    validate_game(9, 9, [], suicide, "tromp-taylor")
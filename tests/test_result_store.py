@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import pytest
+
+from result_store import INT8_SCALE, RECORD_ERRORS, ResultStore, ResultStoreWriter, decode_game, encode_game
+
+MOVES = [["B", "B2"], ["W", "A1"]]
+BOARD_POINTS = 9
+
+
+def ownership(seed: int) -> list[float]:
+    return [((seed * 7 + i * 5) % 21 - 10) / 10 for i in range(BOARD_POINTS)]
+
+
+def katago_results() -> list[dict]:
+    # on a 3x3 board, out of turn order; turn 1's played move A1 is the engine's second candidate
+    policy = [0.1, 0.05, 0.05, 0.1, 0.4, 0.1, 0.05, 0.05, 0.05, 0.05]
+    return [
+        {
+            "id": "engine-id",
+            "isDuringSearch": False,
+            "turnNumber": 1,
+            "moveInfos": [
+                {"move": "C3", "order": 0, "visits": 60, "winrate": 0.25, "scoreLead": -3.5, "prior": 0.5,
+                 "pv": ["C3", "A3"], "ownership": ownership(1)},
+                {"move": "A1", "order": 1, "visits": 30, "winrate": 0.125, "scoreLead": -4.25, "prior": 0.25,
+                 "pv": ["A1"], "isSymmetryOf": "C1", "ownership": ownership(2)},
+                {"move": "B3", "order": 2, "visits": 10, "winrate": 0.0625, "scoreLead": -6.0, "prior": 0.125,
+                 "pv": ["B3"], "ownership": ownership(3)},
+            ],
+            "rootInfo": {"currentPlayer": "W", "winrate": 0.75, "scoreLead": 3.5, "scoreStdev": 9.0, "visits": 100},
+            "policy": policy,
+            "ownership": ownership(4),
+        },
+        {
+            "id": "engine-id",
+            "isDuringSearch": False,
+            "turnNumber": 0,
+            "moveInfos": [
+                {"move": "B2", "order": 0, "visits": 100, "winrate": 0.5, "scoreLead": 0.5, "prior": 0.75, "pv": []},
+            ],
+            "rootInfo": {"currentPlayer": "B", "winrate": 0.5, "scoreLead": 0.5, "scoreStdev": 10.0, "visits": 100},
+            "policy": policy,
+        },
+    ]
+
+
+def expected_results(id_: str) -> list[dict]:
+    """What a decoded block holds of katago_results: the fields the tools read, in turn order."""
+    expected = []
+    for line_dict in sorted(katago_results(), key=lambda d: d["turnNumber"]):
+        move_infos = []
+        for move_info in line_dict["moveInfos"]:
+            move_info = dict(move_info)
+            # only the best and the played move keep their ownership
+            played = MOVES[line_dict["turnNumber"]][1]
+            if move_info["order"] != 0 and move_info["move"] != played:
+                move_info.pop("ownership", None)
+            move_infos.append(move_info)
+        expected.append(
+            {
+                "id": id_,
+                "isDuringSearch": False,
+                "turnNumber": line_dict["turnNumber"],
+                "moveInfos": move_infos,
+                "rootInfo": line_dict["rootInfo"],
+            }
+        )
+    # B2 is the policy's most likely move; A1 (point 6) comes after the four points with more than its 0.05
+    expected[0]["playedPolicy"], expected[0]["playedPolicyRank"] = 0.4, 1
+    expected[1]["playedPolicy"], expected[1]["playedPolicyRank"] = 0.05, 5
+    return expected
+
+
+def split_ownership(results: list[dict]) -> list[list[float]]:
+    rows = []
+    for line_dict in results:
+        for move_info in line_dict["moveInfos"]:
+            if "ownership" in move_info:
+                rows.append(move_info.pop("ownership"))
+    return rows
+
+
+@pytest.mark.parametrize("ownership_dtype, tolerance", [("float16", 1e-3), ("int8", 0.5 / INT8_SCALE)])
+def test_round_trip(ownership_dtype: str, tolerance: float) -> None:
+    decoded = decode_game(encode_game(katago_results(), MOVES, ownership_dtype), "game1")
+    expected = expected_results("game1")
+    decoded_ownership = split_ownership(decoded)
+    expected_ownership = split_ownership(expected)
+    assert decoded == expected
+    assert len(decoded_ownership) == len(expected_ownership) == 2
+    for decoded_row, expected_row in zip(decoded_ownership, expected_ownership):
+        assert decoded_row == pytest.approx(expected_row, abs=tolerance)
+
+
+def test_round_trip_without_ownership_or_policy() -> None:
+    results = katago_results()
+    for line_dict in results:
+        del line_dict["policy"]
+        for move_info in line_dict["moveInfos"]:
+            move_info.pop("ownership", None)
+    decoded = decode_game(encode_game(results, MOVES), "game1")
+    expected = expected_results("game1")
+    split_ownership(expected)
+    for line_dict in expected:
+        del line_dict["playedPolicy"], line_dict["playedPolicyRank"]
+    assert decoded == expected
+
+
+def test_corrupt_block_raises_a_record_error() -> None:
+    block = encode_game(katago_results(), MOVES)
+    with pytest.raises(RECORD_ERRORS):
+        decode_game(block[: len(block) // 2], "game1")
+    with pytest.raises(RECORD_ERRORS):
+        decode_game(bytes(len(block)), "game1")
+
+
+def test_store(tmp_path) -> None:
+    store_path = str(tmp_path / "all.bin")
+    results = katago_results()
+    with ResultStoreWriter(store_path, fsync=False) as writer:
+        writer.append_game("game1", results, MOVES)
+        writer.append_game("game2", results[1:], MOVES)
+        # a game written again supersedes its earlier block
+        writer.append_game("game1", results[:1], MOVES)
+    with ResultStore(store_path) as store:
+        assert sorted(store.games()) == ["game1", "game2"]
+        assert "game3" not in store
+        assert [d["turnNumber"] for d in store.load("game1")] == [1]
+        assert [d["turnNumber"] for d in store.load("game2")] == [0]
+        assert store.load("game2") == decode_game(encode_game(results[1:], MOVES), "game2")
+        assert store.load("game2", turns=[1]) == []
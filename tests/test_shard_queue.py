@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+
+import pytest
+
+from shard_queue import SHARDS_DIRNAME, ShardQueue
+
+GAMES = [f"game{i:02d}" for i in range(10)]
+
+
+def make_queue(tmp_path, worker_id: str, claim_timeout: float = 600.0, games: list[str] = GAMES) -> ShardQueue:
+    return ShardQueue(str(tmp_path / "queue"), str(tmp_path / "results"), games, 4, worker_id, claim_timeout)
+
+
+def make_stale(queue: ShardQueue, batch_name: str) -> None:
+    old = time.time() - queue.claim_timeout - 60
+    os.utime(f"{queue.queue_dir}/{batch_name}.claim", (old, old))
+
+
+def test_plan(tmp_path) -> None:
+    queue = make_queue(tmp_path, "a", games=list(reversed(GAMES)))
+    assert list(queue.batches) == ["batch00000", "batch00001", "batch00002"]
+    assert queue.batches["batch00000"] == GAMES[:4]
+    assert queue.batches["batch00002"] == GAMES[8:]
+    # a later worker uses the recorded plan, whatever games and batch size it was given
+    other = ShardQueue(queue.queue_dir, queue.result_dir, GAMES[:3], 2, "b")
+    assert other.batches == queue.batches
+
+
+def test_claims_are_exclusive(tmp_path) -> None:
+    a = make_queue(tmp_path, "a")
+    b = make_queue(tmp_path, "b")
+    claimed = [a.claim_next(), b.claim_next(), a.claim_next()]
+    assert [batch.name for batch in claimed if batch is not None] == ["batch00000", "batch00001", "batch00002"]
+    assert claimed[1] is not None and claimed[1].output_dir.endswith(f"{SHARDS_DIRNAME}/batch00001.b")
+    # every batch is claimed and no claim is stale
+    assert b.claim_next() is None
+    with open(f"{a.queue_dir}/batch00001.claim", "r", encoding="utf-8") as f:
+        assert json.load(f)["worker"] == "b"
+
+
+def test_stale_claim_is_taken_over(tmp_path) -> None:
+    a = make_queue(tmp_path, "a", claim_timeout=30)
+    b = make_queue(tmp_path, "b", claim_timeout=30)
+    batches = [a.claim_next() for _ in a.batches]
+    assert b.claim_next() is None
+    make_stale(a, "batch00001")
+    batch = b.claim_next()
+    assert batch is not None and batch.name == "batch00001"
+    assert batch.output_dir.endswith("batch00001.b")
+    # the new claim is fresh, so nobody else takes it
+    assert make_queue(tmp_path, "c", claim_timeout=30).claim_next() is None
+    b.complete(batch)
+    make_stale(a, "batch00002")
+    # a finished batch is never claimed again, even with a stale claim left behind
+    make_stale(a, "batch00001")
+    batch = b.claim_next()
+    assert batch is not None and batch.name == "batch00002"
+    assert batches[0] is not None and batches[0].name == "batch00000"
+
+
+def test_complete_and_finished_dirs(tmp_path) -> None:
+    a = make_queue(tmp_path, "a")
+    first = a.claim_next()
+    second = a.claim_next()
+    assert first is not None and second is not None
+    a.complete(second)
+    assert a.is_done("batch00001") and not a.is_done("batch00000")
+    assert a.missing_batches() == ["batch00000", "batch00002"]
+    a.complete(first)
+    assert a.finished_dirs() == [
+        ("batch00000", f"{a.result_dir}/{SHARDS_DIRNAME}/batch00000.a"),
+        ("batch00001", f"{a.result_dir}/{SHARDS_DIRNAME}/batch00001.a"),
+    ]
+
+
+def test_holding_releases_the_claim_on_failure(tmp_path) -> None:
+    a = make_queue(tmp_path, "a")
+    batch = a.claim_next()
+    assert batch is not None
+    with pytest.raises(RuntimeError):
+        with a.holding(batch):
+            raise RuntimeError("engine failed")
+    assert not os.path.exists(f"{a.queue_dir}/{batch.name}.claim")
+    # the released batch is the first one claimed again
+    batch = make_queue(tmp_path, "b").claim_next()
+    assert batch is not None and batch.name == "batch00000"